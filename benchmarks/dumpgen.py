@@ -0,0 +1,418 @@
+"""
+benchmarks.dumpgen
+~~~~~~~~~~~~~~~~~~
+
+Generate synthetic mysqldump output of a configurable size
+
+Usage: python benchmarks/dumpgen.py [options] [--output path]
+
+The output mimics mysqldump 5.5: a header, then for each database its
+table structures, table data (extended INSERTs of at most
+``--net-buffer-length`` bytes), triggers and routines, followed by the
+final view structures and the footer.  A single database is dumped as
+``mysqldump <db>`` would, several as ``mysqldump --databases``.
+
+Every table has a primary key, secondary indexes and, except for the
+first table of each database, a foreign key to the previous table, so
+the output exercises --defer-indexes, --defer-foreign-keys and --sample.
+Row values include escaped quotes, newlines and '),(' sequences inside
+strings.  Output only depends on the options and ``--seed``, so a given
+set of options always produces the same bytes.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import io
+import random
+import sys
+
+HEADER = b"""-- MySQL dump 10.13  Distrib 5.5.40, for Linux (x86_64)
+--
+-- Host: localhost    Database: %(db)s
+-- ------------------------------------------------------
+-- Server version\t5.5.40-log
+
+/*!40101 SET @OLD_CHARACTER_SET_CLIENT=@@CHARACTER_SET_CLIENT */;
+/*!40101 SET @OLD_CHARACTER_SET_RESULTS=@@CHARACTER_SET_RESULTS */;
+/*!40101 SET @OLD_COLLATION_CONNECTION=@@COLLATION_CONNECTION */;
+/*!40101 SET NAMES utf8 */;
+/*!40103 SET @OLD_TIME_ZONE=@@TIME_ZONE */;
+/*!40103 SET TIME_ZONE='+00:00' */;
+/*!40014 SET @OLD_UNIQUE_CHECKS=@@UNIQUE_CHECKS, UNIQUE_CHECKS=0 */;
+/*!40014 SET @OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, \
+FOREIGN_KEY_CHECKS=0 */;
+/*!40101 SET @OLD_SQL_MODE=@@SQL_MODE, SQL_MODE='NO_AUTO_VALUE_ON_ZERO' */;
+/*!40111 SET @OLD_SQL_NOTES=@@SQL_NOTES, SQL_NOTES=0 */;
+
+"""
+
+FOOTER = b"""/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
+
+/*!40101 SET SQL_MODE=@OLD_SQL_MODE */;
+/*!40014 SET FOREIGN_KEY_CHECKS=@OLD_FOREIGN_KEY_CHECKS */;
+/*!40014 SET UNIQUE_CHECKS=@OLD_UNIQUE_CHECKS */;
+/*!40101 SET CHARACTER_SET_CLIENT=@OLD_CHARACTER_SET_CLIENT */;
+/*!40101 SET CHARACTER_SET_RESULTS=@OLD_CHARACTER_SET_RESULTS */;
+/*!40101 SET COLLATION_CONNECTION=@OLD_COLLATION_CONNECTION */;
+/*!40111 SET SQL_NOTES=@OLD_SQL_NOTES */;
+
+-- Dump completed on 2015-01-01  0:00:00
+"""
+
+CREATE_DATABASE = b"""--
+-- Current Database: `%(db)s`
+--
+
+CREATE DATABASE /*!32312 IF NOT EXISTS*/ `%(db)s` \
+/*!40100 DEFAULT CHARACTER SET utf8 */;
+
+USE `%(db)s`;
+
+"""
+
+USE_DATABASE = b"""--
+-- Current Database: `%(db)s`
+--
+
+USE `%(db)s`;
+
+"""
+
+TABLE_STRUCTURE = b"""--
+-- Table structure for table `%(table)s`
+--
+
+DROP TABLE IF EXISTS `%(table)s`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `%(table)s` (
+  `id` int(10) unsigned NOT NULL AUTO_INCREMENT,
+  `parent_id` int(10) unsigned DEFAULT NULL,
+  `name` varchar(64) NOT NULL,
+  `amount` decimal(10,2) NOT NULL,
+  `payload` text,
+  `created` datetime NOT NULL,
+  PRIMARY KEY (`id`),
+  KEY `idx_name` (`name`),
+  KEY `idx_created` (`created`,`amount`)%(parent_key)s
+) ENGINE=InnoDB AUTO_INCREMENT=%(next_id)d DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+"""
+
+PARENT_KEY = b""",
+  KEY `fk_%(table)s_parent` (`parent_id`),
+  CONSTRAINT `fk_%(table)s_parent` FOREIGN KEY (`parent_id`) \
+REFERENCES `%(parent)s` (`id`)"""
+
+TABLE_DATA = b"""--
+-- Dumping data for table `%(table)s`
+--
+
+LOCK TABLES `%(table)s` WRITE;
+/*!40000 ALTER TABLE `%(table)s` DISABLE KEYS */;
+"""
+
+TABLE_DATA_END = b"""/*!40000 ALTER TABLE `%(table)s` ENABLE KEYS */;
+UNLOCK TABLES;
+"""
+
+SAVE_SESSION = b"""/*!50003 SET @saved_cs_client      = @@character_set_client */ ;
+/*!50003 SET @saved_cs_results     = @@character_set_results */ ;
+/*!50003 SET @saved_col_connection = @@collation_connection */ ;
+/*!50003 SET character_set_client  = utf8 */ ;
+/*!50003 SET character_set_results = utf8 */ ;
+/*!50003 SET collation_connection  = utf8_general_ci */ ;
+/*!50003 SET @saved_sql_mode       = @@sql_mode */ ;
+/*!50003 SET sql_mode              = 'NO_AUTO_VALUE_ON_ZERO' */ ;
+DELIMITER ;;
+"""
+
+RESTORE_SESSION = b"""DELIMITER ;
+/*!50003 SET sql_mode              = @saved_sql_mode */ ;
+/*!50003 SET character_set_client  = @saved_cs_client */ ;
+/*!50003 SET character_set_results = @saved_cs_results */ ;
+/*!50003 SET collation_connection  = @saved_col_connection */ ;
+"""
+
+TRIGGER = b"""/*!50003 CREATE*/ /*!50017 DEFINER=`root`@`localhost`*/ \
+/*!50003 TRIGGER `%(table)s_bi` BEFORE INSERT ON `%(table)s`
+FOR EACH ROW SET NEW.created = NOW() */;;
+"""
+
+ROUTINES = b"""--
+-- Dumping routines for database '%(db)s'
+--
+"""
+
+ROUTINE = b"""/*!50003 DROP FUNCTION IF EXISTS `%(name)s` */;
+""" + SAVE_SESSION + b"""CREATE DEFINER=`root`@`localhost` FUNCTION \
+`%(name)s`(p_id INT) RETURNS int(11)
+    READS SQL DATA
+BEGIN
+  DECLARE v_count INT;
+
+  SELECT COUNT(*) INTO v_count FROM `%(table)s` WHERE parent_id = p_id;
+
+  RETURN v_count;
+END ;;
+""" + RESTORE_SESSION
+
+TEMPORARY_VIEW = b"""--
+-- Temporary table structure for view `%(view)s`
+--
+
+DROP TABLE IF EXISTS `%(view)s`;
+/*!50001 DROP VIEW IF EXISTS `%(view)s`*/;
+SET @saved_cs_client     = @@character_set_client;
+SET character_set_client = utf8;
+/*!50001 CREATE TABLE `%(view)s` (
+  `id` tinyint NOT NULL,
+  `name` tinyint NOT NULL
+) ENGINE=MyISAM */;
+SET character_set_client = @saved_cs_client;
+
+"""
+
+VIEW = b"""--
+-- Final view structure for view `%(view)s`
+--
+
+/*!50001 DROP TABLE IF EXISTS `%(view)s`*/;
+/*!50001 DROP VIEW IF EXISTS `%(view)s`*/;
+/*!50001 SET @saved_cs_client          = @@character_set_client */;
+/*!50001 SET @saved_cs_results         = @@character_set_results */;
+/*!50001 SET @saved_col_connection     = @@collation_connection */;
+/*!50001 SET character_set_client      = utf8 */;
+/*!50001 SET character_set_results     = utf8 */;
+/*!50001 SET collation_connection      = utf8_general_ci */;
+/*!50001 CREATE ALGORITHM=UNDEFINED */
+/*!50013 DEFINER=`root`@`localhost` SQL SECURITY DEFINER */
+/*!50001 VIEW `%(view)s` AS select `%(table)s`.`id` AS `id`,\
+`%(table)s`.`name` AS `name` from `%(table)s` */;
+/*!50001 SET character_set_client      = @saved_cs_client */;
+/*!50001 SET character_set_results     = @saved_cs_results */;
+/*!50001 SET collation_connection      = @saved_col_connection */;
+
+"""
+
+# string values, including ones that need escaping or look like row
+# separators, so parsers cannot assume simple input
+WORDS = [b'alpha', b'bravo', b'charlie', b'delta', b'echo', b'foxtrot',
+         b"o\\'brien", b'line\\nbreak', b'tab\\there', b'),(', b'back\\\\']
+
+
+class DumpSpec(object):
+    """Shape of a generated dump
+
+    :param databases: number of databases
+    :param tables: number of tables per database
+    :param rows: number of rows per table
+    :param row_width: approximate size in bytes of each row tuple
+    :param net_buffer_length: maximum size of an extended INSERT
+    :param triggers: add a trigger to every table
+    :param views: number of views per database
+    :param routines: number of stored functions per database
+    :param seed: seed for the row values
+    """
+    def __init__(self, databases=1, tables=8, rows=10000, row_width=128,
+                 net_buffer_length=1024*1024, triggers=True, views=2,
+                 routines=2, seed=0):
+        self.databases = databases
+        self.tables = tables
+        self.rows = rows
+        self.row_width = row_width
+        self.net_buffer_length = net_buffer_length
+        self.triggers = triggers
+        self.views = views
+        self.routines = routines
+        self.seed = seed
+
+    def database_names(self):
+        return [('db%d' % n).encode('ascii')
+                for n in range(1, self.databases + 1)]
+
+    def table_names(self):
+        return [('t%03d' % n).encode('ascii')
+                for n in range(1, self.tables + 1)]
+
+    def view_names(self):
+        return [('v%03d' % n).encode('ascii')
+                for n in range(1, self.views + 1)]
+
+
+def fill(template, **values):
+    """Substitute %(name)s placeholders in a bytes template
+
+    The substitution is done on text, as bytes %-formatting needs python
+    3.5 or later.
+    """
+    for key, value in values.items():
+        if isinstance(value, bytes):
+            values[key] = value.decode('latin-1')
+    return (template.decode('latin-1') % values).encode('latin-1')
+
+
+def rows_for_size(size, **kwargs):
+    """Rows per table so a dump of the given shape is about size bytes"""
+    spec = DumpSpec(rows=0, **kwargs)
+    per_table = size / (spec.databases * spec.tables)
+    # allow ~3 bytes of separators and INSERT prefix overhead per row
+    return max(int(per_table / (spec.row_width + 3)), 1)
+
+
+def generate_rows(spec, rng, table_index):
+    """Yield each row of a table as the text of its VALUES tuple"""
+    created = 1420070400
+    for row_id in range(1, spec.rows + 1):
+        parent = b'NULL'
+        if table_index > 0:
+            parent = str(rng.randint(1, spec.rows)).encode('ascii')
+        name = rng.choice(WORDS) + ('-%d' % row_id).encode('ascii')
+        amount = ('%d.%02d' % (rng.randint(0, 99999),
+                               rng.randint(0, 99))).encode('ascii')
+        created += rng.randint(0, 3600)
+        row = (str(row_id).encode('ascii') + b',' + parent + b",'" + name +
+               b"'," + amount + b",'")
+        # pad the payload so the whole tuple is about row_width bytes
+        padding = max(spec.row_width - len(row) - 24, 0)
+        word = rng.choice(WORDS)
+        payload = (word * (padding // len(word) + 1))[:padding]
+        if payload.endswith(b'\\'):
+            payload = payload[:-1] + b'x'
+        yield row + payload + ("','2015-01-01 %02d:%02d:%02d'" % (
+            (created // 3600) % 24, (created // 60) % 60, created % 60
+        )).encode('ascii')
+
+
+def generate_inserts(spec, rng, table, table_index):
+    """Yield extended INSERT lines of at most net_buffer_length bytes"""
+    prefix = b'INSERT INTO `' + table + b'` VALUES '
+    batch = []
+    size = len(prefix)
+    for row in generate_rows(spec, rng, table_index):
+        if batch and size + len(row) + 3 > spec.net_buffer_length:
+            yield prefix + b','.join(batch) + b';\n'
+            batch = []
+            size = len(prefix)
+        batch.append(b'(' + row + b')')
+        size += len(row) + 3
+    if batch:
+        yield prefix + b','.join(batch) + b';\n'
+
+
+def generate(spec):
+    """Yield the chunks of a synthetic mysqldump for spec"""
+    rng = random.Random(spec.seed)
+    databases = spec.database_names()
+    tables = spec.table_names()
+    multi = len(databases) > 1
+    yield fill(HEADER, db=b'' if multi else databases[0])
+    for database in databases:
+        if multi:
+            yield fill(CREATE_DATABASE, db=database)
+        for view in spec.view_names():
+            yield fill(TEMPORARY_VIEW, view=view)
+        for index, table in enumerate(tables):
+            parent_key = b''
+            if index > 0:
+                parent_key = fill(PARENT_KEY, table=table,
+                                  parent=tables[index - 1])
+            yield fill(TABLE_STRUCTURE, table=table, parent_key=parent_key,
+                       next_id=spec.rows + 1)
+            yield fill(TABLE_DATA, table=table)
+            for line in generate_inserts(spec, rng, table, index):
+                yield line
+            yield fill(TABLE_DATA_END, table=table)
+            if spec.triggers:
+                yield SAVE_SESSION
+                yield fill(TRIGGER, table=table)
+                yield RESTORE_SESSION
+            yield b'\n'
+        if spec.routines:
+            yield fill(ROUTINES, db=database)
+            for n in range(1, spec.routines + 1):
+                yield fill(ROUTINE, name=('f%03d' % n).encode('ascii'),
+                           table=tables[n % len(tables)])
+            yield b'\n'
+    for database in databases:
+        if not spec.views:
+            continue
+        if multi:
+            yield fill(USE_DATABASE, db=database)
+        for n, view in enumerate(spec.view_names()):
+            yield fill(VIEW, view=view, table=tables[n % len(tables)])
+    yield FOOTER
+
+
+def write_dump(spec, fileobj):
+    """Write a synthetic mysqldump for spec to a binary file object
+
+    :returns: number of bytes written
+    """
+    size = 0
+    for chunk in generate(spec):
+        fileobj.write(chunk)
+        size += len(chunk)
+    return size
+
+
+def add_arguments(argparser):
+    """Add options describing a DumpSpec to an ArgumentParser"""
+    argparser.add_argument('--databases', type=int, default=1)
+    argparser.add_argument('--tables', type=int, default=8,
+                           help="tables per database")
+    argparser.add_argument('--rows', type=int, default=10000,
+                           help="rows per table")
+    argparser.add_argument('--size', type=int,
+                           help="approximate dump size in MiB; overrides "
+                                "--rows")
+    argparser.add_argument('--row-width', type=int, default=128)
+    argparser.add_argument('--net-buffer-length', type=int,
+                           default=1024*1024)
+    argparser.add_argument('--no-triggers', dest='triggers',
+                           action='store_false')
+    argparser.add_argument('--views', type=int, default=2)
+    argparser.add_argument('--routines', type=int, default=2)
+    argparser.add_argument('--seed', type=int, default=0)
+
+
+def spec_from_args(args):
+    """Build a DumpSpec from options added by add_arguments()"""
+    kwargs = dict(databases=args.databases,
+                  tables=args.tables,
+                  row_width=args.row_width,
+                  net_buffer_length=args.net_buffer_length,
+                  triggers=args.triggers,
+                  views=args.views,
+                  routines=args.routines,
+                  seed=args.seed)
+    if args.size:
+        rows = rows_for_size(args.size*1024*1024, **kwargs)
+    else:
+        rows = args.rows
+    return DumpSpec(rows=rows, **kwargs)
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser()
+    add_arguments(argparser)
+    argparser.add_argument('-o', '--output',
+                           help="output path (default: stdout)")
+    args = argparser.parse_args(argv)
+
+    spec = spec_from_args(args)
+    if args.output:
+        with io.open(args.output, 'wb') as fileobj:
+            size = write_dump(spec, fileobj)
+    else:
+        stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+        size = write_dump(spec, stdout)
+        stdout.flush()
+    print("Wrote %.1fMB" % (size / 1024.0**2), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"""
+benchmarks.linereader
+~~~~~~~~~~~~~~~~~~~~~
+
+Compare sieve parser throughput using different LineReader implementations
+
+Usage: python benchmarks/linereader.py [--repeat N] [path]
+
+The input defaults to tests/sakila.sql.gz.  Compressed input is
+decompressed into memory up front, and each INSERT line is repeated
+``--repeat`` times so the dump is large enough to measure.  The
+result is written to a temporary file and read back through a regular
+buffered file object, as sieve does for its input.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import gzip
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from dbsake.core.mysql.sieve import parser  # noqa: E402
+
+DEFAULT_INPUT = os.path.join(os.path.dirname(__file__), os.pardir,
+                             'tests', 'sakila.sql.gz')
+
+READERS = [
+    ('LineReader', parser.LineReader),
+    ('BlockLineReader', parser.BlockLineReader),
+]
+
+
+def load_dump(path, repeat):
+    opener = gzip.open if path.endswith('.gz') else io.open
+    result = io.BytesIO()
+    with opener(path, 'rb') as fileobj:
+        for line in fileobj:
+            if line.startswith(b'INSERT'):
+                line *= repeat
+            result.write(line)
+    return result.getvalue()
+
+
+def parse(path, reader_cls):
+    with io.open(path, 'rb') as stream:
+        dump_parser = parser.DumpParser(stream)
+        dump_parser._stream = reader_cls(stream)
+        start = time.time()
+        for section in dump_parser:
+            for _ in section.iterable:
+                pass
+        return time.time() - start
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--repeat', type=int, default=10)
+    argparser.add_argument('--rounds', type=int, default=5)
+    argparser.add_argument('path', nargs='?', default=DEFAULT_INPUT)
+    args = argparser.parse_args(argv)
+
+    data = load_dump(args.path, args.repeat)
+    megabytes = len(data) / 1024.0**2
+    print("%.1fMB, %d lines" % (megabytes, data.count(b'\n')))
+    with tempfile.NamedTemporaryFile() as fileobj:
+        fileobj.write(data)
+        fileobj.flush()
+        del data
+        for name, reader_cls in READERS:
+            elapsed = min(parse(fileobj.name, reader_cls)
+                          for _ in range(args.rounds))
+            print("%-16s %8.3fs %8.1fMB/s" %
+                  (name, elapsed, megabytes / elapsed))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,219 @@
+"""
+benchmarks.sieve_throughput
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Measure sieve throughput on a synthetic dump and check for regressions
+
+Usage: python benchmarks/sieve_throughput.py [options] [--save path]
+                                             [--compare path]
+
+A dump is generated with benchmarks/dumpgen.py (see its options) into a
+temporary file, then each case below is run ``--rounds`` times and the
+best time is reported as MB/s of uncompressed input:
+
+    - parse; DumpParser reading every line of every section
+    - passthrough; sieve with no filters or transforms
+    - filter; sieve outputting a single table
+    - defer-indexes; sieve --defer-indexes --defer-foreign-keys
+    - directory; sieve --format=directory without compression
+    - directory-jobs; sieve --format=directory compressed with gzip -1 by
+      four --jobs workers, checkpointing as it goes
+
+``--save`` writes the results and the dump options to a JSON baseline.
+``--compare`` reads a baseline, reports the change for each case and
+exits with status 1 if any case is more than ``--threshold`` percent
+slower.  Baselines are only comparable for the same dump options, so
+the options are taken from the baseline when comparing.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import dumpgen  # noqa: E402
+from dbsake.core.mysql import sieve  # noqa: E402
+from dbsake.core.mysql.sieve import parser  # noqa: E402
+
+
+def sieve_options(path, output_stream, **kwargs):
+    """Build sieve.Options with the defaults of the sieve command"""
+    options = dict(output_format='stream',
+                   table_schema=True,
+                   table_data=True,
+                   routines=None,
+                   events=None,
+                   triggers=None,
+                   master_data=None,
+                   defer_indexes=False,
+                   defer_foreign_keys=False,
+                   table=(),
+                   exclude_table=(),
+                   write_binlog=True,
+                   directory='.',
+                   compress_command=None)
+    options.update(kwargs)
+    return sieve.Options(input_stream=io.open(path, 'rb'),
+                         output_stream=output_stream,
+                         **options)
+
+
+def run_sieve(path, **kwargs):
+    with io.open(os.devnull, 'wb') as devnull:
+        options = sieve_options(path, devnull, **kwargs)
+        with options.input_stream:
+            sieve.sieve(options)
+
+
+def bench_parse(path, workdir):
+    with io.open(path, 'rb') as stream:
+        for section in parser.DumpParser(stream):
+            for _ in section.iterable:
+                pass
+
+
+def bench_passthrough(path, workdir):
+    run_sieve(path)
+
+
+def bench_filter(path, workdir):
+    run_sieve(path, table=('db1.t001',))
+
+
+def bench_defer_indexes(path, workdir):
+    run_sieve(path, defer_indexes=True, defer_foreign_keys=True)
+
+
+def bench_directory(path, workdir):
+    directory = os.path.join(workdir, 'directory')
+    try:
+        run_sieve(path, output_format='directory', directory=directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_directory_jobs(path, workdir):
+    directory = os.path.join(workdir, 'directory')
+    try:
+        run_sieve(path, output_format='directory', directory=directory,
+                  jobs=4, compress_command='gzip -1')
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+CASES = [
+    ('parse', bench_parse),
+    ('passthrough', bench_passthrough),
+    ('filter', bench_filter),
+    ('defer-indexes', bench_defer_indexes),
+    ('directory', bench_directory),
+    ('directory-jobs', bench_directory_jobs),
+]
+
+
+def measure(func, path, workdir, rounds):
+    """Best wall time of running func(path, workdir) rounds times"""
+    best = None
+    for _ in range(rounds):
+        start = time.time()
+        func(path, workdir)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def compare(results, baseline, threshold):
+    """Print the change from baseline for each case
+
+    :returns: list of case names slower than the baseline by more than
+              threshold percent
+    """
+    regressions = []
+    for name, _ in CASES:
+        if name not in results or name not in baseline:
+            continue
+        change = (results[name] / baseline[name] - 1) * 100
+        flag = ''
+        if change < -threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print("%-16s %8.1fMB/s %8.1fMB/s %+7.1f%%%s" %
+              (name, baseline[name], results[name], change, flag))
+    return regressions
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser()
+    dumpgen.add_arguments(argparser)
+    argparser.add_argument('--rounds', type=int, default=3)
+    argparser.add_argument('--case', action='append',
+                           choices=[name for name, _ in CASES],
+                           help="only run the named case(s)")
+    argparser.add_argument('--save', metavar='PATH',
+                           help="write results to a JSON baseline")
+    argparser.add_argument('--compare', metavar='PATH',
+                           help="compare results with a JSON baseline")
+    argparser.add_argument('--threshold', type=float, default=10.0,
+                           help="percent slowdown reported as a regression "
+                                "(default: 10)")
+    args = argparser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with io.open(args.compare, 'r') as fileobj:
+            baseline = json.load(fileobj)
+        for key, value in baseline['dump'].items():
+            setattr(args, key, value)
+        args.size = None
+    spec = dumpgen.spec_from_args(args)
+
+    workdir = tempfile.mkdtemp(prefix='dbsake-bench-')
+    try:
+        path = os.path.join(workdir, 'dump.sql')
+        with io.open(path, 'wb') as fileobj:
+            size = dumpgen.write_dump(spec, fileobj)
+        megabytes = size / 1024.0**2
+        print("%.1fMB, %d database(s), %d table(s) of %d rows" %
+              (megabytes, spec.databases, spec.tables, spec.rows))
+        results = {}
+        for name, func in CASES:
+            if args.case and name not in args.case:
+                continue
+            elapsed = measure(func, path, workdir, args.rounds)
+            results[name] = megabytes / elapsed
+            if baseline is None:
+                print("%-16s %8.3fs %8.1fMB/s" %
+                      (name, elapsed, results[name]))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save:
+        dump = dict((key, getattr(spec, key))
+                    for key in ('databases', 'tables', 'rows', 'row_width',
+                                'net_buffer_length', 'triggers', 'views',
+                                'routines', 'seed'))
+        with io.open(args.save, 'w') as fileobj:
+            fileobj.write(json.dumps(dict(dump=dump, bytes=size,
+                                          results=results),
+                                     indent=2, sort_keys=True))
+
+    if baseline is not None:
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print("%d case(s) regressed by more than %.0f%%: %s" %
+                  (len(regressions), args.threshold, ', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
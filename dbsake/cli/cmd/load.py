@@ -0,0 +1,65 @@
+"""
+dbsake.cmd.load
+~~~~~~~~~~~~~~~
+
+Parallel restore of sieve directory output
+"""
+import sys
+
+import click
+
+from dbsake.cli import dbsake
+
+
+@dbsake.command('load', options_metavar='[options]')
+@click.option('-C', '--directory',
+              default='.',
+              metavar='<path>',
+              type=click.Path(exists=True, file_okay=False,
+                              resolve_path=True),
+              help="Directory written by sieve --format=directory or tab")
+@click.option('-j', '--jobs',
+              metavar='<n>',
+              default=4,
+              type=click.IntRange(1, None),
+              help="Number of concurrent client processes")
+@click.option('-m', '--mysql-command',
+              metavar='<command>',
+              default='mysql',
+              help="Client command each file is piped through "
+                   "(default: mysql)")
+def load_cli(directory, jobs, mysql_command):
+    """Load sieve directory output in parallel.
+
+    Each file written by sieve --format=directory is piped through a
+    separate mysql client process, with several processes running
+    concurrently.  Databases are created first, then tables are loaded
+    largest first, then any chunked table data and its indexes and triggers,
+    followed by routines and finally views and events.
+
+    --local-infile=1 is added to the mysql command when the directory
+    contains sieve --format=tab data files.
+
+    Example:
+
+        $ dbsake sieve --format=directory -i sakila.sql.gz -C sakila/
+        $ dbsake load -C sakila/ --jobs=8 -m "mysql -uroot"
+    """
+    from dbsake.core.mysql import load
+
+    try:
+        stats = load.load(directory,
+                          jobs=jobs,
+                          mysql_command=mysql_command)
+    except load.LoadError as exc:
+        click.echo(exc, file=sys.stderr)
+        sys.exit(1)
+    else:
+        click.echo(("Loaded %s. %d database(s) %d table(s) %d data chunk(s) "
+                    "%d routine/view/event file(s)") %
+                   (directory,
+                    stats['databases'],
+                    stats['tables'],
+                    stats['data'],
+                    stats['routines'] + stats['views']), file=sys.stderr)
+        sys.exit(0)
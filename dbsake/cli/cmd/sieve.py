@@ -5,6 +5,8 @@ dbsake.cmd.sieve
 Advanced filtering of mysqldump backup files
 """
 import errno
+import os
+import shlex
 import signal
 import sys
 
@@ -12,28 +14,157 @@ import click
 
 from dbsake.cli import dbsake
 from dbsake.util import compression
+from dbsake.util import fmt
+
+
+class InputFile(click.File):
+    """File parameter that also accepts a mydumper directory
+
+    A directory is converted to its path rather than opened.
+    """
+    def convert(self, value, param, ctx):
+        if not hasattr(value, 'read') and value != '-' and \
+                os.path.isdir(value):
+            return os.path.abspath(value)
+        return super(InputFile, self).convert(value, param, ctx)
+
+
+def parse_size(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        size = fmt.parse_filesize(value)
+    except ValueError:
+        raise click.BadParameter("Invalid size '%s'" % value)
+    if size < 1:
+        raise click.BadParameter("Size must be greater than zero")
+    return size
+
+
+def parse_fraction(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        if value.endswith('%'):
+            fraction = float(value[:-1]) / 100
+        else:
+            fraction = float(value)
+    except ValueError:
+        raise click.BadParameter("Invalid fraction '%s'" % value)
+    if not 0 < fraction <= 1:
+        raise click.BadParameter("Fraction must be greater than 0 and "
+                                 "at most 1 (or 100%)")
+    return fraction
+
+
+def parse_where(ctx, param, value):
+    from dbsake.core.mysql.sieve import where
+
+    try:
+        where.parse_all(value)
+    except where.WhereError as exc:
+        raise click.BadParameter(str(exc))
+    return value
+
+
+# options that may be set for each output of --tee
+TEE_OPTIONS = (
+    'output_format',
+    'directory',
+    'compress_command',
+    'jobs',
+    'chunk_size',
+    'chunk_rows',
+    'table',
+    'exclude_table',
+    'where',
+    'defer_indexes',
+    'defer_foreign_keys',
+    'post_load_indexes',
+    'post_load_file',
+    'insert_batch_size',
+    'insert_batch_rows',
+    'write_binlog',
+    'table_schema',
+    'table_data',
+    'routines',
+    'events',
+    'triggers',
+    'master_data',
+    'verify',
+)
+
+
+def parse_tee(ctx, param, value):
+    """Parse each --tee value as the sieve options of another output"""
+    outputs = []
+    for spec in value:
+        try:
+            args = shlex.split(spec)
+        except ValueError as exc:
+            raise click.BadParameter("Invalid options '%s': %s" %
+                                     (spec, exc))
+        params = ctx.command.make_context(ctx.info_name, args,
+                                          parent=ctx).params
+        defaults = ctx.command.make_context(ctx.info_name, [],
+                                            parent=ctx).params
+        for option in ctx.command.params:
+            name = option.name
+            if name not in TEE_OPTIONS and params[name] != defaults[name]:
+                raise click.BadParameter("%s cannot be set for a --tee "
+                                         "output" % option.opts[-1])
+        if params['output_format'] == 'stream':
+            raise click.BadParameter("--tee outputs must use "
+                                     "--format=directory or tab")
+        options = dict((name, params[name]) for name in TEE_OPTIONS)
+        if options['post_load_indexes']:
+            options['defer_indexes'] = True
+        if options['defer_indexes'] and not options['table_data']:
+            options['defer_indexes'] = False
+            options['defer_foreign_keys'] = False
+            options['post_load_indexes'] = False
+        outputs.append(options)
+    return outputs
 
 
 @dbsake.command('sieve', options_metavar='[options]')
 @click.option('-F', '--format', 'output_format',
               metavar='<name>',
               default='stream',
-              type=click.Choice(['stream', 'directory']),
-              help="Select the output format (directory, stream)")
+              type=click.Choice(['stream', 'directory', 'tab']),
+              help="Select the output format (directory, stream, tab)")
 @click.option('-C', '--directory',
               default='.',
               metavar='<path>',
               type=click.Path(resolve_path=True),
-              help="Specify output directory when --format=directory")
+              help="Specify output directory when --format=directory or tab")
 @click.option('-i', '--input-file',
               metavar='<path>',
-              type=click.File(mode='rb', lazy=False),
+              type=InputFile(mode='rb', lazy=False),
               default='-',
-              help="Specify input file to process instead of stdin")
+              help="Specify input file or mydumper directory to process "
+                   "instead of stdin")
 @click.option('-z', '--compress-command',
               metavar='<name>',
               default=compression.filetype_to_command('.gz'),
               help="Specify compression command when --format=directory")
+@click.option('-j', '--jobs',
+              metavar='<n>',
+              default=1,
+              type=click.IntRange(1, None),
+              help="Number of concurrent compression workers when "
+                   "--format=directory and input workers for a mydumper "
+                   "directory")
+@click.option('--chunk-size',
+              metavar='<size>',
+              callback=parse_size,
+              help="Split each table's data into files of about this many "
+                   "bytes when --format=directory")
+@click.option('--chunk-rows',
+              metavar='<n>',
+              type=click.IntRange(1, None),
+              help="Split each table's data into files of about this many "
+                   "rows when --format=directory")
 @click.option('-t', '--table',
               metavar='<glob>',
               multiple=True,
@@ -42,12 +173,53 @@ from dbsake.util import compression
               metavar='<glob>',
               multiple=True,
               help="Excludes tables matching the given glob pattern")
+@click.option('--where',
+              metavar='<db.table:expr>',
+              multiple=True,
+              callback=parse_where,
+              help="Only output rows of db.table matching expr")
+@click.option('--sample',
+              metavar='<fraction>',
+              callback=parse_fraction,
+              help="Keep a fraction of root table rows (e.g. 0.01 or 1%) and "
+                   "the child rows that reference them")
+@click.option('--sample-full',
+              metavar='<glob>',
+              multiple=True,
+              help="Keep all rows of root tables matching the given glob "
+                   "pattern when --sample")
+@click.option('--sample-memory',
+              metavar='<size>',
+              default='128M',
+              callback=parse_size,
+              help="Memory for --sample keys before spilling to temporary "
+                   "files (default: 128M)")
 @click.option('--defer-indexes',
               is_flag=True,
               help="Add secondary indexes after loading table data")
 @click.option('--defer-foreign-keys',
               is_flag=True,
               help="Add foreign key constraints after loading table data")
+@click.option('--post-load-indexes',
+              is_flag=True,
+              help="Write deferred indexes to a separate post-load file "
+                   "(implies --defer-indexes)")
+@click.option('--post-load-file',
+              metavar='<path>',
+              default='post_load.sql',
+              type=click.Path(dir_okay=False),
+              help="Post-load file when --format=stream "
+                   "(default: post_load.sql)")
+@click.option('--insert-batch-size',
+              metavar='<size>',
+              callback=parse_size,
+              help="Rewrite INSERT statements into batches of at most "
+                   "this many bytes (e.g. 16M)")
+@click.option('--insert-batch-rows',
+              metavar='<n>',
+              type=click.IntRange(1, None),
+              help="Rewrite INSERT statements into batches of at most "
+                   "this many rows")
 @click.option('--write-binlog/--no-write-binlog',
               default=True,
               help="Include SQL_LOG_BIN = 0 in output to disable binlog")
@@ -71,16 +243,72 @@ from dbsake.util import compression
               help="Uncomment/comment CHANGE MASTER in input, if present")
 @click.option('-O', '--to-stdout', is_flag=True,
               help="Force output on stdout, even to a terminal.")
+@click.option('--resume', is_flag=True,
+              help="Continue an interrupted --format=directory or tab run "
+                   "from its last checkpoint")
+@click.option('--tee',
+              metavar='<options>',
+              multiple=True,
+              callback=parse_tee,
+              help="Also write an output with these sieve options in the "
+                   "same pass over the input")
+@click.option('--pipeline', is_flag=True,
+              help="Parse and transform input in separate threads from "
+                   "writing output")
+@click.option('--line-memory',
+              metavar='<size>',
+              default='64M',
+              callback=parse_size,
+              help="Memory for a single input line; longer INSERT lines are "
+                   "read in fragments (default: 64M)")
+@click.option('--stats', is_flag=True,
+              help="Report bytes, lines and time spent per stage, section "
+                   "and table")
+@click.option('--stats-format',
+              metavar='<format>',
+              type=click.Choice(['text', 'json']),
+              help="Format of --stats output: text or json (implies --stats)")
+@click.option('--verify',
+              metavar='<path>',
+              type=click.Path(dir_okay=False),
+              help="Write row counts and checksums of each table's output "
+                   "rows to a JSON manifest")
+@click.option('--manifest', is_flag=True,
+              help="Write a JSON list of the objects in the input, with "
+                   "their sizes and estimated row counts, instead of output")
+@click.option('--build-index', is_flag=True,
+              help="Write a section index for the input instead of output")
+@click.option('--index-file',
+              metavar='<path>',
+              type=click.Path(dir_okay=False),
+              help="Section index location (default: <input-file>.idx)")
+@click.option('--index-span',
+              metavar='<size>',
+              default='16M',
+              callback=parse_size,
+              help="Uncompressed distance between the access points of a "
+                   "gzip input's index (default: 16M)")
 @click.pass_context
 def sieve_cli(ctx,
               output_format,
               directory,
               input_file,
               compress_command,
+              jobs,
+              chunk_size,
+              chunk_rows,
               table,
               exclude_table,
+              where,
+              sample,
+              sample_full,
+              sample_memory,
               defer_indexes,
               defer_foreign_keys,
+              post_load_indexes,
+              post_load_file,
+              insert_batch_size,
+              insert_batch_rows,
               write_binlog,
               table_schema,
               table_data,
@@ -88,7 +316,18 @@ def sieve_cli(ctx,
               events,
               triggers,
               master_data,
-              to_stdout):
+              to_stdout,
+              resume,
+              tee,
+              pipeline,
+              line_memory,
+              stats,
+              stats_format,
+              verify,
+              manifest,
+              build_index,
+              index_file,
+              index_span):
     """Filter and transform mysqldump output.
 
     sieve can extract single tables from a mysqldump file and perform useful
@@ -103,19 +342,41 @@ def sieve_cli(ctx,
     """
     from dbsake.core.mysql import sieve
 
+    input_directory = None
+    if not hasattr(input_file, 'read'):
+        input_directory, input_file = input_file, None
+        input_name = input_directory
+    else:
+        input_name = input_file.name
+
     if hasattr(input_file, 'detach'):
         input_file = input_file.detach()
 
-    if output_format == 'stream' and sys.stdout.isatty() and not to_stdout:
+    if output_format == 'stream' and sys.stdout.isatty() and \
+            not (to_stdout or build_index or manifest):
         ctx.fail("stdout appears to be a terminal and --format=stream. "
                  "Use -O/--to-stdout to force output or redirect to a file. "
                  "Aborting.")
 
+    if post_load_indexes:
+        defer_indexes = True
+
     if defer_indexes and not table_data:
         click.echo("Disabling index deferment since --no-data requested",
                    file=sys.stderr)
         defer_indexes = False
         defer_foreign_keys = False
+        post_load_indexes = False
+
+    if stats_format:
+        stats = True
+
+    if pipeline and stats:
+        ctx.fail("--stats cannot be combined with --pipeline")
+
+    if tee and (pipeline or stats or sample):
+        ctx.fail("--tee cannot be combined with --pipeline, --stats or "
+                 "--sample")
 
     options = sieve.Options(output_format=output_format,
                             table_schema=table_schema,
@@ -126,16 +387,40 @@ def sieve_cli(ctx,
                             master_data=master_data,
                             defer_indexes=defer_indexes,
                             defer_foreign_keys=defer_foreign_keys,
+                            post_load_indexes=post_load_indexes,
+                            post_load_file=post_load_file,
+                            insert_batch_size=insert_batch_size,
+                            insert_batch_rows=insert_batch_rows,
                             table=table,
                             exclude_table=exclude_table,
+                            where=where,
+                            sample=sample,
+                            sample_full=sample_full,
+                            sample_memory=sample_memory,
                             write_binlog=write_binlog,
                             directory=directory,
                             compress_command=compress_command,
+                            jobs=jobs,
+                            chunk_size=chunk_size,
+                            chunk_rows=chunk_rows,
+                            tee=[sieve.Options(output_stream=None,
+                                               **options)
+                                 for options in tee],
+                            resume=resume,
+                            pipeline=pipeline,
+                            line_memory=line_memory,
+                            stats=stats,
+                            verify=verify,
+                            manifest=manifest,
+                            build_index=build_index,
+                            index_file=index_file,
+                            index_span=index_span,
                             input_stream=input_file,
+                            input_directory=input_directory,
                             output_stream=click.get_binary_stream('stdout'))
 
     try:
-        stats = sieve.sieve(options)
+        section_stats = sieve.sieve(options)
     except IOError as exc:
         if exc.errno != errno.EPIPE:
             raise  # generate a traceback, in case this is a bug
@@ -146,14 +431,30 @@ def sieve_cli(ctx,
                            file=sys.stderr)
             # exit with SIGPIPE to indicate only partial output
             sys.exit(128 + signal.SIGPIPE)
-    except sieve.Error as exc:
+    except (sieve.Error, compression.DecompressionError) as exc:
         click.echo(exc, file=sys.stderr)
         sys.exit(1)
     else:
+        if build_index:
+            click.echo("Indexed %s. %d section(s)" %
+                       (input_name,
+                        sum(section_stats.values())),
+                       file=sys.stderr)
+            sys.exit(0)
+        if manifest:
+            click.echo("Listed %s. %d section(s)" %
+                       (input_name,
+                        sum(section_stats.values())),
+                       file=sys.stderr)
+            sys.exit(0)
         click.echo(("Processed %s. "
                     "Output: %d database(s) %d table(s) and %d view(s)") %
-                   (options.input_stream.name,
-                    stats['createdatabase'] or 1,
-                    stats['tablestructure'],
-                    stats['view']), file=sys.stderr)
+                   (input_name,
+                    section_stats['createdatabase'] or 1,
+                    section_stats['tablestructure'],
+                    section_stats['view']), file=sys.stderr)
+        if stats_format == 'json':
+            click.echo(section_stats.to_json(), file=sys.stderr)
+        elif stats:
+            click.echo(section_stats.format(), file=sys.stderr)
         sys.exit(0)
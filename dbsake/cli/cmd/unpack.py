@@ -50,6 +50,7 @@ def _unpack(archive,
 
     """
     from dbsake.core.mysql import unpack
+    from dbsake.util import compression
 
     if archive.fileno() == 0 and sys.stdin.isatty():
         print("Refusing to read stdin from console.", file=sys.stderr)
@@ -66,7 +67,7 @@ def _unpack(archive,
                       include_tables=include_tables,
                       exclude_tables=exclude_tables,
                       report_progress=report_progress)
-    except unpack.UnpackError as exc:
+    except (unpack.UnpackError, compression.DecompressionError) as exc:
         print("%s" % exc, file=sys.stderr)
         sys.exit(1)
     else:
@@ -0,0 +1,222 @@
+"""
+dbsake.core.mysql.load
+~~~~~~~~~~~~~~~~~~~~~~
+
+Parallel restore of sieve directory output
+
+A directory written by ``sieve --format=directory`` (or ``--format=tab``)
+is loaded in phases.  Each phase completes before the next one starts:
+
+    - databases: <db>/<db>.createdb
+    - tables: <db>/<table>.sql - table structure, data, deferred indexes and
+      triggers, in the order sieve wrote them
+    - data: <db>/<table>.data-NNNNN.sql - table data chunks written by
+      sieve --chunk-size / --chunk-rows
+    - post: <db>/<table>.post.sql - deferred indexes and triggers for
+      chunked tables
+    - routines: <db>/routines.ddl
+    - views and events: <db>/views.ddl, <db>/events.ddl
+
+Files within a phase are loaded by a pool of concurrent client processes,
+largest files first, so the longest running loads start as early as
+possible.
+
+``--format=tab`` output restores table data with LOAD DATA LOCAL INFILE,
+so --local-infile=1 is added to a mysql client command that does not
+already set it when the directory contains tab data files.
+"""
+from __future__ import unicode_literals
+
+import collections
+import fnmatch
+import logging
+import os
+import threading
+import time
+
+from dbsake.util import cmd
+from dbsake.util import compression
+from dbsake.util import fmt
+
+info = logging.info
+debug = logging.debug
+
+# (phase name, glob patterns matched against per-database file names)
+# a file belongs to the last phase with a matching pattern, as later
+# phases use more specific patterns
+PHASES = (
+    ('databases', ('*.createdb',)),
+    ('tables', ('*.sql',)),
+    ('data', ('*.data-[0-9][0-9][0-9][0-9][0-9].sql',)),
+    ('post', ('*.post.sql',)),
+    ('routines', ('routines.ddl',)),
+    ('views', ('views.ddl', 'events.ddl')),
+)
+
+# extensions sieve adds to files filtered through --compress-command
+COMPRESSION_EXTS = ('.gz', '.bz2', '.lzo', '.xz', '.lzma')
+
+
+class LoadError(Exception):
+    """Raised when a directory cannot be loaded"""
+
+
+Job = collections.namedtuple('Job', 'database path size')
+
+
+def uncompressed_name(name):
+    """Strip any compression extension from a file name"""
+    base, ext = os.path.splitext(name)
+    if ext in COMPRESSION_EXTS:
+        return base
+    return name
+
+
+def discover(directory):
+    """Find the files to load in a sieve output directory
+
+    :returns: list of (phase name, [Job,...]) in load order, with each
+              phase's jobs ordered largest first
+    """
+    if not os.path.isdir(directory):
+        raise LoadError("'%s' is not a directory" % directory)
+    phases = [(name, []) for name, _ in PHASES]
+    for database in sorted(os.listdir(directory)):
+        path = os.path.join(directory, database)
+        if not os.path.isdir(path):
+            continue
+        for name in sorted(os.listdir(path)):
+            base = uncompressed_name(name)
+            for (_, patterns), (_, jobs) in reversed(list(zip(PHASES,
+                                                              phases))):
+                if any(fnmatch.fnmatch(base, pat) for pat in patterns):
+                    file_path = os.path.join(path, name)
+                    jobs.append(Job(database,
+                                    file_path,
+                                    os.path.getsize(file_path)))
+                    break
+    for _, jobs in phases:
+        jobs.sort(key=lambda job: job.size, reverse=True)
+    return phases
+
+
+def has_tab_data(directory):
+    """Check whether a directory contains sieve --format=tab data files"""
+    for database in os.listdir(directory):
+        path = os.path.join(directory, database)
+        if not os.path.isdir(path):
+            continue
+        if any(name.endswith('.txt') for name in os.listdir(path)):
+            return True
+    return False
+
+
+def local_infile_command(command):
+    """Enable LOAD DATA LOCAL INFILE for a mysql client command
+
+    The command is returned unchanged if it does not run the mysql client
+    or if it already sets --local-infile.
+    """
+    args = cmd.shlex_split(command)
+    if not args or os.path.basename(args[0]) != 'mysql':
+        return command
+    if any(arg.startswith(('--local-infile', '--local_infile',
+                           '--enable-local-infile',
+                           '--disable-local-infile',
+                           '--skip-local-infile'))
+           for arg in args[1:]):
+        return command
+    return command + ' --local-infile=1'
+
+
+class Loader(object):
+    """Run jobs through a bounded number of concurrent client processes
+
+    :param command: client command line, e.g. "mysql --local-infile=1"
+    :param jobs: maximum number of concurrent client processes
+    :param directory: working directory for the client processes
+    """
+    def __init__(self, command, jobs, directory):
+        self.command = cmd.shlex_split(command)
+        self.jobs = jobs
+        self.directory = directory
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def load(self, job):
+        """Feed a single file to a client process
+
+        :returns: exit status of the client process
+        """
+        args = list(self.command)
+        name = uncompressed_name(job.path)
+        if not name.endswith('.createdb'):
+            args.append(job.database)
+        with open(job.path, 'rb') as fileobj:
+            if name == job.path:
+                return cmd.run(args, stdin=fileobj, cwd=self.directory)
+            with compression.decompressed(fileobj) as stream:
+                return cmd.run(args, stdin=stream, cwd=self.directory)
+
+    def _worker(self, queue):
+        while True:
+            with self._lock:
+                if not queue or self.errors:
+                    return
+                job = queue.popleft()
+            start = time.time()
+            try:
+                status = self.load(job)
+            except (cmd.CommandError,
+                    compression.DecompressionError,
+                    IOError, OSError) as exc:
+                error = "%s: %s" % (job.path, exc)
+            else:
+                error = None
+                if status != 0:
+                    error = "%s: %s exited with status %d" % (
+                        job.path, self.command[0], status)
+            if error is not None:
+                with self._lock:
+                    self.errors.append(error)
+                return
+            info("Loaded %s (%s) in %s",
+                 os.path.relpath(job.path, self.directory),
+                 fmt.filesize(job.size).strip(),
+                 fmt.timespan(time.time() - start))
+
+    def run(self, jobs):
+        """Load all jobs, largest first, with up to self.jobs processes
+
+        :raises: LoadError if any client process failed
+        """
+        queue = collections.deque(jobs)
+        workers = [threading.Thread(target=self._worker, args=(queue,))
+                   for _ in range(min(self.jobs, len(queue)))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if self.errors:
+            raise LoadError("Failed to load:\n  " + "\n  ".join(self.errors))
+
+
+def load(directory, jobs=1, mysql_command='mysql'):
+    """Load a sieve output directory
+
+    :param directory: path written by sieve --format=directory or tab
+    :param jobs: number of concurrent client processes
+    :param mysql_command: client command to pipe each file through
+    :returns: dict of phase name -> number of files loaded
+    """
+    directory = os.path.abspath(directory)
+    if has_tab_data(directory):
+        mysql_command = local_infile_command(mysql_command)
+    loader = Loader(mysql_command, jobs, directory)
+    stats = collections.OrderedDict()
+    for phase, phase_jobs in discover(directory):
+        debug("# Loading %d file(s) for phase '%s'", len(phase_jobs), phase)
+        loader.run(phase_jobs)
+        stats[phase] = len(phase_jobs)
+    return stats
@@ -7,14 +7,27 @@ Filtering API for mysqldump files
 from __future__ import unicode_literals
 
 import collections
+import io
+import logging
+import os
 
 from dbsake import pycompat
 from dbsake.util import compression
 from dbsake.util import dotdict
+from dbsake.util import gzindex
 
+from . import checkpoint
+from . import checksum
 from . import exc
+from . import index
+from . import manifest
+from . import mydumper
 from . import parser
+from . import pipeline
 from . import filters
+from . import sample
+from . import stats
+from . import tee
 from . import transform
 from . import writers
 
@@ -26,13 +39,145 @@ class Options(dotdict.DotDict):
         super(Options, self).__init__(*args, **kwargs)
         self.setdefault('sections', [])
         self.setdefault('exclude_sections', [])
+        self.setdefault('jobs', 1)
+        self.setdefault('build_index', False)
+        self.setdefault('manifest', False)
+        self.setdefault('index_file', None)
+        self.setdefault('index_span', gzindex.DEFAULT_SPAN)
+        self.setdefault('insert_batch_size', None)
+        self.setdefault('insert_batch_rows', None)
+        self.setdefault('chunk_size', None)
+        self.setdefault('chunk_rows', None)
+        self.setdefault('stats', False)
+        self.setdefault('post_load_indexes', False)
+        self.setdefault('post_load_file', 'post_load.sql')
+        self.setdefault('where', ())
+        self.setdefault('sample', None)
+        self.setdefault('sample_memory', 128*1024*1024)
+        self.setdefault('sample_full', ())
+        self.setdefault('verify', None)
+        self.setdefault('pipeline', False)
+        self.setdefault('input_directory', None)
+        self.setdefault('tee', ())
+        self.setdefault('resume', False)
+        self.setdefault('line_memory', parser.MAX_LINE_SIZE)
 
     def exclude_section(self, name):
         self.exclude_sections.append(name)
 
 
 def sieve(options):
-    if options.output_format == 'directory':
+    if options.input_directory and \
+            (options.build_index or options.manifest or options.sample):
+        raise Error("--build-index, --manifest and --sample cannot read a "
+                    "mydumper directory")
+
+    if options.build_index:
+        return build_index(options)
+
+    if options.manifest:
+        return write_manifest(options)
+
+    if options.tee and (options.pipeline or options.stats or options.sample):
+        raise Error("--tee cannot be combined with --pipeline, --stats or "
+                    "--sample")
+
+    for output in [options] + list(options.tee):
+        prepare_output(output)
+
+    if options.pipeline and options.stats:
+        raise Error("--stats cannot be combined with --pipeline")
+
+    if options.tee:
+        return sieve_tee(options)
+
+    saved = None
+    reason = checkpoint.unsupported(options)
+    if options.resume:
+        if reason:
+            raise Error("--resume " + reason)
+        saved = checkpoint.load(options)
+        if saved is None:
+            logging.info("No checkpoint found in %s. Starting from the "
+                         "beginning of the input.", options.directory)
+
+    section_stats = stats.Stats()
+    start = stats.clock()
+    recorder = stats.Recorder(section_stats) if options.stats else None
+    verifier = checksum.Verifier() if options.verify else None
+
+    with pycompat.ExitStack() as stack:
+        tracker = None
+        if not reason:
+            tracker = stack.enter_context(checkpoint.Checkpoint(options,
+                                                                saved))
+        sampler = None
+        if options.sample:
+            sampler = sample.collect(options)
+            stack.callback(sampler.close)
+        transform_section = transform.SectionTransform(options,
+                                                       sampler=sampler)
+        filter_section = filters.SectionFilter(
+            options,
+            observe=transform_section.observe_filtered
+        )
+        sections, offset = open_input(options, stack, filter_section,
+                                      recorder, tracker)
+        context = transform_section
+        stages = None
+        if options.pipeline:
+            stages = stack.enter_context(
+                pipeline.Pipeline(sections, filter_section,
+                                  transform_section, verifier)
+            )
+            context = stages.context
+        writer = writers.load(options, context=context)
+        if tracker is not None:
+            tracker.track(sections, transform_section, writer, verifier,
+                          section_stats)
+        write_section = writer
+        close_writer = writer.close
+
+        if recorder is not None:
+            sections = recorder.sections(sections, offset)
+            filter_section = recorder.timed('filter', filter_section)
+            transform_section = recorder.timed('transform', transform_section)
+            write_section = recorder.timed('write', write_section)
+            close_writer = recorder.timed('write', close_writer)
+
+        try:
+            if stages is not None:
+                for section in stages:
+                    section_stats[section.name] += 1
+                    write_section(section)
+                sections = ()
+            for section in sections:
+                if not filter_section(section):
+                    section_stats[section.name] += 1
+                    transform_section(section)
+                    if verifier is not None:
+                        verifier(section)
+                    if recorder is not None:
+                        recorder.lines_out(section)
+                    write_section(section)
+                if tracker is not None:
+                    tracker.update(offset())
+        except BaseException:
+            # an error of the writer must not replace this one
+            close_writer(failed=True)
+            raise
+        close_writer()
+
+    if verifier is not None:
+        verifier.write(options.verify)
+
+    section_stats.elapsed = stats.clock() - start
+    return section_stats
+
+
+def prepare_output(options):
+    """Create the output directory and section exclusions of options"""
+    if options.output_format in ('directory', 'tab'):
         pycompat.makedirs(options.directory, exist_ok=True)
 
     if not options.table_schema:
@@ -52,19 +197,138 @@ def sieve(options):
     if options.triggers is False:
         options.exclude_section('triggers')
 
-    with compression.decompressed(options.input_stream) as input_stream:
-        dump_parser = parser.DumpParser(stream=input_stream)
-        filter_section = filters.SectionFilter(options)
-        transform_section = transform.SectionTransform(options)
-        write_section = writers.load(options, context=transform_section)
 
-        stats = collections.defaultdict(int)
+def open_input(options, stack, filter_section, recorder=None, tracker=None):
+    """Open the input described by sieve options as sections
+
+    :param stack: ExitStack the input is closed by
+    :param filter_section: callable returning True for sections that will
+                           be skipped
+    :param recorder: optional stats.Recorder charged for reading input
+    :param tracker: optional checkpoint.Checkpoint the input is opened by,
+                    at the offset of the checkpoint being resumed
+    :returns: tuple of (sections, offset), where offset is None or a
+              callable returning the input offset of the last section
+    """
+    indexed = None
+    if not options.input_directory and tracker is None:
+        indexed = index.open_indexed(options)
+    if options.input_directory:
+        sections = stack.enter_context(
+            mydumper.DirectoryReader(options.input_directory,
+                                     jobs=options.jobs,
+                                     filter_section=filter_section)
+        )
+        return sections, None
+    if indexed is not None:
+        stream, entries = indexed
+        if recorder is not None:
+            stream = recorder.stream(stream)
+        return index.iter_sections(stream, entries), None
+    start = 0
+    if tracker is not None:
+        start = tracker.offset
+        input_stream = tracker.open_input(stack)
+    else:
+        input_stream = stack.enter_context(
+            compression.decompressed(options.input_stream)
+        )
+    if recorder is not None:
+        input_stream = recorder.stream(input_stream)
+    dump_parser = parser.DumpParser(stream=input_stream,
+                                    max_line_size=options.line_memory)
+
+    def offset():
+        return start + dump_parser.offset
+    return dump_parser, offset
+
+
+def sieve_tee(options):
+    """Write the output of options and of each of options.tee in one pass
+
+    :returns: per-section counts of the sections in the output of options
+    """
+    start = stats.clock()
+    with pycompat.ExitStack() as stack:
+        outputs = stack.enter_context(
+            tee.Tee([options] + list(options.tee))
+        )
+        sections, _ = open_input(options, stack, outputs.filter_section)
+        outputs.run(sections)
+    section_stats = outputs.outputs[0].stats
+    section_stats.elapsed = stats.clock() - start
+    return section_stats
+
+
+def build_index(options):
+    """Write a section index for the input described by options
+
+    :returns: per-section counts of the sections indexed
+    """
+    path = index.index_path(options)
+    if path is None:
+        raise Error("An index file must be specified when reading stdin")
+
+    size = mtime = 0
+    gz_reader = None
+    with pycompat.ExitStack() as stack:
+        if compression.is_seekable(options.input_stream):
+            info = os.fstat(options.input_stream.fileno())
+            size, mtime = info.st_size, info.st_mtime
+            gz_reader = open_gzip_indexing(options)
+        if gz_reader is not None:
+            stack.callback(gz_reader.close)
+            input_stream = io.BufferedReader(gz_reader)
+        else:
+            input_stream = stack.enter_context(
+                compression.decompressed(options.input_stream)
+            )
+        dump_parser = parser.DumpParser(stream=input_stream,
+                                        max_line_size=options.line_memory)
+        entries = index.build(dump_parser)
+
+    if gz_reader is not None:
+        gzindex.write_index(index.gzip_index_path(options),
+                            gz_reader.build_index(size, mtime))
+    index.write_index(path, entries, size or dump_parser.offset, mtime)
+
+    stats = collections.defaultdict(int)
+    for entry in entries:
+        stats[entry.name] += 1
+    return stats
+
+
+def open_gzip_indexing(options):
+    """Open a gzip input so its access points are recorded as it is read
+
+    :returns: gzindex.GzipReader or None if the input is not gzip
+              compressed or cannot be indexed
+    """
+    if index.gzip_index_path(options) is None or not gzindex.available():
+        return None
+    if index.input_filetype(options) != '.gz':
+        return None
+    stream = io.open(options.input_stream.fileno(), 'rb', closefd=False)
+    return gzindex.GzipReader(stream, span=options.index_span)
+
+
+def write_manifest(options):
+    """Write a JSON manifest of the input's sections to the output stream
+
+    :returns: per-section counts of the sections listed
+    """
+    with compression.decompressed(options.input_stream) as input_stream:
+        dump_parser = parser.DumpParser(stream=input_stream,
+                                        max_line_size=options.line_memory)
+        entries = manifest.build(dump_parser)
 
-        for section in dump_parser:
-            if filter_section(section):
-                continue
-            stats[section.name] += 1
-            transform_section(section)
-            write_section(section)
+    name = getattr(options.input_stream, 'name', None)
+    if not isinstance(name, str):
+        name = None
+    data = manifest.to_json(entries, name) + '\n'
+    options.output_stream.write(data.encode('utf8'))
 
+    stats = collections.defaultdict(int)
+    for entry in entries:
+        stats[entry.name] += 1
     return stats
@@ -0,0 +1,478 @@
+"""
+dbsake.core.mysql.sieve.checkpoint
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Checkpoints of directory output, so an interrupted sieve run can resume
+
+While sieve writes --format=directory or tab output from a seekable input
+file, it records a checkpoint in the output directory between sections.
+A checkpoint holds the input offset up to which all output is written and
+the state of the parser, transforms and writer that later sections depend
+on.  For gzip input it also refers to the last gzip access point (see
+dbsake.util.gzindex) before that offset, so a resumed run can start
+decompressing there rather than at the start of the file.
+
+Every output file opened after a checkpoint is first recorded in a
+journal, along with its size at the time.  A resumed run truncates those
+files back to the recorded size, or removes files that did not exist,
+before continuing at the checkpoint's offset.
+
+With --jobs, output is still being compressed when a section has been
+parsed, so a checkpoint is first taken as a snapshot, noting how much work
+has been queued for each writer worker.  Parsing goes on and the
+checkpoint is only saved once every worker has completed that much work.
+Files queued for opening after the snapshot are journaled under its
+generation, so they are rolled back if the run is resumed from it.
+
+Checkpoints protect against sieve failing or being killed.  Output is
+not synced to disk, so they do not survive a crash of the host itself.
+"""
+from __future__ import unicode_literals
+
+import collections
+import errno
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+from dbsake.util import compression
+from dbsake.util import gzindex
+
+from . import exc
+from . import index
+
+debug = logging.debug
+info = logging.info
+
+# checkpoint file, relative to the output directory
+CHECKPOINT_NAME = 'sieve.checkpoint'
+
+# format version of the checkpoint file
+VERSION = 1
+
+# minimum number of seconds between checkpoints
+INTERVAL = 1.0
+
+# options that do not change the output of a run
+UNCHECKED_OPTIONS = frozenset([
+    'input_stream',
+    'output_stream',
+    'input_directory',
+    'resume',
+    'jobs',
+    'stats',
+    'pipeline',
+    'line_memory',
+    'tee',
+])
+
+
+class SieveCheckpointError(exc.SieveError):
+    """Raised when a checkpoint cannot be resumed"""
+
+
+def checkpoint_path(options):
+    """Location of the checkpoint for the output of sieve options"""
+    return os.path.join(options.directory, CHECKPOINT_NAME)
+
+
+def unsupported(options):
+    """Explain why checkpoints cannot be written for sieve options
+
+    :returns: reason or None if checkpoints are supported
+    """
+    if options.output_format not in ('directory', 'tab'):
+        return "requires --format=directory or --format=tab"
+    if options.pipeline or options.tee or options.sample:
+        return "cannot be combined with --pipeline, --tee or --sample"
+    if options.input_directory:
+        return "cannot read a mydumper directory"
+    if not compression.is_seekable(options.input_stream):
+        return "requires a seekable input file"
+    path = index.index_path(options)
+    if path is not None and os.path.exists(path):
+        return "cannot read the input through a section index"
+    return None
+
+
+def input_identity(options):
+    """Size and modification time of the input file"""
+    info = os.fstat(options.input_stream.fileno())
+    return info.st_size, int(info.st_mtime)
+
+
+def fingerprint(options):
+    """Digest of the options that determine the output of a run"""
+    values = {}
+    for key, value in options.items():
+        if key in UNCHECKED_OPTIONS:
+            continue
+        try:
+            values[key] = json.dumps(_encode(value), sort_keys=True)
+        except TypeError:
+            continue
+    data = json.dumps(values, sort_keys=True)
+    return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+
+def _encode(value):
+    """Convert state to JSON compatible values, tagging bytes"""
+    if isinstance(value, bytes):
+        return {'__bytes__': value.decode('latin-1')}
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [_encode(item) for item in value]
+    if isinstance(value, dict):
+        return dict((key, _encode(item)) for key, item in value.items())
+    return value
+
+
+def _decode(value):
+    """Reverse _encode()"""
+    if isinstance(value, dict):
+        if list(value) == ['__bytes__']:
+            return value['__bytes__'].encode('latin-1')
+        return dict((key, _decode(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    return value
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+
+
+def _replace(path, write):
+    """Atomically replace path with the output of write(fileobj)"""
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fileobj:
+        write(fileobj)
+    os.rename(tmp, path)
+
+
+def load(options):
+    """Read the checkpoint left by an interrupted run of sieve options
+
+    :returns: checkpoint dict or None if there is no checkpoint
+    :raises: SieveCheckpointError if the checkpoint was written for another
+             input or options
+    """
+    path = checkpoint_path(options)
+    try:
+        fileobj = io.open(path, 'rb')
+    except IOError as error:
+        if error.errno == errno.ENOENT:
+            return None
+        raise
+    with fileobj:
+        try:
+            saved = json.loads(fileobj.read().decode('utf8'))
+        except ValueError:
+            raise SieveCheckpointError("Invalid checkpoint '%s'" % path)
+    if saved.get('version') != VERSION:
+        raise SieveCheckpointError("Unsupported checkpoint version in '%s'" %
+                                   path)
+    size, mtime = input_identity(options)
+    if saved['input'] != dict(size=size, mtime=mtime):
+        raise SieveCheckpointError("Checkpoint '%s' was written for a "
+                                   "different input" % path)
+    if saved['options'] != fingerprint(options):
+        raise SieveCheckpointError("Checkpoint '%s' was written with "
+                                   "different options" % path)
+    saved['state'] = _decode(saved['state'])
+    return saved
+
+
+def read_journal(path, generation):
+    """Read the files opened since a checkpoint from its journal
+
+    :returns: OrderedDict mapping each path to its size before it was
+              first opened in ``generation`` or later, or None if it did
+              not exist
+    """
+    entries = collections.OrderedDict()
+    generations = {}
+    try:
+        fileobj = io.open(path, 'rb')
+    except IOError as error:
+        if error.errno == errno.ENOENT:
+            return entries
+        raise
+    with fileobj:
+        for line in fileobj:
+            try:
+                line_generation, name, size = json.loads(line.decode('utf8'))
+            except ValueError:
+                # interrupted while recording an open; that file was not
+                # opened yet
+                break
+            if line_generation < generation:
+                continue
+            name = _decode(name)
+            if name not in generations or \
+                    line_generation < generations[name]:
+                generations[name] = line_generation
+                entries[name] = size
+    return entries
+
+
+def rollback(entries):
+    """Restore files to the sizes recorded by a journal"""
+    for path, size in entries.items():
+        if size is None:
+            debug("# Removing %r written after the checkpoint", path)
+            _remove(path)
+            continue
+        debug("# Truncating %r to %d bytes", path, size)
+        try:
+            with open(path, 'r+b') as fileobj:
+                fileobj.truncate(size)
+        except IOError as error:
+            if error.errno != errno.ENOENT:
+                raise
+
+
+def _discard(stream, size):
+    """Read and discard size bytes from stream"""
+    while size > 0:
+        data = stream.read(min(size, 1024*1024))
+        if not data:
+            break
+        size -= len(data)
+
+
+class Checkpoint(object):
+    """Record checkpoints of a sieve run and resume from an earlier one
+
+    The caller opens its input via open_input(), registers the objects
+    holding state with track() and calls update() after each section.
+
+    :param options: sieve Options of the run
+    :param saved: checkpoint to resume from, as returned by load()
+    """
+    def __init__(self, options, saved=None):
+        self.options = options
+        self.path = checkpoint_path(options)
+        self.journal_path = self.path + '.journal'
+        self.point_path = self.path + '.gzidx'
+        self.size, self.mtime = input_identity(options)
+        self.fingerprint = fingerprint(options)
+        self.saved = saved
+        self.generation = saved['generation'] if saved else 0
+        self.offset = saved['offset'] if saved else 0
+        self.sections = saved['sections'] if saved else 0
+        self.last_snapshot = None
+        # (generation, offset, sections, state) of a checkpoint waiting
+        # for the writer's barrier, and the barrier's callable
+        self.pending = None
+        self.written = None
+        self.gz_reader = None
+        # gzip access point referenced by the last checkpoint
+        self.point = None
+        # (generation, path, size) journaled since the last checkpoint;
+        # writer workers journal files concurrently
+        self.entries = []
+        self.recorded = set()
+        self.lock = threading.Lock()
+        self.parser = self.transform = self.writer = None
+        self.verifier = self.stats = None
+        if saved:
+            info("Resuming at input offset %d (%d section(s) done)",
+                 self.offset, self.sections)
+            rollback(read_journal(self.journal_path, self.generation))
+        else:
+            _remove(self.path)
+            _remove(self.point_path)
+        self.journal = open(self.journal_path, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.journal.close()
+        if exc_type is None:
+            # the run completed; nothing is left to resume
+            for path in (self.path, self.journal_path, self.point_path):
+                _remove(path)
+
+    def _load_point(self, stream):
+        """Read the gzip access point of the checkpoint being resumed"""
+        if not self.saved or not os.path.exists(self.point_path):
+            return None
+        try:
+            gz_index = gzindex.read_index(self.point_path)
+        except gzindex.GzipIndexError:
+            return None
+        if not gzindex.matches(gz_index, stream) or not gz_index.points or \
+                gz_index.points[0].offset > self.offset:
+            return None
+        self.point = gz_index.points[0]
+        return gz_index
+
+    def open_input(self, stack):
+        """Open the decompressed input at the checkpoint's offset
+
+        :param stack: ExitStack the input is closed by
+        """
+        fd = self.options.input_stream.fileno()
+        filetype = index.input_filetype(self.options)
+        if filetype == '.gz' and gzindex.available():
+            stream = io.open(fd, 'rb', closefd=False)
+            reader = gzindex.GzipReader(stream,
+                                        index=self._load_point(stream),
+                                        span=self.options.index_span)
+            stack.callback(reader.close)
+            reader.seek(self.offset)
+            self.gz_reader = reader
+            return io.BufferedReader(reader)
+        if filetype is None:
+            os.lseek(fd, self.offset, os.SEEK_SET)
+            return stack.enter_context(
+                compression.decompressed(self.options.input_stream)
+            )
+        input_stream = stack.enter_context(
+            compression.decompressed(self.options.input_stream)
+        )
+        _discard(input_stream, self.offset)
+        return input_stream
+
+    def track(self, parser, transform, writer, verifier, stats):
+        """Register the objects whose state is checkpointed
+
+        If resuming, their state is restored from the checkpoint.
+        """
+        self.parser = parser
+        self.transform = transform
+        self.writer = writer
+        self.verifier = verifier
+        self.stats = stats
+        writer.on_open = self.opened
+        writer.barrier(self.generation)
+        if not self.saved:
+            return
+        state = self.saved['state']
+        parser.section.database = state['database']
+        transform.set_state(state['transform'])
+        writer.set_state(state['writer'])
+        if verifier is not None:
+            verifier.set_state(state['verifier'])
+        stats.update(state['stats'])
+
+    def opened(self, path, generation):
+        """Journal an output file before it is opened
+
+        :param generation: generation of the last checkpoint taken before
+                           the file is opened
+        """
+        with self.lock:
+            if (generation, path) in self.recorded:
+                return
+            self.recorded.add((generation, path))
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = None
+            self.entries.append((generation, path, size))
+            self.journal.write(self._journal_entry(generation, path, size))
+            self.journal.flush()
+
+    def _journal_entry(self, generation, path, size):
+        entry = json.dumps([generation, _encode(path), size])
+        return entry.encode('utf8') + b'\n'
+
+    def update(self, offset):
+        """Checkpoint the run, if due, once a section is completely parsed
+
+        A checkpoint is saved once the writer has written all output of
+        the sections before it, without waiting for it to do so.
+
+        :param offset: input offset of the end of the section
+        """
+        self.sections += 1
+        if self.pending is None:
+            if self.last_snapshot is not None and \
+                    time.time() - self.last_snapshot < INTERVAL:
+                return
+            self.snapshot(offset)
+        if self.written():
+            self.save()
+
+    def snapshot(self, offset):
+        """Take a checkpoint at offset, to be saved once it is written"""
+        self.generation += 1
+        self.pending = (self.generation, offset, self.sections,
+                        _encode(self.state()))
+        self.written = self.writer.barrier(self.generation)
+        self.last_snapshot = time.time()
+
+    def _save_point(self, offset):
+        """Write the last gzip access point before offset, if it changed"""
+        points = self.gz_reader.points
+        for idx in range(len(points) - 1, -1, -1):
+            if points[idx].offset <= offset:
+                break
+        else:
+            return
+        point = points[idx]
+        # earlier points are no longer needed
+        del points[:idx]
+        if point is self.point:
+            return
+        gz_index = gzindex.GzipIndex(self.size, self.mtime, 0,
+                                     self.gz_reader.span, [point])
+        gzindex.write_index(self.point_path + '.tmp', gz_index)
+        os.rename(self.point_path + '.tmp', self.point_path)
+        self.point = point
+
+    def state(self):
+        """State of the tracked objects needed to continue the run"""
+        return dict(
+            database=self.parser.section.database,
+            transform=self.transform.get_state(),
+            writer=self.writer.get_state(),
+            verifier=(self.verifier.get_state()
+                      if self.verifier is not None else None),
+            stats=dict(self.stats),
+        )
+
+    def save(self):
+        """Write the pending checkpoint"""
+        generation, offset, sections, state = self.pending
+        self.pending = self.written = None
+        if self.gz_reader is not None:
+            self._save_point(offset)
+        data = collections.OrderedDict([
+            ('version', VERSION),
+            ('generation', generation),
+            ('input', dict(size=self.size, mtime=self.mtime)),
+            ('options', self.fingerprint),
+            ('offset', offset),
+            ('compressed_offset', (self.point.compressed_offset
+                                   if self.point is not None else None)),
+            ('sections', sections),
+            ('state', state),
+        ])
+        _replace(self.path,
+                 lambda fileobj: fileobj.write(
+                     json.dumps(data, indent=2).encode('utf8')
+                 ))
+        # entries of earlier generations are no longer needed
+        with self.lock:
+            self.entries = [entry for entry in self.entries
+                            if entry[0] >= generation]
+            self.recorded = set((entry[0], entry[1])
+                                for entry in self.entries)
+            _replace(self.journal_path,
+                     lambda fileobj: fileobj.write(b''.join(
+                         self._journal_entry(*entry)
+                         for entry in self.entries
+                     )))
+            self.journal.close()
+            self.journal = open(self.journal_path, 'ab')
@@ -0,0 +1,107 @@
+"""
+dbsake.core.mysql.sieve.checksum
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Row counts and order-independent checksums of table data
+
+The crc32 and adler32 of the contents of each row tuple of a table's
+INSERT statements are each summed modulo 2**32, and the two sums combined
+into a single 64-bit checksum.  The sums do not depend on the order of
+rows or how they are batched into INSERT statements, so a table's checksum
+only changes if its rows do.
+"""
+from __future__ import unicode_literals
+
+import collections
+import json
+import zlib
+
+from . import inserts
+
+MASK = 2**32 - 1
+
+ALGORITHM = 'sum32(crc32)<<32|sum32(adler32)'
+
+
+class TableChecksum(object):
+    """Row count and checksum of a single table"""
+    def __init__(self):
+        self.rows = 0
+        self.crc32 = 0
+        self.adler32 = 0
+
+    @property
+    def checksum(self):
+        return self.crc32 << 32 | self.adler32
+
+    def update(self, rows):
+        """Add a list of row tuple contents"""
+        self.rows += len(rows)
+        # zlib checksums are signed on python 2.x; the mask makes the sums
+        # equal either way
+        self.crc32 = (self.crc32 + sum(map(zlib.crc32, rows))) & MASK
+        self.adler32 = (self.adler32 + sum(map(zlib.adler32, rows))) & MASK
+
+
+class Verifier(object):
+    """Accumulate row counts and checksums for the table data sieve writes
+
+    Tables are keyed by (database, table).
+    """
+    def __init__(self):
+        self.tables = collections.OrderedDict()
+
+    def __call__(self, section):
+        """Checksum the rows of a tabledata section as it is written"""
+        if section.name != 'tabledata':
+            return
+        key = (section.database, section.table)
+        if key not in self.tables:
+            self.tables[key] = TableChecksum()
+        section.iterable = self._rows(section.iterable, self.tables[key])
+
+    def _rows(self, lines, table):
+        complete = inserts.Fragments()
+        for line in lines:
+            statement = complete(line)
+            bounds = inserts.values_bounds(statement)
+            if bounds is not None:
+                table.update(inserts.split_rows(statement, *bounds))
+            yield line
+
+    def get_state(self):
+        """Counts and checksums so far, to continue in another run"""
+        return [(database, table, checksum.rows, checksum.crc32,
+                 checksum.adler32)
+                for (database, table), checksum in self.tables.items()]
+
+    def set_state(self, state):
+        """Restore the state of get_state()"""
+        self.tables.clear()
+        for database, table, rows, crc32, adler32 in state:
+            checksum = self.tables[(database, table)] = TableChecksum()
+            checksum.rows = rows
+            checksum.crc32 = crc32
+            checksum.adler32 = adler32
+
+    def as_dict(self):
+        def decode(value):
+            return value.decode('utf8', 'replace')
+        return collections.OrderedDict([
+            ('algorithm', ALGORITHM),
+            ('tables', [
+                collections.OrderedDict([
+                    ('database', decode(database)),
+                    ('table', decode(table)),
+                    ('rows', checksum.rows),
+                    ('checksum', '%016x' % checksum.checksum),
+                ])
+                for (database, table), checksum in sorted(self.tables.items())
+            ]),
+        ])
+
+    def write(self, path):
+        """Write the checksums to path as a JSON manifest"""
+        with open(path, 'w') as fileobj:
+            json.dump(self.as_dict(), fileobj, indent=2)
+            fileobj.write('\n')
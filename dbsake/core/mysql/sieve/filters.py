@@ -5,15 +5,21 @@ dbsake.core.mysql.sieve.filters
 mysqldump section filtering
 """
 
-import fnmatch
 import logging
 
+from dbsake.util import matcher
+
 debug = logging.debug
 
 
 class SectionFilter(object):
-    def __init__(self, options):
+    def __init__(self, options, observe=None):
         self.options = options
+        self.tables = matcher.TableMatcher(options.table,
+                                           options.exclude_table)
+        # called with each filtered section before it is flushed, for
+        # state that later sections depend on even if it is not output
+        self.observe = observe
 
     def filtered_section(self, section):
         include_sections = self.options.sections
@@ -47,27 +53,19 @@ class SectionFilter(object):
         if section.name not in self.TABLE_SECTION_TYPES:
             return False
 
-        identifier = b'.'.join([section.database or b'', section.table or b''])
-        identifier = identifier.decode('utf-8')
-
-        for pattern in self.options.exclude_table:
-            if fnmatch.fnmatch(identifier, pattern):
-                debug("# '%s' matched table exclusion pattern %s. "
-                      "Filtering", identifier, pattern)
-                return True
+        if not self.tables:
+            return False
 
-        for pattern in self.options.table:
-            if fnmatch.fnmatch(identifier, pattern):
-                debug("# '%s' matched a table inclusion pattern(%s). "
-                      "Including.", identifier, pattern)
-                return False
+        return bool(self.tables.table(section.database, section.table))
 
-        debug("# '%s' did not match any inclusion pattern. Filtering.",
-              identifier)
-        return True if self.options.table else False
+    def filtered(self, section):
+        """Check whether section is filtered, without consuming it"""
+        return self.filtered_section(section) or self.filtered_table(section)
 
     def __call__(self, section):
-        if self.filtered_section(section) or self.filtered_table(section):
+        if self.filtered(section):
+            if self.observe is not None:
+                self.observe(section)
             section.flush()
             return True
         else:
@@ -0,0 +1,290 @@
+"""
+dbsake.core.mysql.sieve.index
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Sidecar section index for mysqldump files
+
+An index records the byte offset and length of every section found in a
+mysqldump file, along with the section type and the database / table it
+belongs to.  A later sieve run against the same seekable, uncompressed
+file can then read only the sections that survive filtering rather than
+parsing the whole dump.
+
+For a gzip compressed dump, the sections are located through a gzip
+access-point index (see dbsake.util.gzindex) built alongside the section
+index, so only the compressed data near each section is decompressed.
+"""
+from __future__ import unicode_literals
+
+import collections
+import io
+import logging
+import os
+import struct
+
+from dbsake.util import compression
+from dbsake.util import gzindex
+
+from . import exc
+from . import parser
+
+debug = logging.debug
+
+INDEX_MAGIC = b'DBSKIDX1'
+
+# magic, input size, input mtime
+INDEX_HEADER = struct.Struct(b'<8sQQ')
+
+# offset, length, section type, database length, table length
+INDEX_ENTRY = struct.Struct(b'<QQBHH')
+
+# identifier length used to encode None
+NO_IDENTIFIER = 0xffff
+
+# section types in the order they are encoded in an index
+SECTION_NAMES = tuple(sorted(set(name for _, name in parser.DISCRIMINATORS)))
+
+
+class SieveIndexError(exc.SieveError):
+    """Raised when an index cannot be read or written"""
+
+
+Entry = collections.namedtuple('Entry', 'offset length name database table')
+
+
+def sidecar_path(path):
+    """Default location of the index for a mysqldump file"""
+    return path + '.idx'
+
+
+def index_path(options):
+    """Determine the index path requested by sieve options
+
+    :returns: path to the index or None if no path can be determined
+    """
+    if options.index_file:
+        return options.index_file
+    name = getattr(options.input_stream, 'name', None)
+    if not name or isinstance(name, int) or name.startswith('<'):
+        return None
+    return sidecar_path(name)
+
+
+def gzip_index_path(options):
+    """Determine the gzip access-point index path for sieve options
+
+    The gzip index is kept next to the input file or, if an explicit
+    index file is requested, next to the section index.
+
+    :returns: path to the gzip index or None if no path can be determined
+    """
+    if options.index_file:
+        return os.path.splitext(options.index_file)[0] + '.gzidx'
+    name = getattr(options.input_stream, 'name', None)
+    if not name or isinstance(name, int) or name.startswith('<'):
+        return None
+    return gzindex.sidecar_path(name)
+
+
+def _pack_identifier(value):
+    if value is None:
+        return NO_IDENTIFIER, b''
+    return len(value), value
+
+
+def _unpack_identifier(fileobj, length):
+    if length == NO_IDENTIFIER:
+        return None
+    return fileobj.read(length)
+
+
+def write_index(path, entries, size, mtime=0):
+    """Write index entries to path
+
+    :param path: path of the index file to create
+    :param entries: sequence of Entry instances
+    :param size: total size of the indexed input
+    :param mtime: modification time of the indexed input, if known
+    """
+    with open(path, 'wb') as fileobj:
+        fileobj.write(INDEX_HEADER.pack(INDEX_MAGIC, size, int(mtime)))
+        for entry in entries:
+            db_len, database = _pack_identifier(entry.database)
+            tbl_len, table = _pack_identifier(entry.table)
+            fileobj.write(INDEX_ENTRY.pack(entry.offset,
+                                           entry.length,
+                                           SECTION_NAMES.index(entry.name),
+                                           db_len,
+                                           tbl_len))
+            fileobj.write(database)
+            fileobj.write(table)
+
+
+def read_index(path):
+    """Read an index previously created by write_index()
+
+    :returns: tuple of (size, mtime, entries)
+    :raises: SieveIndexError if path is not a valid index
+    """
+    with open(path, 'rb') as fileobj:
+        header = fileobj.read(INDEX_HEADER.size)
+        if len(header) != INDEX_HEADER.size:
+            raise SieveIndexError("Truncated index '%s'" % path)
+        magic, size, mtime = INDEX_HEADER.unpack(header)
+        if magic != INDEX_MAGIC:
+            raise SieveIndexError("'%s' is not a sieve index" % path)
+        entries = []
+        while True:
+            data = fileobj.read(INDEX_ENTRY.size)
+            if not data:
+                break
+            if len(data) != INDEX_ENTRY.size:
+                raise SieveIndexError("Truncated index '%s'" % path)
+            offset, length, name, db_len, tbl_len = INDEX_ENTRY.unpack(data)
+            database = _unpack_identifier(fileobj, db_len)
+            table = _unpack_identifier(fileobj, tbl_len)
+            entries.append(Entry(offset, length, SECTION_NAMES[name],
+                                 database, table))
+    return size, mtime, entries
+
+
+def build(dump_parser):
+    """Consume a DumpParser, recording the location of each section
+
+    :returns: list of Entry instances
+    """
+    entries = []
+    for section in dump_parser:
+        offset = dump_parser.offset
+        section.flush()
+        entries.append(Entry(offset,
+                             dump_parser.offset - offset,
+                             section.name,
+                             section.database,
+                             section.table))
+    return entries
+
+
+class Region(object):
+    """Iterate over the lines in a byte range of a seekable stream
+
+    The stream position is restored before each read, so several regions
+    may share one underlying stream.
+    """
+    def __init__(self, stream, offset, length):
+        self.stream = stream
+        self.position = offset
+        self.remaining = length
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.remaining <= 0:
+            self.closed = True
+            raise StopIteration()
+        self.stream.seek(self.position)
+        line = self.stream.readline(self.remaining)
+        if not line:
+            self.closed = True
+            raise StopIteration()
+        self.position += len(line)
+        self.remaining -= len(line)
+        return line
+    # python 2.x shim
+    next = __next__
+
+
+class IndexedSection(parser.Section):
+    """Section read directly from its indexed location
+
+    Unread sections do not need to be skipped over, so flush is a no-op.
+    """
+    def flush(self):
+        pass
+
+
+def iter_sections(stream, entries):
+    """Yield a section for each index entry, reading it from stream
+
+    :param stream: seekable binary stream of the uncompressed mysqldump
+    :param entries: sequence of Entry instances for stream
+    """
+    for entry in entries:
+        region_parser = parser.DumpParser(stream=Region(stream,
+                                                        entry.offset,
+                                                        entry.length))
+        section = region_parser.section = IndexedSection()
+        reader = region_parser.section_reader(entry.name)
+        section.__dict__.update(name=entry.name,
+                                database=entry.database,
+                                table=entry.table,
+                                iterable=reader())
+        yield section
+
+
+def open_indexed(options):
+    """Open the input described by sieve options for indexed reads
+
+    An index is only used if it exists, the input is a seekable
+    uncompressed file and the index matches the input's size and mtime.
+
+    :returns: tuple of (stream, entries) or None if no index can be used
+    """
+    path = index_path(options)
+    if path is None or not os.path.exists(path):
+        return None
+    if not compression.is_seekable(options.input_stream):
+        debug("# Input is not seekable. Ignoring index %s", path)
+        return None
+    filetype = input_filetype(options)
+    stream = io.open(options.input_stream.fileno(), 'rb', closefd=False)
+    if filetype is not None:
+        stream = open_gzip_indexed(stream, filetype, options)
+        if stream is None:
+            debug("# Input is compressed. Ignoring index %s", path)
+            return None
+    size, mtime, entries = read_index(path)
+    info = os.fstat(options.input_stream.fileno())
+    if size != info.st_size or (mtime and mtime != int(info.st_mtime)):
+        debug("# Index %s does not match input. Ignoring.", path)
+        return None
+    debug("# Reading sections via index %s", path)
+    return stream, entries
+
+
+def input_filetype(options):
+    """Detect the compression of a seekable input without consuming it
+
+    :returns: compression extension or None if the input is uncompressed
+    """
+    fd = options.input_stream.fileno()
+    position = os.lseek(fd, 0, os.SEEK_CUR)
+    try:
+        return compression.detect_filetype(io.open(fd, 'rb', closefd=False))
+    finally:
+        os.lseek(fd, position, os.SEEK_SET)
+
+
+def open_gzip_indexed(stream, filetype, options):
+    """Open a gzip compressed input for uncompressed reads at any offset
+
+    :returns: seekable stream of the uncompressed input or None if there is
+              no usable gzip index for the input
+    """
+    path = gzip_index_path(options)
+    if filetype != '.gz' or path is None or not os.path.exists(path):
+        return None
+    if not gzindex.available():
+        debug("# libz is not available. Ignoring gzip index %s", path)
+        return None
+    try:
+        gz_index = gzindex.read_index(path)
+    except gzindex.GzipIndexError as exc:
+        raise SieveIndexError(str(exc))
+    if not gzindex.matches(gz_index, stream):
+        debug("# Gzip index %s does not match input. Ignoring.", path)
+        return None
+    debug("# Reading compressed input via gzip index %s", path)
+    return io.BufferedReader(gzindex.GzipReader(stream, index=gz_index))
@@ -0,0 +1,315 @@
+"""
+dbsake.core.mysql.sieve.inserts
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Support for splitting and merging mysqldump extended INSERT statements
+
+mysqldump never writes parentheses outside of quoted strings in a VALUES
+list, so any "),(" that is not inside a string separates two rows.  Rows
+are located by searching for that separator and checking that the number
+of unescaped quotes before it is even, which keeps most of the work in
+C-level bytes methods rather than scanning each character in python.
+"""
+import re
+
+INSERT_PREFIXES = (b'INSERT ', b'REPLACE ')
+
+# text where every quoted string is closed
+BALANCED_CRE = re.compile(br"[^']*(?:'[^'\\]*(?:\\.[^'\\]*)*'[^']*)*\Z",
+                          re.DOTALL)
+
+# a single field of a VALUES row tuple: a number, NULL, hex literal or a
+# quoted string, with an optional charset introducer or bit-literal prefix
+FIELD_PATTERN = (br"(?:[^,')]+"
+                 br"|(?:_\w+ ?|b)?'[^'\\]*(?:(?:\\.|'')[^'\\]*)*')")
+
+
+def values_bounds(line):
+    """Locate the VALUES list of an extended INSERT
+
+    :param line: bytes line from a mysqldump tabledata section
+    :returns: (start, end) offsets of the row tuples in line, or None if
+              line is not an INSERT statement
+    """
+    if not line.startswith(INSERT_PREFIXES):
+        return None
+    idx = line.find(b' VALUES (')
+    if idx == -1:
+        return None
+    end = line.rfind(b');')
+    if end == -1:
+        return None
+    return idx + len(b' VALUES '), end + 1
+
+
+def split_insert(line):
+    """Split an extended INSERT into its prefix and row tuples
+
+    The prefix includes everything up to and including the VALUES keyword,
+    such as "INSERT INTO `t` VALUES ".  Each row tuple includes its
+    enclosing parentheses.
+
+    :param line: bytes line from a mysqldump tabledata section
+    :returns: (prefix, iterator of rows) or None if line is not an INSERT
+    """
+    bounds = values_bounds(line)
+    if bounds is None:
+        return None
+    start, end = bounds
+    return line[:start], iter_rows(line, start, end)
+
+
+def _quotes(line, start, end):
+    """Count the unescaped quotes in line[start:end]
+
+    start must not fall inside a backslash escape sequence.
+    """
+    if line.find(b'\\', start, end) == -1:
+        return line.count(b"'", start, end)
+    # drop escaped backslashes, so any remaining \' is an escaped quote
+    data = line[start:end].replace(b'\\\\', b'')
+    return data.count(b"'") - data.count(b"\\'")
+
+
+def _row_end(line, start, end):
+    """Find the end of the row tuple starting at start"""
+    segment = start
+    while True:
+        idx = line.find(b'),(', segment, end)
+        if idx == -1:
+            return end
+        if _quotes(line, start, idx) % 2 == 0:
+            return idx + 1
+        segment = idx + 3
+
+
+def _rows_end(line, start, end, max_len):
+    """Find the end of the longest run of rows from start within max_len
+
+    :returns: offset of the end of the last row that fits, or None if the
+              first row is longer than max_len
+    """
+    if max_len <= 0:
+        # a negative end offset would make rfind() count from the end of
+        # line and find separators well past the limit
+        return None
+    if end - start <= max_len:
+        return end
+    idx = line.rfind(b'),(', start, start + max_len + 2)
+    while idx != -1:
+        if _quotes(line, start, idx) % 2 == 0:
+            return idx + 1
+        idx = line.rfind(b'),(', start, idx)
+    return None
+
+
+def iter_rows(line, start, end):
+    """Iterate over the row tuples in line[start:end]"""
+    while start < end:
+        row_end = _row_end(line, start, end)
+        yield line[start:row_end]
+        start = row_end + 1
+
+
+def split_rows(line, start, end):
+    """Split the row tuples in line[start:end] into their contents
+
+    Rows are split on every "),(" in a single call and only split row by
+    row if a string contains that separator.  Without escaped quotes, that
+    is the case only if some row has an odd number of quotes.
+
+    :returns: list of row tuples, without their enclosing parentheses
+    """
+    segment = line[start + 1:end - 1]
+    rows = segment.split(b'),(')
+    if b"\\'" in segment:
+        balanced = all(map(BALANCED_CRE.match, rows))
+    else:
+        balanced = not any(row.count(b"'") & 1 for row in rows)
+    if not balanced:
+        rows = [row[1:-1] for row in iter_rows(line, start, end)]
+    return rows
+
+
+def fragment_end(data, max_len):
+    """Find where to split an INSERT line longer than max_len
+
+    :param data: bytes starting with an INSERT statement, or with the rows
+                 continuing a fragment of one
+    :param max_len: target maximum length of the fragment
+    :returns: offset just past the "," after the last row that ends within
+              max_len, or after the first row if that is longer, or None
+              if data does not contain a whole row
+    """
+    values = 0
+    if data.startswith(INSERT_PREFIXES):
+        idx = data.find(b' VALUES (')
+        if idx == -1:
+            return None
+        values = idx + len(b' VALUES ')
+    idx = data.rfind(b'),(', values, max_len)
+    while idx != -1:
+        if _quotes(data, values, idx) % 2 == 0:
+            return idx + 2
+        idx = data.rfind(b'),(', values, idx)
+    end = _row_end(data, values, len(data))
+    if end == len(data):
+        return None
+    return end + 1
+
+
+class Fragments(object):
+    """Rewrite the fragments of long INSERT lines as whole statements
+
+    A line split into fragments by parser.BlockLineReader is rewritten
+    into one INSERT per fragment, using the line's prefix, so code that
+    parses rows only ever holds a fragment in memory.  Any other line is
+    returned unchanged.
+    """
+    def __init__(self):
+        # INSERT prefix of a line whose next fragment is still to come
+        self.prefix = None
+
+    def __call__(self, line):
+        prefix = self.prefix
+        if prefix is None:
+            if not line.endswith(b',') or \
+                    not line.startswith(INSERT_PREFIXES):
+                return line
+            idx = line.find(b' VALUES (')
+            if idx == -1:
+                return line
+            self.prefix = line[:idx + len(b' VALUES ')]
+            return line[:-1] + b';\n'
+        if line.endswith(b'\n'):
+            self.prefix = None
+            return prefix + line
+        return prefix + line[:-1] + b';\n'
+
+
+def whole_statements(lines):
+    """Iterate over lines with fragments rewritten by Fragments"""
+    complete = Fragments()
+    for line in lines:
+        yield complete(line)
+
+
+def row_pattern(positions):
+    """Build a regex matching a whole VALUES row tuple
+
+    The fields at positions are captured, so each row is found and split
+    by a single regex match.
+
+    :param positions: sorted sequence of 0-based field positions to capture
+    :returns: compiled regex object
+    """
+    fields = []
+    for pos in range(positions[-1] + 1):
+        if pos in positions:
+            fields.append(b'(' + FIELD_PATTERN + b')')
+        else:
+            fields.append(FIELD_PATTERN)
+    return re.compile(br'\(' + b','.join(fields) +
+                      br'(?:,' + FIELD_PATTERN + br')*\)', re.DOTALL)
+
+
+def match_rows(row_cre, line, start, end):
+    """Match each row tuple in line[start:end] with a row_pattern() regex
+
+    :raises: ValueError if a row could not be matched
+    :returns: iterator of match objects
+    """
+    for match in row_cre.finditer(line, start, end):
+        if match.start() != start:
+            break
+        yield match
+        start = match.end() + 1
+    if start != end + 1:
+        raise ValueError("Failed to parse row at offset %d" % start)
+
+
+def _rebatch_rows(lines, max_bytes, max_rows):
+    prefix = None
+    rows = []
+    size = 0
+    for line in lines:
+        insert = split_insert(line)
+        if insert is None:
+            if rows:
+                yield prefix + b','.join(rows) + b';\n'
+                rows = []
+            yield line
+            continue
+        if insert[0] != prefix and rows:
+            yield prefix + b','.join(rows) + b';\n'
+            rows = []
+        prefix = insert[0]
+        for row in insert[1]:
+            if rows and (len(rows) >= max_rows or
+                         (max_bytes and size + len(row) + 1 > max_bytes)):
+                yield prefix + b','.join(rows) + b';\n'
+                rows = []
+            if not rows:
+                # prefix + ";\n", less the "," counted for each row
+                size = len(prefix) + 1
+            rows.append(row)
+            size += len(row) + 1
+    if rows:
+        yield prefix + b','.join(rows) + b';\n'
+
+
+def _rebatch_bytes(lines, max_bytes):
+    # runs of rows are copied in one slice rather than row by row
+    prefix = None
+    parts = []
+    size = 0
+    for line in lines:
+        bounds = values_bounds(line)
+        if bounds is None:
+            if parts:
+                yield prefix + b','.join(parts) + b';\n'
+                parts = []
+            yield line
+            continue
+        start, end = bounds
+        if parts and line[:start] != prefix:
+            yield prefix + b','.join(parts) + b';\n'
+            parts = []
+        prefix = line[:start]
+        while start < end:
+            if not parts:
+                # prefix + ";\n", less the "," counted for each part
+                size = len(prefix) + 1
+            stop = _rows_end(line, start, end, max_bytes - size - 1)
+            if stop is None:
+                if parts:
+                    yield prefix + b','.join(parts) + b';\n'
+                    parts = []
+                    continue
+                # a single row larger than max_bytes
+                stop = _row_end(line, start, end)
+            parts.append(line[start:stop])
+            size += stop - start + 1
+            start = stop + 1
+    if parts:
+        yield prefix + b','.join(parts) + b';\n'
+
+
+def rebatch(lines, max_bytes=None, max_rows=None):
+    """Rewrite INSERT statements into batches of a target size
+
+    Consecutive INSERT statements for the same table are merged and
+    oversized statements are split, so that each INSERT written is at most
+    max_bytes long and has at most max_rows rows.  A single row larger than
+    max_bytes is written as its own statement.  Any other lines are passed
+    through unchanged.
+
+    :param lines: iterable of bytes lines from a tabledata section
+    :param max_bytes: target maximum length of each INSERT statement
+    :param max_rows: maximum number of rows per INSERT statement
+    :returns: iterator of bytes lines
+    """
+    lines = whole_statements(lines)
+    if max_rows:
+        return _rebatch_rows(lines, max_bytes, max_rows)
+    return _rebatch_bytes(lines, max_bytes)
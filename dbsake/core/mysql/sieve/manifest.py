@@ -0,0 +1,112 @@
+"""
+dbsake.core.mysql.sieve.manifest
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+List the objects in a mysqldump file for restore planning
+
+A manifest records the type, database, table, uncompressed input offset
+and size of every section in a dump.  Table data sections also record an
+estimated row count, counted from the row separators in each INSERT
+statement, which only overcounts rows whose strings contain "),(".
+"""
+from __future__ import unicode_literals
+
+import collections
+import json
+
+from . import inserts
+
+
+Entry = collections.namedtuple('Entry',
+                               'offset length name database table rows')
+
+
+def estimate_rows(lines):
+    """Estimate the number of rows in the INSERT statements of lines"""
+    rows = 0
+    # whether line continues a fragmented INSERT (see parser.BlockLineReader)
+    continued = False
+    for line in lines:
+        if continued or line.startswith(inserts.INSERT_PREFIXES):
+            rows += line.count(b'),(') + 1
+            continued = not line.endswith(b'\n')
+    return rows
+
+
+def build(dump_parser):
+    """Consume a DumpParser, recording each section's location and size
+
+    :returns: list of Entry instances
+    """
+    entries = []
+    for section in dump_parser:
+        offset = dump_parser.offset
+        rows = None
+        if section.name == 'tabledata':
+            rows = estimate_rows(section.iterable)
+        else:
+            section.flush()
+        entries.append(Entry(offset,
+                             dump_parser.offset - offset,
+                             section.name,
+                             section.database,
+                             section.table,
+                             rows))
+    return entries
+
+
+def as_dict(entries, name=None):
+    """Format manifest entries as a dict suitable for JSON output
+
+    Entries are listed in input order as "objects", and the sections of
+    each table are also summed under "tables".
+    """
+    def decode(value):
+        if value is None:
+            return None
+        return value.decode('utf8', 'replace')
+
+    objects = []
+    tables = collections.OrderedDict()
+    for entry in entries:
+        item = collections.OrderedDict([
+            ('type', entry.name),
+            ('database', decode(entry.database)),
+            ('table', decode(entry.table)),
+            ('offset', entry.offset),
+            ('bytes', entry.length),
+        ])
+        if entry.rows is not None:
+            item['rows'] = entry.rows
+        objects.append(item)
+        if entry.table is None or entry.name not in ('tablestructure',
+                                                     'tabledata',
+                                                     'triggers'):
+            continue
+        key = (entry.database, entry.table)
+        if key not in tables:
+            tables[key] = collections.OrderedDict([
+                ('database', decode(entry.database)),
+                ('table', decode(entry.table)),
+                ('bytes', 0),
+                ('data_bytes', 0),
+                ('rows', 0),
+            ])
+        tables[key]['bytes'] += entry.length
+        if entry.name == 'tabledata':
+            tables[key]['data_bytes'] += entry.length
+            tables[key]['rows'] += entry.rows
+
+    size = 0
+    if entries:
+        size = entries[-1].offset + entries[-1].length
+    return collections.OrderedDict([
+        ('input', name),
+        ('bytes', size),
+        ('objects', objects),
+        ('tables', list(tables.values())),
+    ])
+
+
+def to_json(entries, name=None):
+    return json.dumps(as_dict(entries, name), indent=2)
@@ -0,0 +1,470 @@
+"""
+dbsake.core.mysql.sieve.mydumper
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Read a mydumper backup directory as mysqldump sections
+
+mydumper writes one file per object, possibly compressed:
+
+    - <db>-schema-create.sql: CREATE DATABASE
+    - <db>.<table>-schema.sql: CREATE TABLE, or a view's placeholder table
+    - <db>.<table>.sql, <db>.<table>.<nnnnn>.sql: table data
+    - <db>.<table>-schema-triggers.sql: triggers
+    - <db>.<view>-schema-view.sql: CREATE VIEW
+    - <db>-schema-post.sql: routines and events
+
+A DirectoryReader turns these into the same sections DumpParser yields
+for a mysqldump file, in the order mysqldump would write them, so the
+usual filters, transforms and writers apply.  mydumper writes each row
+of an INSERT on its own line; these are joined into one extended INSERT
+per line, as mysqldump writes them.
+
+Table data files may be decompressed and reformatted by a pool of worker
+processes ahead of the sections being read.  Workers spool their output
+to temporary files, which are read back and removed in order.
+"""
+from __future__ import unicode_literals
+
+import collections
+import io
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+
+from dbsake.util import compression
+
+from . import exc
+from . import parser
+
+debug = logging.debug
+
+FILENAME_CRE = re.compile(r'^(?P<database>[^.]+?)(?:\.(?P<table>.+?))?'
+                          r'(?P<kind>-schema-create|-schema-post|'
+                          r'-schema-triggers|-schema-view|-schema)?'
+                          r'(?:\.(?P<chunk>\d+))?\.sql(?:\.\w+)?$')
+
+# mydumper writes table data with the client character set 'binary'
+HEADER = [
+    b'-- MySQL dump 10.13  Distrib 5.5, converted from mydumper\n',
+    b'--\n',
+    b'-- Host: localhost    Database: \n',
+    b'-- ------------------------------------------------------\n',
+    b'-- Server version\t5.5\n',
+    b'\n',
+    b'/*!40101 SET @OLD_CHARACTER_SET_CLIENT=@@CHARACTER_SET_CLIENT */;\n',
+    b'/*!40101 SET @OLD_CHARACTER_SET_RESULTS=@@CHARACTER_SET_RESULTS */;\n',
+    b'/*!40101 SET @OLD_COLLATION_CONNECTION=@@COLLATION_CONNECTION */;\n',
+    b'/*!40101 SET NAMES binary */;\n',
+    b'/*!40103 SET @OLD_TIME_ZONE=@@TIME_ZONE */;\n',
+    b"/*!40103 SET TIME_ZONE='+00:00' */;\n",
+    b'/*!40014 SET @OLD_UNIQUE_CHECKS=@@UNIQUE_CHECKS, UNIQUE_CHECKS=0 */;\n',
+    b'/*!40014 SET @OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, '
+    b'FOREIGN_KEY_CHECKS=0 */;\n',
+    b"/*!40101 SET @OLD_SQL_MODE=@@SQL_MODE, "
+    b"SQL_MODE='NO_AUTO_VALUE_ON_ZERO' */;\n",
+    b'/*!40111 SET @OLD_SQL_NOTES=@@SQL_NOTES, SQL_NOTES=0 */;\n',
+    b'\n',
+]
+
+FOOTER = [
+    b'/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;\n',
+    b'\n',
+    b'/*!40101 SET SQL_MODE=@OLD_SQL_MODE */;\n',
+    b'/*!40014 SET FOREIGN_KEY_CHECKS=@OLD_FOREIGN_KEY_CHECKS */;\n',
+    b'/*!40014 SET UNIQUE_CHECKS=@OLD_UNIQUE_CHECKS */;\n',
+    b'/*!40101 SET CHARACTER_SET_CLIENT=@OLD_CHARACTER_SET_CLIENT */;\n',
+    b'/*!40101 SET CHARACTER_SET_RESULTS=@OLD_CHARACTER_SET_RESULTS */;\n',
+    b'/*!40101 SET COLLATION_CONNECTION=@OLD_COLLATION_CONNECTION */;\n',
+    b'/*!40111 SET SQL_NOTES=@OLD_SQL_NOTES */;\n',
+    b'\n',
+]
+
+# mysqldump brackets triggers with statements saving the session, which
+# is also how its triggers sections are recognized
+TRIGGERS_HEADER = [
+    b'/*!50003 SET @saved_cs_client      = @@character_set_client */ ;\n',
+    b'/*!50003 SET @saved_sql_mode       = @@sql_mode */ ;\n',
+]
+
+TRIGGERS_FOOTER = [
+    b'/*!50003 SET sql_mode              = @saved_sql_mode */ ;\n',
+    b'/*!50003 SET character_set_client  = @saved_cs_client */ ;\n',
+]
+
+
+class MydumperError(exc.SieveError):
+    """Error raised when a mydumper directory cannot be read"""
+
+
+def quote(name):
+    return b'`' + name.replace(b'`', b'``') + b'`'
+
+
+def comment(text):
+    """mysqldump's three line comment preceding each section"""
+    return [b'--\n', b'-- ' + text + b'\n', b'--\n']
+
+
+def read_lines(path):
+    """Yield the lines of a possibly compressed file"""
+    with io.open(path, 'rb') as fileobj:
+        with compression.decompressed(fileobj) as stream:
+            for line in stream:
+                yield line
+
+
+def strip_preamble(lines):
+    """Skip the session settings and blank lines starting a mydumper file
+
+    The dump header already sets these for the whole output.
+    """
+    lines = iter(lines)
+    for line in lines:
+        if line.startswith(b'/*!40') or not line.strip():
+            continue
+        yield line
+        break
+    for line in lines:
+        yield line
+
+
+def join_inserts(lines):
+    """Join mydumper's one row per line INSERTs into extended INSERTs
+
+    mydumper writes "INSERT INTO `t` VALUES" followed by one row tuple
+    per line.  Each statement is yielded as a single line in the format
+    mysqldump uses: "INSERT INTO `t` VALUES (...),(...);".  Any other
+    line is passed through.
+    """
+    statement = None
+    for line in lines:
+        if statement is None:
+            if not line.startswith((b'INSERT ', b'REPLACE ')) or \
+                    line.endswith(b';\n'):
+                yield line.replace(b' VALUES(', b' VALUES (', 1)
+                continue
+            line = line.rstrip(b'\r\n')
+            if line.endswith(b' VALUES'):
+                line += b' '
+            else:
+                line = line.replace(b' VALUES(', b' VALUES (', 1)
+            statement = [line]
+        elif line.endswith(b';\n'):
+            statement.append(line)
+            yield b''.join(statement)
+            statement = None
+        else:
+            statement.append(line.rstrip(b'\r\n'))
+    if statement is not None:
+        raise MydumperError("Unterminated INSERT statement: %r..." %
+                            statement[0][:80])
+
+
+def data_lines(path):
+    """Yield the INSERT statements of a mydumper table data file"""
+    return join_inserts(strip_preamble(read_lines(path)))
+
+
+def spool_data(path, spool_path):
+    """Write the INSERT statements of a data file to spool_path
+
+    This runs in a worker process.
+
+    :returns: spool_path
+    """
+    with io.open(spool_path, 'wb') as fileobj:
+        fileobj.writelines(data_lines(path))
+    return spool_path
+
+
+class Table(object):
+    """Files of a single mydumper table or view"""
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.schema = None
+        self.view = None
+        self.triggers = None
+        # (chunk number, path) of each data file
+        self.data = []
+
+    @property
+    def is_view(self):
+        return self.view is not None
+
+
+class Database(object):
+    """Files of a single mydumper database"""
+    def __init__(self, name):
+        self.name = name
+        self.create = None
+        self.post = None
+        self.tables = {}
+
+    def table(self, name):
+        if name not in self.tables:
+            self.tables[name] = Table(self.name, name)
+        return self.tables[name]
+
+    def sorted_tables(self):
+        return [self.tables[name] for name in sorted(self.tables)]
+
+
+def scan(path):
+    """Group the files of a mydumper directory by database and table
+
+    :returns: list of Database instances, sorted by name
+    """
+    databases = {}
+    for filename in sorted(os.listdir(path)):
+        match = FILENAME_CRE.match(filename)
+        if not match:
+            continue
+        full_path = os.path.join(path, filename)
+        name = match.group('database').encode('utf8')
+        database = databases.setdefault(name, Database(name))
+        kind = match.group('kind')
+        table = match.group('table')
+        if table is None:
+            if kind == '-schema-create':
+                database.create = full_path
+            elif kind == '-schema-post':
+                database.post = full_path
+            continue
+        table = database.table(table.encode('utf8'))
+        if kind == '-schema':
+            table.schema = full_path
+        elif kind == '-schema-view':
+            table.view = full_path
+        elif kind == '-schema-triggers':
+            table.triggers = full_path
+        elif kind is None:
+            table.data.append((int(match.group('chunk') or -1), full_path))
+    for database in databases.values():
+        for table in database.tables.values():
+            table.data.sort()
+    return [databases[name] for name in sorted(databases)]
+
+
+class Prefetcher(object):
+    """Convert table data files in a process pool ahead of their use
+
+    Files are submitted in the order they will be read, keeping at most
+    ``depth`` converted files waiting on disk.
+    """
+    def __init__(self, jobs, depth=None):
+        self.pool = multiprocessing.Pool(jobs)
+        self.depth = depth or jobs*2
+        self.spool_dir = tempfile.mkdtemp(prefix='dbsake-mydumper-')
+        self.paths = collections.deque()
+        self.pending = collections.deque()
+        self.count = 0
+
+    def add(self, path):
+        """Queue a data file to be converted, in the order it will be read"""
+        self.paths.append(path)
+
+    def _submit(self):
+        while self.paths and len(self.pending) < self.depth:
+            path = self.paths.popleft()
+            self.count += 1
+            spool_path = os.path.join(self.spool_dir,
+                                      '%08d.sql' % self.count)
+            result = self.pool.apply_async(spool_data, (path, spool_path))
+            self.pending.append((path, result))
+
+    def lines(self, path):
+        """Yield the converted lines of a queued data file
+
+        Files queued before path that were never read are discarded.
+        """
+        while True:
+            self._submit()
+            if not self.pending:
+                raise MydumperError("%s was not queued for conversion" %
+                                    path)
+            queued_path, result = self.pending.popleft()
+            spool_path = result.get()
+            if queued_path == path:
+                break
+            os.unlink(spool_path)
+        self._submit()
+        try:
+            with io.open(spool_path, 'rb') as fileobj:
+                for line in fileobj:
+                    yield line
+        finally:
+            os.unlink(spool_path)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+
+class DirectoryReader(object):
+    """Iterate over a mydumper directory as mysqldump sections
+
+    :param path: mydumper output directory
+    :param jobs: number of processes converting table data ahead of use;
+                 with 1 data files are converted as they are read
+    :param filter_section: optional callable returning True for sections
+                           that will be skipped, whose data files are
+                           then never converted
+    """
+    def __init__(self, path, jobs=1, filter_section=None):
+        if not os.path.isdir(path):
+            raise MydumperError("%s is not a directory" % path)
+        self.databases = scan(path)
+        if not self.databases:
+            raise MydumperError("No mydumper files found in %s" % path)
+        self.prefetcher = None
+        if jobs > 1:
+            self.prefetcher = Prefetcher(jobs)
+        self.sections = self.plan()
+        for section in self.sections:
+            if filter_section is not None and filter_section(section):
+                continue
+            if section.name == 'tabledata' and self.prefetcher:
+                for path in section.paths:
+                    self.prefetcher.add(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+
+    def section(self, name, database, table, iterable, paths=()):
+        section = parser.Section()
+        section.name = name
+        section.database = database
+        section.table = table
+        section.iterable = section.source = iterable
+        # sections that are never read do not need their files opened
+        section.skip = _noop
+        section.paths = paths
+        return section
+
+    def file_lines(self, path, preamble, postamble=()):
+        for line in preamble:
+            yield line
+        for line in strip_preamble(read_lines(path)):
+            yield line
+        for line in postamble:
+            yield line
+        yield b'\n'
+
+    def table_data(self, table):
+        name = quote(table.name)
+        for line in comment(b'Dumping data for table ' + name):
+            yield line
+        yield b'\n'
+        yield b'/*!40000 ALTER TABLE ' + name + b' DISABLE KEYS */;\n'
+        for _, path in table.data:
+            if self.prefetcher is not None:
+                lines = self.prefetcher.lines(path)
+            else:
+                lines = data_lines(path)
+            for line in lines:
+                yield line
+        yield b'/*!40000 ALTER TABLE ' + name + b' ENABLE KEYS */;\n'
+        yield b'\n'
+
+    def create_database(self, database, create=True):
+        for line in comment(b'Current Database: ' + quote(database.name)):
+            yield line
+        yield b'\n'
+        if create and database.create:
+            for line in strip_preamble(read_lines(database.create)):
+                yield line
+            yield b'\n'
+        yield b'USE ' + quote(database.name) + b';\n'
+        yield b'\n'
+
+    def plan(self):
+        """Build the sections of the dump, in mysqldump order"""
+        sections = [self.section('header', None, None, iter(HEADER))]
+        views = []
+        for database in self.databases:
+            db = database.name
+            sections.append(
+                self.section('createdatabase', db, None,
+                             self.create_database(database))
+            )
+            tables = database.sorted_tables()
+            for table in tables:
+                name = quote(table.name)
+                if table.is_view:
+                    views.append(table)
+                    if table.schema:
+                        preamble = comment(
+                            b'Temporary table structure for view ' + name
+                        ) + [b'\n']
+                        sections.append(self.section(
+                            'view_temporary', db, table.name,
+                            self.file_lines(table.schema, preamble)
+                        ))
+                    continue
+                if table.schema:
+                    preamble = comment(b'Table structure for table ' +
+                                       name) + [b'\n']
+                    sections.append(self.section(
+                        'tablestructure', db, table.name,
+                        self.file_lines(table.schema, preamble)
+                    ))
+                if table.data:
+                    sections.append(self.section(
+                        'tabledata', db, table.name,
+                        self.table_data(table),
+                        paths=[path for _, path in table.data]
+                    ))
+                if table.triggers:
+                    sections.append(self.section(
+                        'triggers', db, table.name,
+                        self.file_lines(table.triggers,
+                                        TRIGGERS_HEADER, TRIGGERS_FOOTER)
+                    ))
+            if database.post:
+                preamble = comment(b"Dumping routines for database '" +
+                                   db + b"'")
+                sections.append(self.section(
+                    'routines', db, None,
+                    self.file_lines(database.post, preamble)
+                ))
+        databases = collections.OrderedDict()
+        for view in views:
+            databases.setdefault(view.database, []).append(view)
+        for db, db_views in databases.items():
+            sections.append(
+                self.section('createdatabase', db, None,
+                             self.create_database(Database(db),
+                                                  create=False))
+            )
+            for view in db_views:
+                preamble = comment(b'Final view structure for view ' +
+                                   quote(view.name)) + [b'\n']
+                sections.append(self.section(
+                    'view', db, view.name,
+                    self.file_lines(view.view, preamble)
+                ))
+        sections.append(self.section('footer', None, None, iter(FOOTER)))
+        return sections
+
+    def __iter__(self):
+        for section in self.sections:
+            yield section
+            # release the plan's reference to the section's lines
+            section.iterable = ()
+
+
+def _noop():
+    pass
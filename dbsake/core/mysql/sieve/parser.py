@@ -10,10 +10,13 @@ related section as an iterable, while minimizing memory utilization.
 from __future__ import unicode_literals
 
 import collections
+import inspect
+import io
 import logging
 import re
 
 from . import exc
+from . import inserts
 
 try:
     _range = xrange
@@ -24,6 +27,9 @@ debug = logging.debug
 
 IDENTIFIER = re.compile(br'''.*?([`'])(?P<ident>.*)\1$''')
 
+# longest INSERT line read whole; longer lines are read in fragments
+MAX_LINE_SIZE = 64*1024*1024
+
 
 class SieveParseError(exc.SieveError):
     """Error raised when parsing fails"""
@@ -80,14 +86,52 @@ def discriminate(value):
     return extra
 
 
+def _unstarted(iterable):
+    """Check whether a section generator has not produced any lines yet"""
+    frame = getattr(iterable, 'gi_frame', None)
+    if frame is None:
+        return False
+    try:
+        return inspect.getgeneratorstate(iterable) == inspect.GEN_CREATED
+    except AttributeError:
+        # python 2.x
+        return frame.f_lasti == -1
+
+
 class Section(object):
     def __init__(self):
         self.name = None
         self.database = None
         self.table = None
         self.iterable = ()
+        # optional method to discard an unread section in bulk
+        self.skip = None
+        # optional method to write an unread section's raw input in bulk
+        self.copy = None
+        # iterable as created by the parser, before any transform
+        self.source = ()
+
+    def passthrough(self, write):
+        """Write an untransformed section's input with write() in bulk
+
+        This only applies if the parser supports copying the section and
+        its iterable has not been replaced or started.  Otherwise nothing
+        is written and the caller should iterate over the section's lines.
+
+        :returns: True if the section was written
+        """
+        if self.copy is None or self.iterable is not self.source or \
+                not _unstarted(self.iterable):
+            return False
+        self.copy(write)
+        self.iterable = ()
+        return True
 
     def flush(self):
+        if self.skip is not None and _unstarted(self.iterable):
+            self.skip()
+            self.iterable = ()
+            return
         for line in self.iterable:
             pass
 
@@ -98,6 +142,7 @@ class LineReader(object):
         self.stream = stream
         self._cache = collections.deque()
         self.line_no = 0
+        self.offset = 0
 
     def __iter__(self):
         return self
@@ -108,6 +153,7 @@ class LineReader(object):
         else:
             line = next(self.stream)
         self.line_no += 1
+        self.offset += len(line)
         return line
     # python 2.x shim
     next = __next__
@@ -115,6 +161,29 @@ class LineReader(object):
     def pushback(self, value):
         self._cache.append(value)
         self.line_no -= 1
+        self.offset -= len(value)
+
+    def skip_to(self, prefixes):
+        """Discard lines until one starts with one of prefixes
+
+        The matching line is left to be read next.  If no line matches,
+        the remainder of the stream is discarded.
+        """
+        for line in self:
+            if line.startswith(prefixes):
+                self.pushback(line)
+                break
+
+    def copy_to(self, prefixes, write):
+        """Pass lines to write() until one starts with one of prefixes
+
+        The matching line is left to be read next, as with skip_to().
+        """
+        for line in self:
+            if line.startswith(prefixes):
+                self.pushback(line)
+                break
+            write(line)
 
     def expect_prefix(self, prefix):
         line = next(self)
@@ -142,10 +211,228 @@ class LineReader(object):
         return self.stream.closed
 
 
+class BlockLineReader(LineReader):
+    """LineReader that pulls lines from its stream a block at a time
+
+    Rather than calling next(stream) for every line, this reads a block of
+    ``block_size`` bytes, completes its last line and splits the block
+    into a batch of lines, so handing out a line is a step of a list
+    iterator.  The ``line_no`` and ``offset`` positions are computed on
+    demand from the position in the current batch rather than updated for
+    every line.
+
+    An INSERT line longer than ``max_line_size`` is not read whole, but
+    handed out as fragments of about that size, each split after a row:
+    every fragment but the last ends with "," rather than a newline and
+    each following fragment starts with the "(" of a row.  A single row
+    longer than ``max_line_size`` is kept whole.  Blocks are no larger
+    than ``max_line_size`` either, so a batch never holds a longer line.
+    """
+    block_size = 256*1024
+    max_line_size = MAX_LINE_SIZE
+
+    def __init__(self, stream, block_size=None, max_line_size=None):
+        self.stream = stream
+        if block_size is not None:
+            self.block_size = block_size
+        if max_line_size is not None:
+            self.max_line_size = max_line_size
+        # rest of a line split into fragments, not yet handed out
+        self._carry = b''
+        self._cache = collections.deque()
+        self._lines = []
+        self._iter = iter(self._lines)
+        self._base_line_no = 0
+        self._base_offset = 0
+
+    def __next__(self):
+        if self._cache:
+            return self._cache.popleft()
+        try:
+            return next(self._iter)
+        except StopIteration:
+            self._fill()
+            return next(self._iter)
+    # python 2.x shim
+    next = __next__
+
+    def _fill(self):
+        self._base_line_no += len(self._lines)
+        self._base_offset += sum(map(len, self._lines))
+        continued = bool(self._carry)
+        lines = io.BytesIO(
+            self._read(min(self.block_size, self.max_line_size))
+        ).readlines()
+        if lines and not lines[-1].endswith(b'\n'):
+            lines[-1] = self._complete(lines[-1],
+                                       continued and len(lines) == 1)
+        self._lines = lines
+        self._iter = iter(self._lines)
+
+    def _read(self, size):
+        """Read a block, starting with the rest of a fragmented line"""
+        if self._carry:
+            data, self._carry = self._carry, b''
+            return data
+        return self.stream.read(size)
+
+    def _complete(self, line, continued=False):
+        """Read the rest of a partial line
+
+        If the line is an INSERT longer than max_line_size, only a fragment
+        is read and the part after its last row is kept for the next read.
+
+        :param continued: whether line is the rest of a fragmented line
+        """
+        # read enough of the line to recognize an INSERT prefix
+        line += self.stream.readline(max(self.max_line_size - len(line), 16))
+        if line.endswith(b'\n'):
+            return line
+        if not continued and not line.startswith(inserts.INSERT_PREFIXES):
+            return line + self.stream.readline()
+        while not line.endswith(b'\n'):
+            end = inserts.fragment_end(line, self.max_line_size)
+            if end is not None:
+                self._carry = line[end:]
+                return line[:end]
+            more = self.stream.readline(self.max_line_size)
+            if not more:
+                break
+            line += more
+        return line
+
+    def pushback(self, value):
+        self._cache.append(value)
+
+    def skip_to(self, prefixes):
+        """Discard lines until one starts with one of prefixes
+
+        Once the current batch of lines is exhausted, this reads raw blocks
+        from the stream and searches them for a newline followed by one of
+        prefixes, so skipped data is never split into lines.
+        """
+        while self._cache:
+            if self._cache[0].startswith(prefixes):
+                return
+            self._cache.popleft()
+        for line in self._iter:
+            if line.startswith(prefixes):
+                self._cache.append(line)
+                return
+        self._skip_raw(prefixes)
+
+    def copy_to(self, prefixes, write):
+        """Pass lines to write() until one starts with one of prefixes
+
+        As with skip_to(), once the current batch of lines is exhausted
+        the stream is read in raw blocks, which are passed to write() as
+        memoryview slices rather than split into lines.
+        """
+        while self._cache:
+            if self._cache[0].startswith(prefixes):
+                return
+            write(self._cache.popleft())
+        for line in self._iter:
+            if line.startswith(prefixes):
+                self._cache.append(line)
+                return
+            write(line)
+        self._skip_raw(prefixes, write)
+
+    def _skip_raw(self, prefixes, write=None):
+        self._base_line_no += len(self._lines)
+        self._base_offset += sum(map(len, self._lines))
+        self._lines = []
+        self._iter = iter(self._lines)
+        pattern = re.compile(b'\n(?:' +
+                             b'|'.join(re.escape(p) for p in prefixes) +
+                             b')')
+        overlap = max(len(prefix) for prefix in prefixes) + 1
+        # the last batch ended in a newline, so the first block starts a line
+        lead = b'\n'
+        # end of the previous block(s), not yet passed, where a match
+        # spanning into the next block may start
+        held = b''
+        while True:
+            data = self._read(self.block_size)
+            if not data:
+                self._pass(held, len(held), write)
+                return
+            # check for a match starting before this block first
+            match = pattern.search(lead + held + data[:overlap])
+            if match and match.start() < len(lead) + len(held):
+                start = match.start() + 1 - len(lead)
+                break
+            match = pattern.search(data)
+            if match:
+                start = len(held) + match.start() + 1
+                break
+            if len(data) > overlap:
+                self._pass(held, len(held), write)
+                self._pass(data, len(data) - overlap, write)
+                held = data[-overlap:]
+            else:
+                held += data
+                end = max(len(held) - overlap, 0)
+                self._pass(held, end, write)
+                held = held[end:]
+            lead = b''
+
+        if start <= len(held):
+            self._pass(held, start, write)
+            remainder = held[start:] + data
+        else:
+            self._pass(held, len(held), write)
+            self._pass(data, start - len(held), write)
+            remainder = data[start - len(held):]
+        lines = io.BytesIO(remainder).readlines()
+        if lines and not lines[-1].endswith(b'\n'):
+            lines[-1] = self._complete(lines[-1])
+        self._lines = lines
+        self._iter = iter(self._lines)
+
+    def _pass(self, data, end, write):
+        """Account for data[:end] as read, passing it to write() if given"""
+        self._base_offset += end
+        self._base_line_no += data.count(b'\n', 0, end)
+        if write is not None and end:
+            write(memoryview(data)[:end])
+
+    @property
+    def _pos(self):
+        return len(self._lines) - self._iter.__length_hint__()
+
+    @property
+    def line_no(self):
+        return self._base_line_no + self._pos - len(self._cache)
+
+    @property
+    def offset(self):
+        return (self._base_offset +
+                sum(map(len, self._lines[:self._pos])) -
+                sum(map(len, self._cache)))
+
+
+def line_reader(stream, max_line_size=None):
+    """Create the most efficient LineReader supported by stream"""
+    if hasattr(stream, 'readlines'):
+        return BlockLineReader(stream, max_line_size=max_line_size)
+    return LineReader(stream)
+
+
 class DumpParser(object):
-    def __init__(self, stream):
+    def __init__(self, stream, max_line_size=None):
         self.section = Section()
-        self._stream = LineReader(stream)
+        self._stream = line_reader(stream, max_line_size)
+
+    @property
+    def offset(self):
+        """Byte offset in the input of the next unread line"""
+        return self._stream.offset
+
+    def section_reader(self, name):
+        """Find the method that reads the body of a section type"""
+        return getattr(self, 'read_section_' + name, self.read_section)
 
     def read_section_header(self):
         yield self._stream.expect_prefix(b'-- MySQL dump')
@@ -215,6 +502,48 @@ class DumpParser(object):
             if line.startswith(b'\n'):
                 break
 
+    def skip_section_tabledata(self):
+        """Discard a tabledata section without yielding each line
+
+        This consumes the same input as read_section_tabledata(), but the
+        table data itself is passed over with LineReader.skip_to()
+        """
+        self._stream.expect(b'--')
+        self._stream.expect_prefix(b'-- ')
+        self._stream.expect(b'--')
+        self._stream.expect_blank()
+        while True:
+            self._stream.skip_to((b'\n', b'/*!'))
+            line = next(self._stream, None)
+            if line is None or not line.startswith(b'/*!'):
+                break
+            if not line.startswith(b'/*!40000 ALTER'):
+                self._stream.pushback(line)
+                break
+
+    def copy_section_tabledata(self, write):
+        """Pass a tabledata section's input to write() in bulk
+
+        This consumes the same input as read_section_tabledata(), but the
+        table data itself is copied with LineReader.copy_to()
+        """
+        write(self._stream.expect(b'--'))
+        write(self._stream.expect_prefix(b'-- '))
+        write(self._stream.expect(b'--'))
+        write(self._stream.expect_blank())
+        while True:
+            self._stream.copy_to((b'\n', b'/*!'), write)
+            line = next(self._stream, None)
+            if line is None:
+                break
+            if line.startswith(b'/*!') and \
+                    not line.startswith(b'/*!40000 ALTER'):
+                self._stream.pushback(line)
+                break
+            write(line)
+            if not line.startswith(b'/*!'):
+                break
+
     def discriminate_next(self):
         pending = []
         line = None
@@ -241,9 +570,18 @@ class DumpParser(object):
         section = self.section
 
         while not self._stream.closed:
-            discriminator = self.discriminate_next()
-            iterable = getattr(self,
-                               'read_section_' + discriminator['name'],
-                               self.read_section)
-            self.section.__dict__.update(discriminator, iterable=iterable())
+            try:
+                discriminator = self.discriminate_next()
+            except StopIteration:
+                # end of input
+                break
+            name = discriminator['name']
+            iterable = self.section_reader(name)()
+            skip = getattr(self, 'skip_section_' + name, None)
+            copy = getattr(self, 'copy_section_' + name, None)
+            self.section.__dict__.update(discriminator,
+                                         iterable=iterable,
+                                         source=iterable,
+                                         skip=skip,
+                                         copy=copy)
             yield section
@@ -0,0 +1,244 @@
+"""
+dbsake.core.mysql.sieve.pipeline
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Staged execution of sieve with bounded queues between stages
+
+By default sieve parses, transforms and writes each section in a single
+thread.  A Pipeline instead runs parsing (including section filtering and
+reading the decompressed input) and transformation in their own threads,
+handing batches of lines to the next stage through bounded queues, while
+the caller's thread writes the output.  A stage that falls behind blocks
+the stages feeding it once its queue is full.
+
+Any exception raised by a stage stops all of the stages and is re-raised
+in the caller's thread when the pipeline is closed.
+"""
+from __future__ import unicode_literals
+
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from . import parser
+
+debug = logging.debug
+
+# bytes of lines handed between stages at once
+BATCH_BYTES = 256*1024
+# batches buffered between two stages
+DEPTH = 16
+# seconds between checks for a stopped pipeline while blocked on a queue
+POLL_INTERVAL = 0.1
+
+
+class Cancelled(Exception):
+    """Raised in a stage blocked on a queue when the pipeline is stopped"""
+
+
+class Channel(object):
+    """Bounded queue of messages between two pipeline stages
+
+    Messages are (kind, value) tuples, where kind is one of:
+
+        - 'section': value is the (name, database, table) of a new section
+        - 'lines': value is a list of the section's lines
+        - 'end': value is any DDL held back for a post-load phase
+        - 'done': no more sections follow
+    """
+    def __init__(self, depth, stop):
+        self.queue = queue.Queue(depth)
+        self.stop = stop
+
+    def put(self, kind, value=None):
+        while not self.stop.is_set():
+            try:
+                self.queue.put((kind, value), timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
+        raise Cancelled()
+
+    def get(self):
+        while not self.stop.is_set():
+            try:
+                return self.queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+        raise Cancelled()
+
+    def send_section(self, section, batch_bytes, post_load=None):
+        """Send all lines of section, followed by its end marker"""
+        self.put('section', (section.name, section.database, section.table))
+        batch = []
+        size = 0
+        for line in section.iterable:
+            batch.append(line)
+            size += len(line)
+            if size >= batch_bytes:
+                self.put('lines', batch)
+                batch = []
+                size = 0
+        if batch:
+            self.put('lines', batch)
+        # anything left unread by a replacement iterable
+        section.flush()
+        self.put('end', post_load)
+
+
+class PipelineSection(parser.Section):
+    """Section whose lines are received from a Channel
+
+    :param channel: Channel the section's lines are read from
+    :param header: (name, database, table) of the section
+    :param on_end: called with the value of the section's end marker
+    """
+    def __init__(self, channel, header, on_end=None):
+        super(PipelineSection, self).__init__()
+        self.name, self.database, self.table = header
+        self.channel = channel
+        self.on_end = on_end
+        self.done = False
+        self.iterable = self._lines()
+
+    def _receive(self):
+        kind, value = self.channel.get()
+        if kind == 'end':
+            self.done = True
+            if self.on_end is not None:
+                self.on_end(value)
+            return None
+        return value
+
+    def _lines(self):
+        while not self.done:
+            batch = self._receive()
+            if batch is not None:
+                for line in batch:
+                    yield line
+
+    def flush(self):
+        while not self.done:
+            self._receive()
+        self.iterable = ()
+
+
+class Context(object):
+    """Writer context holding the post-load DDL of the last section read"""
+    def __init__(self):
+        self.post_load_ddl = None
+
+    def set_post_load(self, ddl):
+        self.post_load_ddl = ddl
+
+    def pop_post_load(self):
+        ddl, self.post_load_ddl = self.post_load_ddl, None
+        return ddl
+
+
+class Pipeline(object):
+    """Parse, filter and transform sections in background threads
+
+    Iterating a Pipeline yields the transformed sections that passed the
+    filter, in input order, ready to be written.  ``context`` should be
+    passed to the writer in place of the SectionTransform.
+
+    :param sections: iterable of parser.Section instances
+    :param filter_section: callable returning True for sections to skip
+    :param transform_section: SectionTransform instance
+    :param verifier: optional checksum.Verifier applied after transform
+    """
+    def __init__(self, sections, filter_section, transform_section,
+                 verifier=None, depth=DEPTH, batch_bytes=BATCH_BYTES):
+        self.sections = sections
+        self.filter_section = filter_section
+        self.transform_section = transform_section
+        self.verifier = verifier
+        self.batch_bytes = batch_bytes
+        self.context = Context()
+        self.error = None
+        self.stop = threading.Event()
+        self.parsed = Channel(depth, self.stop)
+        self.transformed = Channel(depth, self.stop)
+        self.threads = [
+            threading.Thread(target=self._run, args=(self.parse,),
+                             name='sieve-parse'),
+            threading.Thread(target=self._run, args=(self.transform,),
+                             name='sieve-transform'),
+        ]
+        for thread in self.threads:
+            thread.daemon = True
+
+    def __enter__(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _run(self, stage):
+        try:
+            stage()
+        except Cancelled:
+            pass
+        except BaseException as error:
+            debug("# sieve pipeline stage %s failed: %r",
+                  threading.current_thread().name, error)
+            if self.error is None:
+                self.error = error
+            self.stop.set()
+
+    def parse(self):
+        for section in self.sections:
+            if self.filter_section(section):
+                continue
+            self.parsed.send_section(section, self.batch_bytes)
+        self.parsed.put('done')
+
+    def transform(self):
+        while True:
+            kind, value = self.parsed.get()
+            if kind == 'done':
+                break
+            section = PipelineSection(self.parsed, value)
+            self.transform_section(section)
+            # take the DDL now, before the next section's transform can
+            # replace it
+            ddl = self.transform_section.pop_post_load()
+            if self.verifier is not None:
+                self.verifier(section)
+            self.transformed.send_section(section, self.batch_bytes,
+                                          post_load=ddl)
+        self.transformed.put('done')
+
+    def __iter__(self):
+        try:
+            while True:
+                kind, value = self.transformed.get()
+                if kind == 'done':
+                    break
+                section = PipelineSection(self.transformed, value,
+                                          on_end=self.context.set_post_load)
+                yield section
+                section.flush()
+        except Cancelled:
+            # a stage failed; surface its error rather than the cancellation
+            self.close()
+            raise
+
+    def close(self):
+        """Stop and wait for all stages
+
+        :raises: the first exception raised by any stage
+        """
+        self.stop.set()
+        for thread in self.threads:
+            if thread.is_alive():
+                thread.join()
+        if self.error is not None:
+            raise self.error
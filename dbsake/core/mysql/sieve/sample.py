@@ -0,0 +1,472 @@
+"""
+dbsake.core.mysql.sieve.sample
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Referentially consistent sampling of table data
+
+Root tables - tables without foreign keys - keep a deterministic fraction
+of their rows, chosen by a hash of each row's primary key.  Every other
+table keeps only the rows whose foreign keys reference kept parent rows.
+
+mysqldump orders tables by name rather than by their foreign keys, so a
+child table's data may come before its parent's.  The dump is therefore
+read more than once:
+
+    - one pass reads the table structure, skipping all table data
+    - one or more passes record the keys of the kept rows of each table
+      referenced by a foreign key.  A table is decided once all of its
+      parents are, so each pass decides at least one more table.
+    - the final sieve pass filters every table's rows against the keys
+      recorded for its parents
+
+Keys are held as sorted arrays of 64-bit hashes, which are spilled to
+temporary files when they exceed the memory budget.
+"""
+import array
+import bisect
+import collections
+import logging
+import mmap
+import re
+import struct
+import tempfile
+import zlib
+
+from dbsake.util import compression
+from dbsake.util import matcher
+
+from . import defer
+from . import exc
+from . import inserts
+from . import parser
+from . import where
+
+debug = logging.debug
+info = logging.info
+warn = logging.warn
+
+try:
+    TYPECODE = 'Q'
+    array.array(TYPECODE)
+except ValueError:
+    # python 2.x has no 'Q' typecode; 'L' is 64-bit on LP64 platforms
+    TYPECODE = 'L'
+
+KEY_SIZE = array.array(TYPECODE).itemsize
+
+KEY_LIMIT = 2**(KEY_SIZE*8)
+
+IDENT = br'`(?:[^`]|``)+`'
+
+FOREIGN_KEY_CRE = re.compile(br'^\s*CONSTRAINT ' + IDENT + br' FOREIGN KEY '
+                             br'\((?P<columns>.+?)\) REFERENCES '
+                             br'(?P<table>' + IDENT + br'(?:\.' + IDENT +
+                             br')?) \((?P<references>.+?)\)')
+
+IDENT_CRE = re.compile(IDENT)
+
+PRIMARY_KEY_CRE = re.compile(br'^\s*PRIMARY KEY \((?P<columns>.+)\)')
+
+
+class SampleError(exc.SieveError):
+    """Raised when a dump cannot be sampled"""
+
+
+def key_hash(value):
+    """Hash bytes to an unsigned integer of KEY_SIZE bytes
+
+    Key sets only live for a single run, so python's own (per-process
+    randomized) hash is sufficient.
+    """
+    return hash(value) % KEY_LIMIT
+
+
+def sample_hash(value):
+    """Hash bytes to an unsigned 32-bit integer, stable across runs"""
+    return zlib.crc32(value) & 0xffffffff
+
+
+class KeySet(object):
+    """Compact set of key hashes
+
+    Keys are appended to an array of hashes, which is sorted when the set
+    is frozen and searched with a binary search.  When more than max_keys
+    are held in memory they are sorted and written to a temporary file,
+    which is searched through mmap.
+
+    :param max_keys: number of keys to hold in memory before spilling
+    """
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._keys = array.array(TYPECODE)
+        self._runs = []
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, value):
+        self._keys.append(key_hash(value))
+        self._count += 1
+        if len(self._keys) >= self.max_keys:
+            self._spill()
+
+    def _spill(self):
+        keys = array.array(TYPECODE, sorted(self._keys))
+        fileobj = tempfile.TemporaryFile(prefix='dbsake-sample-')
+        keys.tofile(fileobj)
+        fileobj.flush()
+        self._runs.append((fileobj,
+                           mmap.mmap(fileobj.fileno(), 0,
+                                     access=mmap.ACCESS_READ),
+                           len(keys)))
+        debug("# Spilled %d sample keys to a temporary file", len(keys))
+        self._keys = array.array(TYPECODE)
+
+    def freeze(self):
+        """Sort any in-memory keys, so they can be searched"""
+        self._keys = array.array(TYPECODE, sorted(self._keys))
+
+    def __contains__(self, value):
+        key = key_hash(value)
+        idx = bisect.bisect_left(self._keys, key)
+        if idx < len(self._keys) and self._keys[idx] == key:
+            return True
+        for _, buf, count in self._runs:
+            lo, hi = 0, count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                found = struct.unpack_from('=' + TYPECODE, buf,
+                                           mid*KEY_SIZE)[0]
+                if found < key:
+                    lo = mid + 1
+                elif found > key:
+                    hi = mid
+                else:
+                    return True
+        return False
+
+    def close(self):
+        for fileobj, buf, _ in self._runs:
+            buf.close()
+            fileobj.close()
+        del self._runs[:]
+
+
+ForeignKey = collections.namedtuple('ForeignKey', 'columns parent references')
+
+
+class Table(object):
+    """Columns and keys of a table, parsed from its CREATE TABLE
+
+    :param database: database name as bytes
+    :param name: table name as bytes
+    :param table_ddl: CREATE TABLE statement
+    """
+    def __init__(self, database, name, table_ddl):
+        self.database = database
+        self.name = name
+        self.columns = where.table_columns(table_ddl)
+        self.primary_key = ()
+        self.foreign_keys = []
+        for line in table_ddl.splitlines():
+            match = PRIMARY_KEY_CRE.match(line)
+            if match:
+                self.primary_key = defer.parse_columns(match.group('columns'))
+                continue
+            match = FOREIGN_KEY_CRE.match(line)
+            if match:
+                parent = tuple(name[1:-1].replace(b'``', b'`') for name in
+                               IDENT_CRE.findall(match.group('table')))
+                if len(parent) == 1:
+                    parent = (database,) + parent
+                self.foreign_keys.append(ForeignKey(
+                    defer.parse_columns(match.group('columns')),
+                    parent,
+                    defer.parse_columns(match.group('references'))
+                ))
+        # filled in by Sampler.plan()
+        self.parents = []
+        self.key_sets = {}
+
+    @property
+    def key(self):
+        return (self.database, self.name)
+
+    def __str__(self):
+        return b'.'.join(self.key).decode('utf8', 'replace')
+
+    def positions(self, columns):
+        try:
+            return [self.columns.index(name) for name in columns]
+        except ValueError:
+            raise SampleError("%s: unknown column in %s" %
+                              (self, b','.join(columns).decode('utf8')))
+
+
+class RowFilter(object):
+    """Select the rows of a table to keep, and record their keys
+
+    :param table: Table instance, with parents and key sets planned
+    :param threshold: rows of root tables are kept if the hash of their
+                      primary key is below this value, or all rows are
+                      kept if None
+    """
+    def __init__(self, table, threshold):
+        self.table = table
+        self.threshold = threshold
+        wanted = []
+        # (group offsets of primary key, or None to hash the whole row)
+        self.sample_key = None
+        if not table.parents and table.primary_key:
+            wanted.append(table.positions(table.primary_key))
+        # (group offsets, parent KeySet)
+        self.checks = []
+        for foreign_key, parent in table.parents:
+            wanted.append(table.positions(foreign_key.columns))
+            key_set = parent.key_sets[tuple(foreign_key.references)]
+            self.checks.append((len(wanted) - 1, key_set))
+        # (group offsets, KeySet) for columns referenced by children
+        self.records = []
+        for columns, key_set in table.key_sets.items():
+            wanted.append(table.positions(columns))
+            self.records.append((len(wanted) - 1, key_set))
+
+        positions = sorted(set(pos for group in wanted for pos in group))
+        self.row_cre = None
+        if positions:
+            self.row_cre = inserts.row_pattern(positions)
+        groups = [tuple(positions.index(pos) for pos in group)
+                  for group in wanted]
+        if not table.parents and table.primary_key:
+            self.sample_key = groups[0]
+        self.checks = [(groups[idx], key_set)
+                       for idx, key_set in self.checks]
+        self.records = [(groups[idx], key_set)
+                        for idx, key_set in self.records]
+
+    @property
+    def keeps_all(self):
+        """True if every row of the table is kept"""
+        return not self.table.parents and self.threshold is None
+
+    def _matches(self, line, start, end):
+        if self.row_cre is None:
+            return [(row, ()) for row in inserts.iter_rows(line, start, end)]
+        try:
+            return [(match.group(0), match.groups())
+                    for match in inserts.match_rows(self.row_cre,
+                                                    line, start, end)]
+        except ValueError as exc:
+            raise SampleError("%s: %s" % (self.table, exc))
+
+    def keep(self, row, fields):
+        """Check whether a row is kept"""
+        if not self.table.parents:
+            if self.threshold is None:
+                return True
+            if self.sample_key is None:
+                value = row
+            else:
+                value = b','.join(fields[idx] for idx in self.sample_key)
+            return sample_hash(value) < self.threshold
+        for offsets, key_set in self.checks:
+            values = [fields[idx] for idx in offsets]
+            # like InnoDB, a key with any NULL column is not checked
+            if b'NULL' in values:
+                continue
+            if b','.join(values) not in key_set:
+                return False
+        return True
+
+    def rows(self, line, start, end, record=False):
+        """Find the kept row tuples in line[start:end]
+
+        :param record: if True, add the keys of kept rows to the key sets
+                       of the columns children reference
+        :returns: list of kept row tuples
+        """
+        kept = []
+        for row, fields in self._matches(line, start, end):
+            if not self.keep(row, fields):
+                continue
+            kept.append(row)
+            if record:
+                for offsets, key_set in self.records:
+                    key_set.add(b','.join(fields[idx] for idx in offsets))
+        return kept
+
+    def filter_lines(self, lines, record=False):
+        """Drop the rows of INSERT statements that are not kept
+
+        INSERT statements with no remaining rows are dropped entirely and
+        all other lines are passed through unchanged.
+        """
+        for line in inserts.whole_statements(lines):
+            bounds = inserts.values_bounds(line)
+            if bounds is None:
+                yield line
+                continue
+            start, end = bounds
+            kept = self.rows(line, start, end, record)
+            if kept:
+                yield line[:start] + b','.join(kept) + b';\n'
+
+
+class Sampler(object):
+    """Plan and collect a referentially consistent sample of a dump
+
+    :param fraction: fraction of root table rows to keep, 0 < fraction <= 1
+    :param memory: bytes of keys to hold in memory before spilling
+    :param full: glob patterns of root tables to keep all rows of
+    """
+    def __init__(self, fraction, memory, full=()):
+        self.fraction = fraction
+        self.memory = memory
+        self.threshold = int(fraction * 2**32)
+        self.full = matcher.TableMatcher(include=full)
+        self.tables = collections.OrderedDict()
+        self.filters = {}
+
+    def add_table(self, database, name, table_ddl):
+        table = Table(database, name, table_ddl)
+        self.tables[table.key] = table
+
+    def plan(self):
+        """Resolve foreign keys to parent tables
+
+        Foreign keys referencing the table itself, a table missing from
+        the dump or a table that would complete a cycle are not followed.
+
+        :returns: list of tables referenced by other tables
+        """
+        state = {}
+
+        def visit(table):
+            state[table.key] = 'visiting'
+            for foreign_key in table.foreign_keys:
+                parent = self.tables.get(foreign_key.parent)
+                if parent is None:
+                    warn("Not sampling %s by foreign key to %s - "
+                         "table not found in dump", table,
+                         b'.'.join(foreign_key.parent).decode('utf8'))
+                    continue
+                if parent is table or state.get(parent.key) == 'visiting':
+                    warn("Not sampling %s by foreign key to %s - "
+                         "reference is circular", table, parent)
+                    continue
+                if parent.key not in state:
+                    visit(parent)
+                table.parents.append((foreign_key, parent))
+                columns = tuple(foreign_key.references)
+                if columns not in parent.key_sets:
+                    parent.key_sets[columns] = None
+            state[table.key] = 'done'
+
+        for table in self.tables.values():
+            if table.key not in state:
+                visit(table)
+
+        parents = [table for table in self.tables.values() if table.key_sets]
+        count = sum(len(table.key_sets) for table in parents)
+        max_keys = max(1024, self.memory // KEY_SIZE // max(count, 1))
+        for table in parents:
+            for columns in table.key_sets:
+                table.key_sets[columns] = KeySet(max_keys)
+        return parents
+
+    def row_filter(self, database, name):
+        """Find the RowFilter for a table, or None if it is not sampled"""
+        key = (database, name)
+        if key not in self.filters:
+            table = self.tables.get(key)
+            threshold = self.threshold
+            if self.full and not self.full.table(database, name):
+                threshold = None
+            self.filters[key] = table and RowFilter(table, threshold)
+        return self.filters[key]
+
+    def close(self):
+        for table in self.tables.values():
+            for key_set in table.key_sets.values():
+                key_set.close()
+
+
+def _read_sections(options):
+    """Read the sections of the input from the start"""
+    options.input_stream.seek(0)
+    with compression.decompressed(options.input_stream) as input_stream:
+        for section in parser.DumpParser(stream=input_stream,
+                                         max_line_size=options.line_memory):
+            yield section
+
+
+def collect(options):
+    """Read the input to decide which rows of each table are sampled
+
+    The input is read from the start once for its table structure and
+    once more for each level of foreign keys that must be resolved, and
+    left positioned at the start for the final sieve pass.
+
+    :returns: Sampler instance
+    :raises: SampleError if the input is not a regular file
+    """
+    if not compression.is_seekable(options.input_stream):
+        raise SampleError("--sample requires a regular --input-file, as the "
+                          "input is read more than once")
+
+    sampler = Sampler(options.sample,
+                      options.sample_memory,
+                      options.sample_full)
+    with_data = set()
+    for section in _read_sections(options):
+        if section.name == 'tablestructure':
+            section.iterable = list(section.iterable)
+            sampler.add_table(section.database, section.table,
+                              defer.extract_create_table(section))
+        elif section.name == 'tabledata':
+            with_data.add((section.database, section.table))
+        section.flush()
+
+    parents = sampler.plan()
+    decided = set(sampler.tables)
+    pending = set()
+    for table in parents:
+        if table.key in with_data:
+            pending.add(table.key)
+            decided.discard(table.key)
+
+    def ready(key):
+        return all(parent.key in decided
+                   for _, parent in sampler.tables[key].parents)
+
+    passes = 0
+    while pending:
+        passes += 1
+        progress = False
+        for section in _read_sections(options):
+            key = (section.database, section.table)
+            if (section.name != 'tabledata' or key not in pending or
+                    not ready(key)):
+                section.flush()
+                continue
+            table = sampler.tables[key]
+            row_filter = sampler.row_filter(*key)
+            for _ in row_filter.filter_lines(section.iterable, record=True):
+                pass
+            for key_set in table.key_sets.values():
+                key_set.freeze()
+            pending.discard(key)
+            decided.add(key)
+            progress = True
+            debug("# Recorded %s key(s) for %s in sample pass %d",
+                  '/'.join('%d' % len(key_set)
+                           for key_set in table.key_sets.values()),
+                  table, passes)
+        if not progress:
+            raise SampleError("Failed to resolve foreign keys for %s" %
+                              ', '.join(str(sampler.tables[key])
+                                        for key in sorted(pending)))
+    info("Recorded sample keys in %d pass(es)", passes)
+    options.input_stream.seek(0)
+    return sampler
@@ -0,0 +1,264 @@
+"""
+dbsake.core.mysql.sieve.stats
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Byte accounting and per-stage timing for sieve
+
+sieve work is interleaved: the writer pulls lines through the transform,
+which pulls lines from the parser, which reads blocks of input.  Timing
+is therefore done with a stack of stages, where only the innermost stage
+is charged for elapsed time.  Time spent writing a section excludes the
+parse and transform work done to produce its lines, and so on.
+
+The stages are:
+
+    - read: waiting on input, including any decompression
+    - parse: splitting the input into sections and lines
+    - filter: deciding whether a section is output
+    - transform: rewriting section lines
+    - write: writing and compressing output
+"""
+from __future__ import unicode_literals
+
+import collections
+import json
+import time
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+STAGES = ('read', 'parse', 'filter', 'transform', 'write')
+
+FIELDS = ('sections', 'bytes_in', 'bytes_out', 'lines_in', 'lines_out',
+          'inserts')
+
+
+class Counters(object):
+    """Byte, line and time totals for a group of sections"""
+    def __init__(self):
+        for name in FIELDS:
+            setattr(self, name, 0)
+        self.time = dict((stage, 0.0) for stage in STAGES)
+
+    def as_dict(self):
+        result = collections.OrderedDict((name, getattr(self, name))
+                                         for name in FIELDS)
+        result['time'] = collections.OrderedDict(
+            (stage, round(self.time[stage], 6)) for stage in STAGES
+        )
+        return result
+
+
+class Stats(collections.defaultdict):
+    """Count of sections output, by section name
+
+    If detailed accounting was requested, ``by_section`` and ``by_table``
+    map section names and (database, table) pairs to Counters, and
+    ``total`` holds the totals across all sections.
+    """
+    def __init__(self):
+        super(Stats, self).__init__(int)
+        self.total = Counters()
+        self.by_section = collections.OrderedDict()
+        self.by_table = collections.OrderedDict()
+        self.elapsed = 0.0
+
+    def counters(self, section):
+        """Find the Counters objects a section should be charged to"""
+        result = [self.total]
+        if section is None:
+            return result
+        if section.name not in self.by_section:
+            self.by_section[section.name] = Counters()
+        result.append(self.by_section[section.name])
+        if section.table is not None:
+            key = (section.database, section.table)
+            if key not in self.by_table:
+                self.by_table[key] = Counters()
+            result.append(self.by_table[key])
+        return result
+
+    def as_dict(self):
+        def decode(value):
+            return value.decode('utf8', 'replace')
+        return collections.OrderedDict([
+            ('elapsed', round(self.elapsed, 6)),
+            ('total', self.total.as_dict()),
+            ('sections', collections.OrderedDict(
+                (name, counters.as_dict())
+                for name, counters in self.by_section.items()
+            )),
+            ('tables', [
+                collections.OrderedDict(
+                    [('database', decode(database)),
+                     ('table', decode(table))] +
+                    list(counters.as_dict().items())
+                )
+                for (database, table), counters in self.by_table.items()
+            ]),
+        ])
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2)
+
+    def format(self):
+        """Format detailed stats as a human readable table"""
+        header = ('%-32s %8s %10s %10s %9s %8s' + ' %9s'*len(STAGES)) % (
+            ('', 'sections', 'bytes in', 'bytes out', 'lines', 'inserts') +
+            STAGES
+        )
+
+        def row(label, counters):
+            return ('%-32s %8d %10d %10d %9d %8d' + ' %8.3fs'*len(STAGES)) % (
+                (label[:32], counters.sections, counters.bytes_in,
+                 counters.bytes_out, counters.lines_in, counters.inserts) +
+                tuple(counters.time[stage] for stage in STAGES)
+            )
+
+        lines = [header]
+        for name, counters in self.by_section.items():
+            lines.append(row(name, counters))
+        lines.append(row('total', self.total))
+        if self.by_table:
+            lines.append('')
+            lines.append(header)
+            for (database, table), counters in self.by_table.items():
+                label = b'.'.join((database, table)).decode('utf8', 'replace')
+                lines.append(row(label, counters))
+        lines.append('elapsed: %.3fs' % self.elapsed)
+        return '\n'.join(lines)
+
+
+class Recorder(object):
+    """Charge time and bytes to the sections sieve processes
+
+    :param stats: Stats instance to update
+    """
+    def __init__(self, stats):
+        self.stats = stats
+        self.current = stats.counters(None)
+        self._stack = []
+        self._last = clock()
+
+    def push(self, stage):
+        """Start charging time to stage, pausing the enclosing stage"""
+        now = clock()
+        if self._stack:
+            stage_name, counters = self._stack[-1]
+            for counter in counters:
+                counter.time[stage_name] += now - self._last
+        self._stack.append((stage, self.current))
+        self._last = now
+
+    def pop(self):
+        """Stop charging time to the current stage"""
+        now = clock()
+        stage_name, counters = self._stack.pop()
+        for counter in counters:
+            counter.time[stage_name] += now - self._last
+        self._last = now
+
+    def timed(self, stage, func):
+        """Wrap func so calls to it are charged to stage"""
+        def wrapper(*args, **kwargs):
+            self.push(stage)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.pop()
+        return wrapper
+
+    def stream(self, stream):
+        """Wrap an input stream so reads from it are charged to 'read'"""
+        return TimedStream(stream, self)
+
+    def sections(self, sections, offset=None):
+        """Charge time spent finding each section to 'parse'
+
+        :param sections: iterable of sections
+        :param offset: optional function returning the current input offset,
+                       used to count the bytes of sections that are skipped
+                       rather than read line by line
+        """
+        iterator = iter(sections)
+        start = offset() if offset else 0
+        while True:
+            self.push('parse')
+            try:
+                section = next(iterator, None)
+            finally:
+                self.pop()
+            if offset:
+                end = offset()
+                for counter in self.current:
+                    counter.bytes_in += end - start
+                start = end
+            if section is None:
+                break
+            self.current = self.stats.counters(section)
+            for counter in self.current:
+                counter.sections += 1
+            if section.skip is not None:
+                section.skip = self.timed('parse', section.skip)
+            section.iterable = self._lines_in(section.iterable,
+                                              count_bytes=offset is None)
+            yield section
+        self.current = self.stats.counters(None)
+
+    def _lines_in(self, iterable, count_bytes):
+        iterator = iter(iterable)
+        counters = self.current
+        while True:
+            self.push('parse')
+            try:
+                line = next(iterator, None)
+            finally:
+                self.pop()
+            if line is None:
+                break
+            for counter in counters:
+                counter.lines_in += 1
+                if count_bytes:
+                    counter.bytes_in += len(line)
+                if line.startswith((b'INSERT ', b'REPLACE ')):
+                    counter.inserts += 1
+            yield line
+
+    def lines_out(self, section):
+        """Charge time to produce the transformed lines to 'transform'"""
+        section.iterable = self._lines_out(section.iterable)
+
+    def _lines_out(self, iterable):
+        iterator = iter(iterable)
+        counters = self.current
+        while True:
+            self.push('transform')
+            try:
+                line = next(iterator, None)
+            finally:
+                self.pop()
+            if line is None:
+                break
+            for counter in counters:
+                counter.lines_out += 1
+                counter.bytes_out += len(line)
+            yield line
+
+
+class TimedStream(object):
+    """Proxy for an input stream, charging reads to the 'read' stage"""
+    def __init__(self, stream, recorder):
+        self._stream = stream
+        self._recorder = recorder
+        self.read = recorder.timed('read', stream.read)
+        self.readline = recorder.timed('read', stream.readline)
+        if hasattr(stream, 'readlines'):
+            self.readlines = recorder.timed('read', stream.readlines)
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
@@ -0,0 +1,144 @@
+"""
+dbsake.core.mysql.sieve.tab
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Support for converting mysqldump INSERT statements to LOAD DATA input
+
+Rows are written in the default LOAD DATA INFILE format: fields terminated
+by a tab, lines terminated by a newline, with backslash escapes and NULL
+written as \\N.
+"""
+import binascii
+import re
+
+from . import inserts
+
+# a single value in a VALUES row tuple
+#   quoted string, with an optional charset introducer (_binary '...')
+#   hexadecimal literal (mysqldump --hex-blob)
+#   bit literal
+#   anything else (numbers, NULL)
+VALUE_CRE = re.compile(br"(?:_\w+ ?)?'([^'\\]*(?:(?:\\.|'')[^'\\]*)*)'"
+                       br"|0x([0-9A-Fa-f]*)"
+                       br"|b'([01]*)'"
+                       br"|([^,']+)", re.DOTALL)
+
+INSERT_CRE = re.compile(br"(?P<verb>INSERT|REPLACE)(?P<ignore> IGNORE)? "
+                        br"INTO (?P<table>`(?:[^`]|``)+`) "
+                        br"(?:\((?P<columns>.*)\) )?VALUES $", re.DOTALL)
+
+NAMES_CRE = re.compile(br"SET NAMES (\w+)")
+
+
+def _escape(value):
+    """Escape raw bytes for a LOAD DATA field"""
+    return (value.replace(b'\\', b'\\\\')
+                 .replace(b'\t', b'\\t')
+                 .replace(b'\n', b'\\n')
+                 .replace(b'\0', b'\\0'))
+
+
+def _unquote(value):
+    """Convert the contents of a mysqldump quoted string to a field
+
+    mysqldump strings already use the backslash escapes LOAD DATA
+    understands, except that tabs and newlines may appear literally.
+    """
+    if b"''" in value:
+        value = value.replace(b"''", b"\\'")
+    if b'\t' in value:
+        value = value.replace(b'\t', b'\\t')
+    if b'\n' in value:
+        value = value.replace(b'\n', b'\\n')
+    return value
+
+
+def row_fields(row):
+    """Convert a VALUES row tuple to a list of LOAD DATA fields
+
+    :param row: bytes row tuple, including its enclosing parentheses
+    :returns: list of escaped bytes fields
+    """
+    fields = []
+    for match in VALUE_CRE.finditer(row, 1, len(row) - 1):
+        string, hex_value, bits, other = match.groups()
+        if string is not None:
+            fields.append(_unquote(string))
+        elif hex_value is not None:
+            fields.append(_escape(binascii.unhexlify(hex_value)))
+        elif bits is not None:
+            value = int(bits or b'0', 2)
+            nbytes = max(1, (len(bits) + 7) // 8)
+            hex_value = '%0*x' % (nbytes*2, value)
+            data = binascii.unhexlify(hex_value.encode('ascii'))
+            fields.append(_escape(data))
+        else:
+            other = other.strip()
+            fields.append(b'\\N' if other == b'NULL' else other)
+    return fields
+
+
+def quote_string(value):
+    """Quote bytes as a SQL string literal"""
+    return b"'" + value.replace(b'\\', b'\\\\').replace(b"'", b"\\'") + b"'"
+
+
+def client_charset(header):
+    """Find the character set set by a mysqldump header"""
+    match = NAMES_CRE.search(header or b'')
+    if match:
+        return match.group(1)
+    return b'utf8'
+
+
+def load_data(prefix, path, charset):
+    """Build a LOAD DATA statement equivalent to INSERTs with prefix
+
+    :param prefix: INSERT prefix, as returned by inserts.split_insert()
+    :param path: path of the data file, as bytes
+    :param charset: character set of the data file
+    :returns: bytes LOAD DATA statement, including a trailing newline
+    """
+    match = INSERT_CRE.match(prefix)
+    if match is None:
+        raise ValueError("Unsupported INSERT statement %r" % prefix)
+    modifier = b''
+    if match.group('verb') == b'REPLACE':
+        modifier = b'REPLACE '
+    elif match.group('ignore'):
+        modifier = b'IGNORE '
+    statement = (b'LOAD DATA LOCAL INFILE ' + quote_string(path) + b' ' +
+                 modifier + b'INTO TABLE ' + match.group('table') +
+                 b' CHARACTER SET ' + charset +
+                 b" FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\'"
+                 b" LINES TERMINATED BY '\\n'")
+    if match.group('columns'):
+        statement += b' (' + match.group('columns') + b')'
+    return statement + b';\n'
+
+
+def convert(lines, data_file, path, charset=b'utf8'):
+    """Write the rows of INSERT statements to a LOAD DATA file
+
+    The first INSERT statement is replaced with a LOAD DATA statement for
+    the data file and any later INSERT statements are dropped.  All other
+    lines are passed through unchanged.
+
+    :param lines: iterable of bytes lines from a tabledata section
+    :param data_file: file object to write rows to
+    :param path: path to the data file used in the LOAD DATA statement
+    :param charset: character set of the data
+    :returns: iterator of bytes lines
+    """
+    write = data_file.write
+    loaded = False
+    for line in inserts.whole_statements(lines):
+        insert = inserts.split_insert(line)
+        if insert is None:
+            yield line
+            continue
+        prefix, rows = insert
+        if not loaded:
+            loaded = True
+            yield load_data(prefix, path, charset)
+        write(b''.join(b'\t'.join(row_fields(row)) + b'\n' for row in rows))
@@ -0,0 +1,193 @@
+"""
+dbsake.core.mysql.sieve.tee
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Several filtered outputs from a single pass over a dump
+
+Each output has its own sieve options - section and table filters,
+transforms and output format - and is written by its own thread.  The
+caller's thread parses the input once, decides which outputs keep each
+section and sends the section's lines to them, through a bounded Channel
+per output.  Output threads never run the filters themselves, as the
+table matchers' caches are not thread-safe.  A slow
+output only holds up parsing once its own queue is full, and sections no
+output keeps are skipped without being read.
+
+Any exception raised by an output stops all of them and is re-raised in
+the caller's thread when the tee is closed.
+"""
+from __future__ import unicode_literals
+
+import logging
+import threading
+
+from . import checksum
+from . import filters
+from . import pipeline
+from . import stats
+from . import transform
+from . import writers
+
+debug = logging.debug
+
+
+class Output(object):
+    """Filter, transform and writer of a single tee output
+
+    :param options: sieve Options of the output
+    :param channel: pipeline.Channel the output's sections are read from
+    """
+    def __init__(self, options, channel):
+        self.options = options
+        self.channel = channel
+        self.transform_section = transform.SectionTransform(options)
+        self.filter_section = filters.SectionFilter(options)
+        self.verifier = checksum.Verifier() if options.verify else None
+        self.stats = stats.Stats()
+        self.writer = writers.load(options, context=self.transform_section)
+
+    def filtered(self, section):
+        """Decide how the output treats section, in the parsing thread
+
+        :returns: False if the output writes section, True if it only
+                  observes the filtered section, or None if it does not
+                  read section at all
+        """
+        if not self.filter_section.filtered(section):
+            return False
+        if self.transform_section.observes(section):
+            return True
+        return None
+
+    def run(self):
+        try:
+            while True:
+                kind, value = self.channel.get()
+                if kind == 'done':
+                    break
+                header, filtered = value
+                section = pipeline.PipelineSection(self.channel, header)
+                if filtered:
+                    self.transform_section.observe_filtered(section)
+                    section.flush()
+                    continue
+                self.stats[section.name] += 1
+                self.transform_section(section)
+                if self.verifier is not None:
+                    self.verifier(section)
+                self.writer(section)
+                section.flush()
+        except BaseException:
+            self.writer.close(failed=True)
+            raise
+        self.writer.close()
+        if self.verifier is not None:
+            self.verifier.write(self.options.verify)
+
+
+class Tee(object):
+    """Write sections to several outputs in one pass
+
+    :param outputs: sequence of sieve Options, one per output
+    """
+    def __init__(self, outputs, depth=pipeline.DEPTH,
+                 batch_bytes=pipeline.BATCH_BYTES):
+        self.batch_bytes = batch_bytes
+        self.error = None
+        self.stop = threading.Event()
+        self.outputs = []
+        self.threads = []
+        try:
+            for options in outputs:
+                self.outputs.append(
+                    Output(options, pipeline.Channel(depth, self.stop))
+                )
+        except Exception:
+            for output in self.outputs:
+                output.writer.close(failed=True)
+            raise
+        for idx, output in enumerate(self.outputs):
+            thread = threading.Thread(target=self._run, args=(output,),
+                                      name='sieve-tee-%d' % idx)
+            thread.daemon = True
+            self.threads.append(thread)
+
+    def __enter__(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _run(self, output):
+        try:
+            output.run()
+        except pipeline.Cancelled:
+            pass
+        except BaseException as error:
+            debug("# sieve tee output %s failed: %r",
+                  threading.current_thread().name, error)
+            if self.error is None:
+                self.error = error
+            self.stop.set()
+
+    def filter_section(self, section):
+        """Check whether no output keeps section"""
+        return all(output.filtered(section) is None
+                   for output in self.outputs)
+
+    def _send(self, section, outputs):
+        """Send section to outputs, a list of (output, filtered) pairs"""
+        header = (section.name, section.database, section.table)
+        for output, filtered in outputs:
+            output.channel.put('section', (header, filtered))
+        outputs = [output for output, _ in outputs]
+        batch = []
+        size = 0
+        for line in section.iterable:
+            batch.append(line)
+            size += len(line)
+            if size >= self.batch_bytes:
+                for output in outputs:
+                    output.channel.put('lines', batch)
+                batch = []
+                size = 0
+        if batch:
+            for output in outputs:
+                output.channel.put('lines', batch)
+        for output in outputs:
+            output.channel.put('end')
+
+    def run(self, sections):
+        """Send each section to the outputs that keep it
+
+        :raises: the first exception raised by any output
+        """
+        try:
+            for section in sections:
+                outputs = [(output, output.filtered(section))
+                           for output in self.outputs]
+                outputs = [(output, filtered) for output, filtered in outputs
+                           if filtered is not None]
+                if outputs:
+                    self._send(section, outputs)
+                else:
+                    section.flush()
+            for output in self.outputs:
+                output.channel.put('done')
+        except pipeline.Cancelled:
+            # an output failed; surface its error rather than the
+            # cancellation
+            pass
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """Stop and wait for all outputs"""
+        self.stop.set()
+        for thread in self.threads:
+            if thread.is_alive():
+                thread.join()
@@ -8,17 +8,28 @@ API for transforming mysqldump sections
 import itertools
 
 from . import defer
+from . import inserts
+from . import where
 
 SKIP_BINLOG = b'/*!40101 SET @OLD_SQL_LOG_BIN=@@SQL_LOG_BIN, SQL_LOG_BIN=0 */;'
 ENABLE_BINLOG = b'/*!40101 SET SQL_LOG_BIN=@OLD_SQL_LOG_BIN */;'
 
 
 class SectionTransform(object):
-    def __init__(self, options):
+    def __init__(self, options, sampler=None):
         self.options = options
+        # sample.Sampler deciding the rows kept by --sample
+        self.sampler = sampler
         # used to track deferred keys / constraints
         # in order to output them after the data load
         self.pending_ddl = None
+        # deferred keys / constraints for the last tabledata section, when
+        # they are written separately for a post-load phase
+        self.post_load_ddl = None
+        # --where predicates by (database, table) and the column names
+        # of the last table structure seen for each of those tables
+        self.where = where.parse_all(options.where)
+        self.where_columns = {}
 
     def transform_header(self, section):
         if not self.options.write_binlog:
@@ -43,10 +54,33 @@ class SectionTransform(object):
             data = data.replace(b'CHANGE MASTER', b'-- CHANGE MASTER')
         section.iterable = data.splitlines(True)
 
+    def observes(self, section):
+        """Check whether observe_filtered() reads section"""
+        return (section.name == 'tablestructure' and
+                (section.database, section.table) in self.where)
+
+    def observe_filtered(self, section):
+        """Track state needed by later sections from a filtered section
+
+        --where still needs the columns of a table whose structure is not
+        output, e.g. with --no-table-schema.
+        """
+        if self.observes(section):
+            self._record_where_columns(section)
+
+    def _record_where_columns(self, section):
+        key = (section.database, section.table)
+        if key in self.where:
+            section.iterable = list(section.iterable)
+            table_ddl = defer.extract_create_table(section)
+            self.where_columns[key] = where.table_columns(table_ddl)
+
     def transform_tablestructure(self, section):
         defer_indexes = self.options.defer_indexes
         defer_fks = self.options.defer_foreign_keys
 
+        self._record_where_columns(section)
+
         if defer_indexes:
             alter_table = defer.split_indexes(section, defer_fks)
             if alter_table:
@@ -56,11 +90,50 @@ class SectionTransform(object):
                 self.pending_ddl = []
 
     def transform_tabledata(self, section):
+        key = (section.database, section.table)
+        if key in self.where:
+            section.iterable = where.filter_rows(section.iterable,
+                                                 self.where[key],
+                                                 self.where_columns.get(key))
+        if self.sampler is not None:
+            row_filter = self.sampler.row_filter(*key)
+            if row_filter is not None and not row_filter.keeps_all:
+                section.iterable = row_filter.filter_lines(section.iterable)
+        if self.options.insert_batch_size or self.options.insert_batch_rows:
+            section.iterable = inserts.rebatch(
+                section.iterable,
+                max_bytes=self.options.insert_batch_size,
+                max_rows=self.options.insert_batch_rows
+            )
         if self.pending_ddl:
-            section.iterable = itertools.chain(section.iterable,
-                                               self.pending_ddl)
+            if self.options.post_load_indexes:
+                self.post_load_ddl = self.pending_ddl
+            else:
+                section.iterable = itertools.chain(section.iterable,
+                                                   self.pending_ddl)
             self.pending_ddl = None
 
+    def pop_post_load(self):
+        """Take the deferred DDL held back for a post-load phase, if any"""
+        ddl, self.post_load_ddl = self.post_load_ddl, None
+        return ddl
+
+    def get_state(self):
+        """State later sections depend on, between sections"""
+        return dict(
+            pending_ddl=self.pending_ddl,
+            where_columns=[(database, table, columns)
+                           for (database, table), columns
+                           in self.where_columns.items()]
+        )
+
+    def set_state(self, state):
+        """Restore the state of get_state()"""
+        self.pending_ddl = state['pending_ddl']
+        self.where_columns = dict(((database, table), columns)
+                                  for database, table, columns
+                                  in state['where_columns'])
+
     def __call__(self, section):
         try:
             dispatch = getattr(self, 'transform_' + section.name)
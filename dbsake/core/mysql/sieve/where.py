@@ -0,0 +1,486 @@
+"""
+dbsake.core.mysql.sieve.where
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Row level filtering of table data
+
+A predicate is a small subset of SQL WHERE syntax, evaluated against each
+row tuple of a table's extended INSERT statements:
+
+    - comparisons of a column to a literal: =, !=, <>, <, <=, >, >=
+    - column [NOT] IN (literal, ...)
+    - column [NOT] BETWEEN literal AND literal
+    - column IS [NOT] NULL
+    - AND, OR, NOT and parentheses
+
+Literals are numbers, quoted strings or NULL.  A column and a literal are
+compared as numbers if either is a number and both can be read as one,
+otherwise their bytes are compared (case-sensitive, unlike most MySQL
+collations).  As in SQL, a comparison with NULL is neither true nor false
+and a row is only kept if the predicate is true.
+"""
+import binascii
+import decimal
+import re
+
+from . import defer
+from . import exc
+from . import inserts
+from . import tab
+
+
+class WhereError(exc.SieveError):
+    """Raised when a --where predicate cannot be parsed or applied"""
+
+
+TOKEN_CRE = re.compile(r"""
+    \s*(?:
+        (?P<number>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+      | (?P<string>'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")
+      | (?P<quoted>`(?:[^`]|``)+`)
+      | (?P<op><=|>=|<>|!=|=|<|>|\(|\)|,)
+      | (?P<word>\w+)
+    )""", re.VERBOSE | re.DOTALL)
+
+KEYWORDS = ('AND', 'OR', 'NOT', 'IN', 'BETWEEN', 'IS', 'NULL')
+
+COMPARISONS = {
+    '=': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<>': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+# mysql string escapes, see "String Literals" in the MySQL manual
+ESCAPES = {
+    b'0': b'\0', b'b': b'\b', b'n': b'\n', b'r': b'\r', b't': b'\t',
+    b'Z': b'\x1a',
+}
+
+ESCAPE_CRE = re.compile(br"\\(.)|''", re.DOTALL)
+
+COLUMN_CRE = re.compile(br'^\s+(`(?:[^`]|``)+`) ')
+
+
+def _unescape_match(match):
+    char = match.group(1)
+    if char is None:
+        return b"'"
+    return ESCAPES.get(char, char)
+
+
+def unescape(value):
+    """Decode the contents of a quoted SQL string to bytes"""
+    if b'\\' not in value and b"''" not in value:
+        return value
+    return ESCAPE_CRE.sub(_unescape_match, value)
+
+
+def tokenize(text):
+    """Split a predicate into (kind, value) tokens"""
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = TOKEN_CRE.match(text, pos)
+        if match is None or match.end() == pos:
+            raise WhereError("Invalid syntax at %r" % text[pos:].strip())
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'word' and value.upper() in KEYWORDS:
+            kind, value = 'keyword', value.upper()
+        elif kind == 'word':
+            kind = 'column'
+        elif kind == 'quoted':
+            kind, value = 'column', value[1:-1].replace('``', '`')
+        elif kind == 'string':
+            quote = value[0]
+            value = value[1:-1].encode('utf8')
+            if quote == '"':
+                value = value.replace(b'""', b'"')
+            value = unescape(value)
+        elif kind == 'number':
+            value = decimal.Decimal(value)
+        tokens.append((kind, value))
+    return tokens
+
+
+class Parser(object):
+    """Recursive descent parser for a predicate
+
+    Produces a tree of tuples:
+
+        ('and', left, right), ('or', left, right), ('not', node)
+        ('cmp', op, column, literal)
+        ('in', column, [literal, ...])
+        ('between', column, low, high)
+        ('null', column)
+    """
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def peek(self, kind=None, value=None):
+        if self.pos >= len(self.tokens):
+            return False
+        token_kind, token_value = self.tokens[self.pos]
+        return ((kind is None or token_kind == kind) and
+                (value is None or token_value == value))
+
+    def accept(self, kind, value=None):
+        if self.peek(kind, value):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, kind, value=None):
+        if not self.peek(kind, value):
+            if self.pos < len(self.tokens):
+                found = repr(self.tokens[self.pos][1])
+            else:
+                found = 'end of predicate'
+            raise WhereError("Expected %s but found %s in %r" %
+                             (value or kind, found, self.text))
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token[1]
+
+    def parse(self):
+        node = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise WhereError("Unexpected %r in %r" %
+                             (self.tokens[self.pos][1], self.text))
+        return node
+
+    def parse_or(self):
+        node = self.parse_and()
+        while self.accept('keyword', 'OR'):
+            node = ('or', node, self.parse_and())
+        return node
+
+    def parse_and(self):
+        node = self.parse_not()
+        while self.accept('keyword', 'AND'):
+            node = ('and', node, self.parse_not())
+        return node
+
+    def parse_not(self):
+        if self.accept('keyword', 'NOT'):
+            return ('not', self.parse_not())
+        if self.accept('op', '('):
+            node = self.parse_or()
+            self.expect('op', ')')
+            return node
+        return self.parse_predicate()
+
+    def parse_literal(self):
+        if self.accept('keyword', 'NULL'):
+            return None
+        if self.peek('number'):
+            return self.expect('number')
+        return self.expect('string')
+
+    def parse_predicate(self):
+        column = self.expect('column')
+        if self.accept('keyword', 'IS'):
+            negate = self.accept('keyword', 'NOT')
+            self.expect('keyword', 'NULL')
+            node = ('null', column)
+        else:
+            negate = self.accept('keyword', 'NOT')
+            if self.accept('keyword', 'IN'):
+                self.expect('op', '(')
+                values = [self.parse_literal()]
+                while self.accept('op', ','):
+                    values.append(self.parse_literal())
+                self.expect('op', ')')
+                node = ('in', column, values)
+            elif self.accept('keyword', 'BETWEEN'):
+                low = self.parse_literal()
+                self.expect('keyword', 'AND')
+                node = ('between', column, low, self.parse_literal())
+            elif negate:
+                raise WhereError("Expected IN or BETWEEN after NOT in %r" %
+                                 self.text)
+            else:
+                op = self.expect('op')
+                if op not in COMPARISONS:
+                    raise WhereError("Expected a comparison but found %r "
+                                     "in %r" % (op, self.text))
+                return ('cmp', op, column, self.parse_literal())
+        if negate:
+            node = ('not', node)
+        return node
+
+
+def _number(value):
+    if isinstance(value, decimal.Decimal):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        value = decimal.Decimal(value.decode('ascii').strip())
+    except (UnicodeDecodeError, decimal.InvalidOperation):
+        return None
+    # strings like 'nan' or 'infinity' are not numbers to mysql
+    if not value.is_finite():
+        return None
+    return value
+
+
+def compare(op, value, literal):
+    """Compare a row value to a literal
+
+    :returns: True, False or None if either side is NULL
+    """
+    if value is None or literal is None:
+        return None
+    if isinstance(value, bytes) != isinstance(literal, bytes):
+        number_value, number_literal = _number(value), _number(literal)
+        if number_value is not None and number_literal is not None:
+            value, literal = number_value, number_literal
+        else:
+            value = value if isinstance(value, bytes) else \
+                str(value).encode('ascii')
+            literal = literal if isinstance(literal, bytes) else \
+                str(literal).encode('ascii')
+    return COMPARISONS[op](value, literal)
+
+
+def _and(left, right):
+    if left is False or right is False:
+        return False
+    if left is None or right is None:
+        return None
+    return True
+
+
+def _or(left, right):
+    if left is True or right is True:
+        return True
+    if left is None or right is None:
+        return None
+    return False
+
+
+def _columns(node):
+    kind = node[0]
+    if kind in ('and', 'or'):
+        return _columns(node[1]) | _columns(node[2])
+    if kind == 'not':
+        return _columns(node[1])
+    if kind == 'cmp':
+        return set([node[2]])
+    return set([node[1]])
+
+
+def _compile(node, index):
+    """Compile a parse tree to a function of the list of row values"""
+    kind = node[0]
+    if kind in ('and', 'or'):
+        left = _compile(node[1], index)
+        right = _compile(node[2], index)
+        if kind == 'and':
+            return lambda values: _and(left(values), right(values))
+        return lambda values: _or(left(values), right(values))
+    if kind == 'not':
+        inner = _compile(node[1], index)
+
+        def negate(values):
+            result = inner(values)
+            return None if result is None else not result
+        return negate
+    if kind == 'cmp':
+        _, op, column, literal = node
+        pos = index[column]
+        return lambda values: compare(op, values[pos], literal)
+    if kind == 'in':
+        _, column, literals = node
+        pos = index[column]
+
+        def is_in(values):
+            result = False
+            for literal in literals:
+                result = _or(result, compare('=', values[pos], literal))
+                if result:
+                    break
+            return result
+        return is_in
+    if kind == 'between':
+        _, column, low, high = node
+        pos = index[column]
+        return lambda values: _and(compare('>=', values[pos], low),
+                                   compare('<=', values[pos], high))
+    pos = index[node[1]]
+    return lambda values: values[pos] is None
+
+
+def field_value(field):
+    """Convert a field of a VALUES row tuple to a value
+
+    Strings and hex literals are returned as bytes, bit literals and
+    numbers as Decimal and NULL as None.
+    """
+    if field.startswith(b"'"):
+        return unescape(field[1:-1])
+    if field == b'NULL':
+        return None
+    string, hex_value, bits, other = tab.VALUE_CRE.match(field).groups()
+    if string is not None:
+        return unescape(string)
+    if hex_value is not None:
+        return binascii.unhexlify(hex_value)
+    if bits is not None:
+        return decimal.Decimal(int(bits or b'0', 2))
+    other = other.strip()
+    if other == b'NULL':
+        return None
+    return _number(other)
+
+
+class Predicate(object):
+    """A parsed --where predicate for a single table
+
+    :param database: database name as bytes
+    :param table: table name as bytes
+    :param text: predicate text
+    """
+    def __init__(self, database, table, text):
+        self.database = database
+        self.table = table
+        self.text = text
+        self.tree = Parser(text).parse()
+        self.columns = _columns(self.tree)
+        self._bound = {}
+
+    def combine(self, other):
+        """AND another predicate for the same table into this one"""
+        self.text = '(%s) AND (%s)' % (self.text, other.text)
+        self.tree = ('and', self.tree, other.tree)
+        self.columns |= other.columns
+        self._bound = {}
+
+    def bind(self, columns):
+        """Compile this predicate for a table's column names
+
+        :param columns: sequence of bytes column names, in row order
+        :returns: function of (line, start, end) returning the row tuples
+                  in line[start:end] the predicate is true for
+        """
+        columns = tuple(columns)
+        try:
+            return self._bound[columns]
+        except KeyError:
+            pass
+        names = [name.decode('utf8') for name in columns]
+        index = {}
+        for name in self.columns:
+            if name not in names:
+                raise WhereError("Unknown column '%s' in --where for %s.%s" %
+                                 (name,
+                                  self.database.decode('utf8'),
+                                  self.table.decode('utf8')))
+            index[name] = names.index(name)
+        positions = sorted(set(index.values()))
+        row_cre = inserts.row_pattern(positions)
+        test = _compile(self.tree, index)
+
+        def keep_rows(line, start, end):
+            kept = []
+            try:
+                for match in inserts.match_rows(row_cre, line, start, end):
+                    values = dict(zip(positions,
+                                      map(field_value, match.groups())))
+                    if test(values) is True:
+                        kept.append(match.group(0))
+            except ValueError as exc:
+                raise WhereError("%s.%s: %s" %
+                                 (self.database.decode('utf8'),
+                                  self.table.decode('utf8'), exc))
+            return kept
+        self._bound[columns] = keep_rows
+        return keep_rows
+
+
+def parse_where(spec):
+    """Parse a 'db.table:predicate' option value
+
+    :returns: Predicate instance
+    :raises: WhereError if spec is not valid
+    """
+    name, sep, text = spec.partition(':')
+    database, dot, table = name.partition('.')
+    if not sep or not dot or not database or not table or not text.strip():
+        raise WhereError("--where must be of the form 'db.table:predicate', "
+                         "got %r" % spec)
+    return Predicate(database.strip('`').encode('utf8'),
+                     table.strip('`').encode('utf8'),
+                     text)
+
+
+def parse_all(specs):
+    """Parse --where option values into a dict of (db, table) -> Predicate
+
+    Several predicates for the same table are combined with AND.
+    """
+    result = {}
+    for spec in specs or ():
+        predicate = parse_where(spec)
+        key = (predicate.database, predicate.table)
+        if key in result:
+            result[key].combine(predicate)
+        else:
+            result[key] = predicate
+    return result
+
+
+def table_columns(table_ddl):
+    """Find the column names defined by a CREATE TABLE statement"""
+    columns = []
+    for line in table_ddl.splitlines()[1:]:
+        match = COLUMN_CRE.match(line)
+        if match:
+            columns.extend(defer.parse_columns(match.group(1)))
+    return columns
+
+
+def filter_rows(lines, predicate, columns):
+    """Drop the rows of INSERT statements a predicate does not keep
+
+    INSERT statements with no remaining rows are dropped entirely and all
+    other lines are passed through unchanged.
+
+    :param lines: iterable of bytes lines from a tabledata section
+    :param predicate: Predicate instance
+    :param columns: column names from the table's CREATE TABLE, or None
+    :returns: iterator of bytes lines
+    """
+    for line in inserts.whole_statements(lines):
+        bounds = inserts.values_bounds(line)
+        if bounds is None:
+            yield line
+            continue
+        start, end = bounds
+        prefix = line[:start]
+        match = tab.INSERT_CRE.match(prefix)
+        if match and match.group('columns'):
+            keep_rows = predicate.bind(
+                defer.parse_columns(match.group('columns'))
+            )
+        elif columns:
+            keep_rows = predicate.bind(columns)
+        else:
+            raise WhereError("No table structure for %s.%s to resolve "
+                             "--where columns" %
+                             (predicate.database.decode('utf8'),
+                              predicate.table.decode('utf8')))
+        kept = keep_rows(line, start, end)
+        if kept:
+            yield prefix + b','.join(kept) + b';\n'
@@ -10,30 +10,82 @@ This API supports two modes for handling mysqldump output:
       filtering data)
     - directory, which splits a single mysqldump stream in a separate
       file per section (possibly transforming or filtering data)
+    - tab, which is like directory but writes table data to a separate
+      tab-delimited file per table, loaded via LOAD DATA LOCAL INFILE
+
+In directory mode, output may optionally be handed off to a pool of
+worker threads so that several compression commands run concurrently
+with the parser.
 """
 from __future__ import unicode_literals
 
+import contextlib
 import itertools
 import logging
 import os
+import re
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
+from dbsake import pycompat
 from dbsake.util import cmd
 
 from . import exc
+from . import tab
 
 debug = logging.debug
 info = logging.info
 
 
+def use_database(database):
+    """USE statement for a database name"""
+    return b'USE `' + database.replace(b'`', b'``') + b'`;\n'
+
+
 class SimpleWriter(object):
     def __init__(self, options, context):
         self.options = options
         self.context = context
         self.stream = options.output_stream
+        self._dump_header = b''
+        self._post_load = None
 
     def __call__(self, section):
-        for line in section.iterable:
-            self.stream.write(line)
+        if section.name == 'header':
+            section.iterable = list(section.iterable)
+            self._dump_header = b''.join(section.iterable)
+        if not section.passthrough(self.stream.write):
+            for line in section.iterable:
+                self.stream.write(line)
+        if section.name == 'tabledata':
+            self.write_post_load(section)
+
+    def write_post_load(self, section):
+        """Write DDL deferred to the post-load file"""
+        ddl = self.context.pop_post_load()
+        if not ddl:
+            return
+        if self._post_load is None:
+            self._post_load = open(self.options.post_load_file, 'wb')
+            self._post_load.write(self._dump_header)
+        if section.database:
+            self._post_load.write(use_database(section.database))
+        self._post_load.writelines(ddl)
+
+    def close(self, failed=False):
+        """Finish writing any pending output
+
+        :param failed: whether the run is failing with an exception that
+                       must not be replaced by an error of the writer
+        """
+        if self._post_load is not None:
+            self._post_load.write(session_footer(self._dump_header))
+            self._post_load.close()
+            self._post_load = None
 
 
 def command_to_ext(command):
@@ -58,27 +110,151 @@ def command_to_ext(command):
     arg0 = cmd.shlex_split(command)[0]
     arg0 = os.path.basename(arg0)
 
-    return known_exts.get(arg0, '')
+    return known_exts.get(arg0, b'')
+
+
+# header statements saving a session variable, e.g.:
+# /*!40014 SET @OLD_UNIQUE_CHECKS=@@UNIQUE_CHECKS, UNIQUE_CHECKS=0 */;
+SAVED_VARIABLE_CRE = re.compile(br'^(/\*!\d+ )?SET @(\w+)=@@(\w+)',
+                                re.MULTILINE)
+
+
+def session_footer(header):
+    """Build statements restoring the session variables saved by header
+
+    The mysqldump footer restores each variable its header saved in an
+    @OLD_* user variable.  This generates the equivalent footer for any
+    header, including the SQL_LOG_BIN setting added by --no-write-binlog.
+    """
+    lines = []
+    for version, saved, name in SAVED_VARIABLE_CRE.findall(header or b''):
+        statement = b'SET ' + name + b'=@' + saved
+        if version:
+            statement = version + statement + b' */'
+        lines.append(statement + b';\n')
+    lines.reverse()
+    return b''.join(lines)
+
+
+class ChunkedTableData(object):
+    """File-like object rotating INSERT statements into chunk files
+
+    INSERT statements are written to <table>.data-NNNNN.sql files of at
+    most ``options.chunk_size`` bytes or ``options.chunk_rows`` rows, each
+    with the dump header and a matching footer, so chunks can be loaded
+    concurrently.  Chunks rotate between INSERT statements, so a chunk may
+    exceed the limit by up to one statement.  Every other line of the
+    section (LOCK TABLES, deferred indexes, etc.) is written to
+    <table>.post.sql, to be loaded after all chunks.
+    """
+    def __init__(self, writer, section):
+        self.writer = writer
+        self.parts = [section.database, section.table]
+        self.max_bytes = writer.options.chunk_size
+        self.max_rows = writer.options.chunk_rows
+        self.footer = session_footer(writer._dump_header)
+        self.chunks = 0
+        self.stack = pycompat.ExitStack()
+        self.chunk_stack = None
+        self.chunk = None
+        self.post = None
+        # whether the next line continues a fragmented INSERT
+        self._continued = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self._close_chunk()
+        finally:
+            self.stack.close()
+
+    def _close_chunk(self):
+        if self.chunk is not None:
+            self.chunk.write(self.footer)
+            self.chunk = None
+            self.chunk_stack.close()
+
+    def _rotate(self):
+        self._close_chunk()
+        self.chunks += 1
+        self.size = self.rows = 0
+        self.chunk_stack = pycompat.ExitStack()
+        database, table = self.parts
+        name = table + ('.data-%05d.sql' % self.chunks).encode('ascii')
+        self.chunk = self.chunk_stack.enter_context(
+            self.writer._open([database, name], mode='wb')
+        )
+        self.chunk.write(self.writer._dump_header)
+
+    def write(self, line):
+        if self._continued:
+            # the rest of an INSERT read in fragments stays in its chunk
+            self._write_chunk(line)
+            return
+        if not line.startswith((b'INSERT ', b'REPLACE ')):
+            if self.post is None:
+                self.post = self.stack.enter_context(
+                    self.writer.open_post(*self.parts)
+                )
+            self.post.write(line)
+            return
+        if self.chunk is None or \
+                (self.max_bytes and self.size >= self.max_bytes) or \
+                (self.max_rows and self.rows >= self.max_rows):
+            self._rotate()
+        self._write_chunk(line)
+
+    def _write_chunk(self, line):
+        self.chunk.write(line)
+        self._continued = not line.endswith(b'\n')
+        self.size += len(line)
+        # rows are counted by their separators; a "),(" within a string
+        # only makes a chunk rotate early
+        self.rows += line.count(b'),(') + 1
 
 
 class DirectoryWriter(SimpleWriter):
     # track the first view, so we can initialize a file as needed
     first_view = False
     replication_info = False
+    # called with the path of each output file before it is opened and the
+    # checkpoint generation the file is opened in
+    on_open = None
+    # checkpoint generation of the output written from here on
+    generation = 0
 
-    def _open(self, parts, mode='ab'):
+    def __init__(self, options, context):
+        super(DirectoryWriter, self).__init__(options, context)
+        # <table>.post.sql files already started, by database
+        self._post_files = {}
+
+    def _opening(self, path, generation=None):
+        if self.on_open is not None:
+            if generation is None:
+                generation = self.generation
+            self.on_open(path, generation)
+
+    def _path(self, parts):
         basedir = self.options.directory.encode('utf8')
         path = os.path.join(basedir, *parts)
         dirname = os.path.dirname(path)
         if not os.path.exists(dirname):
             os.makedirs(dirname)
+        return path
+
+    def _open(self, parts, mode='ab'):
+        path = self._path(parts)
 
         if self.options.compress_command:
             ext = command_to_ext(self.options.compress_command)
             path += ext
+            self._opening(path)
             return cmd.stream_command(self.options.compress_command,
                                       stdout=open(path, mode))
         else:
+            self._opening(path)
             return open(path, mode)
 
     def open_header(self, section):
@@ -104,11 +280,32 @@ class DirectoryWriter(SimpleWriter):
         return self._open([section.database, section.table + b'.sql'],
                           mode='wb')
 
+    def _chunked(self):
+        return self.options.chunk_size or self.options.chunk_rows
+
+    @contextlib.contextmanager
+    def open_post(self, database, table):
+        """Open <table>.post.sql, loaded after all of a table's data"""
+        parts = [database, table + b'.post.sql']
+        started = self._post_files.setdefault(database, set())
+        if parts[1] in started:
+            with self._open(parts, mode='ab') as fileobj:
+                yield fileobj
+        else:
+            started.add(parts[1])
+            with self._open(parts, mode='wb') as fileobj:
+                fileobj.write(self._dump_header)
+                yield fileobj
+
     def open_tabledata(self, section):
+        if self._chunked():
+            return ChunkedTableData(self, section)
         return self._open([section.database, section.table + b'.sql'],
                           mode='ab')
 
     def open_triggers(self, section):
+        if self._chunked():
+            return self.open_post(section.database, section.table)
         return self._open([section.database, section.table + b'.sql'],
                           mode='ab')
 
@@ -149,12 +346,295 @@ class DirectoryWriter(SimpleWriter):
             info("Skipping section '%s'", section.name)
             dispatch = self.open_devnull
         with dispatch(section) as fileobj:
-            for line in section.iterable:
-                fileobj.write(line)
+            # chunk files are rotated between whole INSERT lines
+            if isinstance(fileobj, ChunkedTableData) or \
+                    not section.passthrough(fileobj.write):
+                for line in section.iterable:
+                    fileobj.write(line)
+        if section.name == 'tabledata':
+            self.write_post_load(section)
+
+    def write_post_load(self, section):
+        """Write DDL deferred to <table>.post.sql"""
+        ddl = self.context.pop_post_load()
+        if ddl:
+            with self.open_post(section.database, section.table) as fileobj:
+                for line in ddl:
+                    fileobj.write(line)
+
+    def barrier(self, generation):
+        """Start a new checkpoint generation for the output written next
+
+        :returns: callable returning True once all output written before
+                  the barrier is in its files
+        """
+        self.generation = generation
+        return lambda: True
+
+    def get_state(self):
+        """State needed to continue writing in another run"""
+        return dict(
+            dump_header=self._dump_header,
+            first_view=self.first_view,
+            replication_info=self.replication_info,
+            post_files=sorted((database, sorted(names))
+                              for database, names in self._post_files.items())
+        )
+
+    def set_state(self, state):
+        """Restore the state of get_state()"""
+        self._dump_header = state['dump_header']
+        self.first_view = state['first_view']
+        self.replication_info = state['replication_info']
+        self._post_files = dict((database, set(names))
+                                for database, names in state['post_files'])
+
+
+class PoolWorker(threading.Thread):
+    """Thread writing files requested by a WriterPool
+
+    Each worker processes its queue in order, so all writes for a path
+    routed to one worker are applied in the order they were submitted.
+    """
+    def __init__(self, pool, depth):
+        super(PoolWorker, self).__init__()
+        self.pool = pool
+        self.queue = queue.Queue(depth)
+        self.pending = 0
+        # number of items queued and processed, for WriterPool.barrier()
+        self.submitted = 0
+        self.completed = 0
+        self.daemon = True
+
+    def put(self, item):
+        if self.pool.error is not None:
+            raise self.pool.error
+        self.queue.put(item)
+        self.submitted += 1
+
+    def run(self):
+        # (stack, fileobj) of each path open on this worker; a writer may
+        # keep several files open at once, e.g. a chunk and its post file
+        files = {}
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            op, path = item[0], item[1]
+            try:
+                if self.pool.error is not None:
+                    # drain the queue so the parser never blocks on us
+                    continue
+                if op == 'open':
+                    if self.pool.on_open is not None:
+                        self.pool.on_open(path, item[3])
+                    stack = pycompat.ExitStack()
+                    files[path] = (stack, self.pool.open(stack, path,
+                                                         item[2]))
+                elif op == 'write':
+                    files[path][1].write(item[2])
+                elif op == 'close':
+                    stack, _ = files.pop(path)
+                    stack.close()
+            except Exception as error:
+                self.pool.error = error
+                for stack, _ in files.values():
+                    try:
+                        stack.close()
+                    except Exception:
+                        pass
+                files.clear()
+            finally:
+                if op == 'close':
+                    self.pool.release(path, self)
+                self.completed += 1
+
+
+class PooledFile(object):
+    """File-like object buffering writes for a single WriterPool path
+
+    Writes are batched into blocks of ``WriterPool.block_size`` bytes before
+    being queued for the worker that owns the path.
+    """
+    def __init__(self, pool, path, mode):
+        self.pool = pool
+        self.path = path
+        self.mode = mode
+        self.worker = None
+        self._buffer = []
+        self._size = 0
+
+    def __enter__(self):
+        self.worker = self.pool.acquire(self.path)
+        self.worker.put(('open', self.path, self.mode, self.pool.generation))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+        self.worker.put(('close', self.path))
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._size >= self.pool.block_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self.worker.put(('write', self.path, b''.join(self._buffer)))
+            del self._buffer[:]
+            self._size = 0
+
+
+class WriterPool(object):
+    """Bounded pool of threads writing (and compressing) output files
+
+    A path that still has queued work is always routed to the same worker
+    so output for a single file is never reordered.  New paths are given
+    to the worker with the least outstanding work.
+    """
+    block_size = 1024*1024
+
+    def __init__(self, size, compress_command=None, depth=8, on_open=None):
+        self.compress_command = compress_command
+        # called with each path and the checkpoint generation it was
+        # queued in, before the path is opened
+        self.on_open = on_open
+        self.generation = 0
+        self.error = None
+        self._lock = threading.Lock()
+        self._paths = {}
+        self.workers = [PoolWorker(self, depth) for _ in range(size)]
+        for worker in self.workers:
+            worker.start()
+
+    def open(self, stack, path, mode):
+        fileobj = stack.enter_context(open(path, mode))
+        if self.compress_command:
+            fileobj = stack.enter_context(
+                cmd.stream_command(self.compress_command, stdout=fileobj)
+            )
+        return fileobj
+
+    def acquire(self, path):
+        with self._lock:
+            if path in self._paths:
+                worker, count = self._paths[path]
+            else:
+                worker = min(self.workers,
+                             key=lambda w: (w.pending, w.queue.qsize()))
+                count = 0
+            self._paths[path] = (worker, count + 1)
+            worker.pending += 1
+        return worker
+
+    def release(self, path, worker):
+        with self._lock:
+            _, count = self._paths[path]
+            if count == 1:
+                del self._paths[path]
+            else:
+                self._paths[path] = (worker, count - 1)
+            worker.pending -= 1
+
+    def barrier(self, generation):
+        """Mark the work queued so far as belonging to a checkpoint
+
+        Files queued for opening from here on are reported as opened in
+        the checkpoint generation ``generation``.  Nothing waits for the
+        workers; they keep compressing while parsing continues.
+
+        :returns: callable returning True once every worker has processed
+                  the work queued before the barrier
+        """
+        self.generation = generation
+        marks = [(worker, worker.submitted) for worker in self.workers]
+
+        def done():
+            if self.error is not None:
+                raise self.error
+            return all(worker.completed >= submitted
+                       for worker, submitted in marks)
+        return done
+
+    def close(self, failed=False):
+        """Wait for the workers to finish their queued work
+
+        :param failed: whether the caller is failing with an exception
+                       already; a worker's error, often caused by that
+                       failure, is then logged rather than raised
+        """
+        for worker in self.workers:
+            worker.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        if self.error is not None:
+            if not failed:
+                raise self.error
+            debug("# Writer worker failed after an earlier error: %r",
+                  self.error)
+
+
+class ParallelDirectoryWriter(DirectoryWriter):
+    """DirectoryWriter that compresses files in a pool of workers
+
+    Parsing continues while up to ``options.jobs`` compression commands
+    process previously parsed sections.
+    """
+    def __init__(self, options, context):
+        super(ParallelDirectoryWriter, self).__init__(options, context)
+        self.pool = WriterPool(options.jobs, options.compress_command,
+                               on_open=self._opening)
+
+    def _open(self, parts, mode='ab'):
+        path = self._path(parts)
+        if self.options.compress_command:
+            path += command_to_ext(self.options.compress_command)
+        # the worker reports the path when it opens the file
+        return PooledFile(self.pool, path, mode)
+
+    def barrier(self, generation):
+        return self.pool.barrier(generation)
+
+    def close(self, failed=False):
+        self.pool.close(failed)
+
+
+class TabWriter(DirectoryWriter):
+    """DirectoryWriter that converts table data to LOAD DATA input
+
+    Rows from each tabledata section are written to <db>/<table>.txt and
+    the INSERT statements in <db>/<table>.sql are replaced by a
+    LOAD DATA LOCAL INFILE statement.  The data file path is relative to
+    the output directory.  Output is never compressed, as LOAD DATA
+    cannot read compressed files.
+    """
+    def _open(self, parts, mode='ab'):
+        path = self._path(parts)
+        self._opening(path)
+        return open(path, mode)
+
+    def _chunked(self):
+        return False
+
+    @contextlib.contextmanager
+    def open_tabledata(self, section):
+        parts = [section.database, section.table + b'.txt']
+        with self._open(parts, mode='wb') as data_file:
+            with self._open([section.database, section.table + b'.sql'],
+                            mode='ab') as fileobj:
+                section.iterable = tab.convert(
+                    section.iterable,
+                    data_file,
+                    path=b'/'.join(parts),
+                    charset=tab.client_charset(self._dump_header)
+                )
+                yield fileobj
 
 
 stream_writer = SimpleWriter
 directory_writer = DirectoryWriter
+tab_writer = TabWriter
 
 
 def load(options, context):
@@ -163,4 +643,7 @@ def load(options, context):
     except KeyError:
         raise exc.SieveError("Invalid format '%s'" % options.output_format)
 
+    if cls is DirectoryWriter and options.jobs > 1:
+        cls = ParallelDirectoryWriter
+
     return cls(options, context)
@@ -8,11 +8,10 @@ Support for unpacking various MySQL datasources
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import fnmatch
 import logging
-import re
 
 from dbsake.util import compression
+from dbsake.util import matcher
 
 from . import common
 from . import tar
@@ -26,48 +25,16 @@ debug = logging.debug
 def inclusion_exclusion_filter(include=(), exclude=(), mode='glob'):
     """Create an inclusion exclusion filter
 
+    If inclusion patterns are specified and no patterns are matched, the
+    filter returns ``True``.  If an exclusion pattern is matched, the
+    matched pattern is returned as a true value.  Otherwise the filter
+    returns ``False``, indicating the name was not excluded.
+
     :param include: sequence of regex patterns to include
     :param exclude: sequence of regex patterns to exclude
-    :returns: function(name) that filters strings based on the provided filters
+    :returns: TableMatcher that filters strings based on the provided filters
     """
-    if mode == 'glob':
-        re_include = [fnmatch.translate(pat) for pat in include]
-        re_exclude = [fnmatch.translate(pat) for pat in exclude]
-    elif mode != 'regex':
-        raise ValueError("only 'glob' or 'regex' filters are supported")
-    else:
-        re_include = include
-        re_exclude = exclude
-
-    re_include = [re.compile(pat) for pat in re_include]
-    re_exclude = [re.compile(pat) for pat in re_exclude]
-
-    def apply_filter(name):
-        """Apply a filter to ``name``
-
-        If inclusion patterns are specified and no patterns are
-        matched, the value will be excluded and this function
-        returns ``True``.
-
-        If no inclusion patterns are specified all values will
-        be included unless some exclusion pattern is matched.
-
-        If an exclusion pattern is matched, the matched pattern
-        will be returned as true value.
-
-        If no exclusion patterns were matched, ``False`` is returned
-        indicating the value was not excluded
-
-        :param name: string value to filter
-        :returns: true value if filtered, False otherwise
-        """
-        if re_include and not any(pat.match(name) for pat in re_include):
-            return True
-        for idx, pattern in enumerate(re_exclude):
-            if pattern.match(name):
-                return exclude[idx]
-        return False
-    return apply_filter
+    return matcher.TableMatcher(include, exclude, mode)
 
 
 def load_unpacker(stream):
@@ -9,14 +9,22 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import bz2
 import contextlib
 import errno
+import fcntl
 import io
 import os
 import stat
 import sys
 import threading
 import time
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
 
 from dbsake import pycompat
 
@@ -40,6 +48,113 @@ COMPRESSION_MAGIC = {
 }
 
 
+# Linux allows resizing pipe buffers; larger buffers mean fewer wakeups
+# between ProxyStream and its reader.  Unprivileged processes may grow a
+# pipe up to /proc/sys/fs/pipe-max-size (1MiB by default)
+PIPE_SIZE = 1024*1024
+
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ',
+                       1031 if sys.platform.startswith('linux') else None)
+
+
+def set_pipe_size(fd, size=PIPE_SIZE):
+    """Try to resize the buffer of the pipe fd
+
+    :returns: True if the pipe was resized, False otherwise
+    """
+    if F_SETPIPE_SZ is None:
+        return False
+    try:
+        fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def gzip_decompressor():
+    """Create a zlib decompressor accepting gzip formatted input"""
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+# extension -> decompression methods in order of preference
+# strings are external commands, callables create an in-process
+# decompressor.  Parallel external tools are preferred, then in-process
+# decompression which avoids piping data through another process.
+DECOMPRESSION_METHODS = {
+    '.gz': ('pigz', gzip_decompressor, 'gzip'),
+    '.bz2': ('pbzip2', 'lbzip2', bz2.BZ2Decompressor, 'bzip2'),
+    '.lzo': ('lzop',),
+    '.xz': ('pxz',) + ((lzma.LZMADecompressor,) if lzma else ()) + ('xz',),
+}
+
+
+class DecompressionError(Exception):
+    """Raised if in-process decompression of a stream fails"""
+
+
+def _member_ended(decompressor):
+    """Check whether decompressor has read the end of its member
+
+    Python 2.7's zlib and bz2 decompressors have no eof attribute.  Once
+    their member has ended, zlib leaves any further input in unused_data
+    and bz2 raises EOFError, so a probe byte tells whether the end was
+    reached.  The decompressor must not be used for more input afterwards.
+    """
+    try:
+        return decompressor.eof
+    except AttributeError:
+        pass
+    try:
+        decompressor.decompress(b'\0')
+    except EOFError:
+        return True
+    except (IOError, ValueError, zlib.error):
+        return False
+    return bool(decompressor.unused_data)
+
+
+class StreamDecompressor(object):
+    """Incrementally decompress a stream of one or more compressed members
+
+    gzip, bzip2 and xz all allow several compressed streams to be
+    concatenated (as pigz and pbzip2 produce), so a new decompressor is
+    started whenever one reaches the end of its member.
+
+    :param factory: callable returning a new zlib/bz2/lzma decompressor
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self.decompressor = factory()
+        self.finished = False
+
+    def decompress(self, data):
+        result = []
+        while data:
+            if self.finished:
+                self.decompressor = self.factory()
+                self.finished = False
+            try:
+                result.append(self.decompressor.decompress(data))
+            except EOFError as exc:
+                if hasattr(self.decompressor, 'eof'):
+                    raise DecompressionError(str(exc))
+                # python 2.7 bz2: the member ended with the previous data
+                self.finished = True
+                continue
+            except (IOError, ValueError, zlib.error) as exc:
+                raise DecompressionError(str(exc))
+            data = self.decompressor.unused_data
+            self.finished = (getattr(self.decompressor, 'eof', False) or
+                             bool(data))
+        return b''.join(result)
+
+    def flush(self):
+        if not self.finished and not _member_ended(self.decompressor):
+            raise DecompressionError("Compressed input ended unexpectedly")
+        self.finished = True
+        return b''
+
+
 def is_seekable(stream):
     """Determine if a stream is seekable"""
     mode = os.fstat(stream.fileno()).st_mode
@@ -118,20 +233,36 @@ def progress_bar(maxsize, width=25):
 
 
 class ProxyStream(threading.Thread):
+    """Copy a stream into a pipe from a background thread
+
+    Bytes read from the input are reported to ``widget`` for progress
+    reporting.  If ``decompressor`` is provided, it is called to create
+    a zlib/bz2/lzma style decompressor and data is decompressed in this
+    thread before being written to the pipe.
+
+    On Linux, a file backed input is moved into the pipe with splice(2)
+    or sendfile(2) so the data never has to be copied through python.
+    """
     def __init__(self,
                  stream,
                  widget=None,
                  interval=0.5,
-                 block_size=io.DEFAULT_BUFFER_SIZE):
+                 block_size=io.DEFAULT_BUFFER_SIZE,
+                 decompressor=None):
         super(ProxyStream, self).__init__()
         self.stream = stream
         self.widget = widget
         self.interval = interval
         rd, wr = os.pipe()
+        set_pipe_size(wr)
         self.rd = rd
         self.wr = os.fdopen(wr, 'wb')
         self.block_size = block_size
+        self.decompressor = decompressor
+        self.error = None
         self.daemon = True
+        self._nbytes = 0
+        self._last_update = 0
 
     def __enter__(self):
         self.start()
@@ -141,37 +272,105 @@ class ProxyStream(threading.Thread):
         os.close(self.rd)
         self.join()
         self.wr.close()
+        if self.error is not None and exc_type is None:
+            raise self.error
 
     def fileno(self):
         return self.rd
 
-    def run(self):
-        widget = self.widget
-        interval = self.interval
+    def _update(self, n):
+        """Report n bytes read to the widget, at most once per interval"""
+        self._nbytes += n
+        now = time.time()
+        if (now - self._last_update) > self.interval:
+            self.widget(self._nbytes)
+            self._last_update = now
+            self._nbytes = 0
+
+    def _zero_copy_fd(self):
+        """Find the input fd if it can be spliced directly into the pipe
+
+        :returns: file descriptor or None if data must be copied
+        """
+        if self.decompressor is not None:
+            return None
+        if not isinstance(getattr(self.stream, 'raw', self.stream),
+                          io.FileIO):
+            return None
+        fd = self.stream.fileno()
+        if hasattr(os, 'splice'):
+            return fd
+        if hasattr(os, 'sendfile') and stat.S_ISREG(os.fstat(fd).st_mode):
+            return fd
+        return None
+
+    def _move(self, fd):
+        """Move data from fd into the pipe with splice or sendfile
+
+        :returns: False if the kernel does not support moving data between
+                  these file descriptors and nothing was written
+        """
+        # write out anything already buffered by an earlier peek()
+        if hasattr(self.stream, 'peek'):
+            pending = self.stream.read(len(self.stream.peek(1)))
+            self.wr.write(pending)
+            self.wr.flush()
+            if self.widget:
+                self._update(len(pending))
+        out = self.wr.fileno()
+        if hasattr(os, 'splice'):
+            def move():
+                return os.splice(fd, out, PIPE_SIZE)
+        else:
+            def move():
+                return os.sendfile(out, fd, None, PIPE_SIZE)
+        try:
+            n = move()
+        except OSError as exc:
+            if exc.errno in (errno.EINVAL, errno.ENOSYS):
+                return False
+            raise
+        while n:
+            if self.widget:
+                self._update(n)
+            n = move()
+        return True
+
+    def _copy(self):
+        """Copy blocks read from the input into the pipe"""
         read = self.stream.read
         write = self.wr.write
         block_size = self.block_size
-        last_update = 0
-        n = 0
 
-        try:
-            block = read(block_size)
-            while block:
+        decompressor = None
+        if self.decompressor is not None:
+            decompressor = StreamDecompressor(self.decompressor)
+
+        block = read(block_size)
+        while block:
+            if decompressor is not None:
+                write(decompressor.decompress(block))
+            else:
                 write(block)
-                if widget:
-                    n += len(block)
-                    now = time.time()
-                    if (now - last_update) > interval:
-                        widget(n)
-                        last_update = now
-                        n = 0
-                block = read(block_size)
-            if widget:
-                widget(n)
-                widget(0)
+            if self.widget:
+                self._update(len(block))
+            block = read(block_size)
+        if decompressor is not None:
+            decompressor.flush()
+
+    def run(self):
+        try:
+            fd = self._zero_copy_fd()
+            if fd is None or not self._move(fd):
+                self._copy()
+            if self.widget:
+                self.widget(self._nbytes)
+                self.widget(0)
         except IOError as exc:
             if exc.errno != errno.EPIPE:
                 raise
+        except DecompressionError as exc:
+            self.error = exc
         finally:
             try:
                 self.wr.close()
@@ -233,8 +432,45 @@ def filetype_to_command(ext):
                   (ext,))
 
 
+def decompression_method(ext, method='auto'):
+    """Given a filetype extension, select how it should be decompressed
+
+    Methods are tried in the order listed in ``DECOMPRESSION_METHODS``
+    and the first available one is returned.
+
+    :param ext: compression extension
+    :param method: 'auto' to select the fastest available method, 'command'
+                   to only consider external commands or 'python' to only
+                   consider in-process decompression
+    :returns: command name, decompressor factory or None if ext is not a
+              known compression extension
+    :raises: OSError if no method is available for ext
+    """
+    if method not in ('auto', 'command', 'python'):
+        raise ValueError("Unknown decompression method '%s'" % method)
+
+    try:
+        candidates = DECOMPRESSION_METHODS[ext]
+    except KeyError:
+        return None
+
+    for candidate in candidates:
+        if callable(candidate):
+            if method != 'command':
+                return candidate
+        elif method != 'python' and pycompat.which(candidate):
+            return candidate
+
+    raise OSError("Unable to find decompression method for extension '%s'" %
+                  (ext,))
+
+
 @contextlib.contextmanager
-def decompressed(stream, report_progress=False, sizehint=None, filetype=None):
+def decompressed(stream,
+                 report_progress=False,
+                 sizehint=None,
+                 filetype=None,
+                 method='auto'):
     """Context manager to decompress a stream of bytes.
 
     Note: This method will convert a stream to an io.BufferedReader() instance
@@ -254,6 +490,9 @@ def decompressed(stream, report_progress=False, sizehint=None, filetype=None):
                      This should be a compression extension:
                      .gz, .bz2, .lzo, .xz
                      If not provided, it will be looked up.
+    :param method: (optional) restrict decompression to external commands
+                   ('command') or in-process decompression ('python').
+                   Defaults to 'auto', see ``decompression_method``.
     """
     # convert to a BufferedReader
     # note: closefd=False because we assume called is managing stream lifetime
@@ -263,9 +502,7 @@ def decompressed(stream, report_progress=False, sizehint=None, filetype=None):
     if filetype is None:
         stream = io.open(stream.fileno(), 'rb', closefd=False)
         filetype = detect_filetype(stream)
-    command = filetype_to_command(filetype)
-    if command is not None:
-        command += ' -dc'
+    decompressor = decompression_method(filetype, method)
     if report_progress and (sizehint or is_seekable(stream)):
         streamsize = sizehint or os.fstat(stream.fileno()).st_size
         widget = progress_bar(streamsize)
@@ -275,7 +512,14 @@ def decompressed(stream, report_progress=False, sizehint=None, filetype=None):
         widget = None
 
     with pycompat.ExitStack() as es:
-        stream = es.enter_context(ProxyStream(stream, widget))
-        if filetype is not None:
-            stream = es.enter_context(cmd.piped_stdout(command, stdin=stream))
+        if callable(decompressor):
+            stream = es.enter_context(ProxyStream(stream, widget,
+                                                  block_size=64*1024,
+                                                  decompressor=decompressor))
+        else:
+            stream = es.enter_context(ProxyStream(stream, widget))
+            if decompressor is not None:
+                command = decompressor + ' -dc'
+                stream = es.enter_context(cmd.piped_stdout(command,
+                                                           stdin=stream))
         yield io.open(stream.fileno(), 'rb', closefd=False)
@@ -24,6 +24,26 @@ def filesize(value):
         return '%.1f%s' % ((base * bytes / unit), prefix)
 
 
+def parse_filesize(value):
+    """Convert a size string such as 512K or 16M to a number of bytes
+
+    Suffixes are binary multiples (K = 1024) and are case-insensitive.
+
+    :raises: ValueError if value is not a valid size
+    """
+    value = value.strip().upper()
+    if value.endswith('B'):
+        value = value[:-1]
+    multiplier = 1
+    if value and value[-1] in "KMGTPEZY":
+        multiplier = 1024 ** ("KMGTPEZY".index(value[-1]) + 1)
+        value = value[:-1]
+    size = int(float(value) * multiplier)
+    if size < 0:
+        raise ValueError("Size must not be negative")
+    return size
+
+
 def timespan(seconds):
     """Convert a number of seconds to a human friendly string"""
     units = [
@@ -0,0 +1,454 @@
+"""
+dbsake.util.gzindex
+~~~~~~~~~~~~~~~~~~~
+
+Random access to gzip files through an index of access points
+
+A gzip file can normally only be decompressed from its start.  An access
+point records where a deflate block starts in the compressed file, the
+uncompressed offset of its first byte and the 32KiB of output preceding
+it, which is all inflate needs to resume decompression at that block.
+This is the approach of zlib's examples/zran.c.
+
+python's zlib module can neither stop at deflate block boundaries nor
+resume at a bit offset within a byte, so libz is called through ctypes.
+"""
+from __future__ import division
+
+import bisect
+import collections
+import ctypes
+import ctypes.util
+import io
+import os
+import struct
+import zlib
+
+from . import compression
+
+# output history inflate needs to resume decompression
+WINDOW_SIZE = 32*1024
+
+# default uncompressed distance between access points
+DEFAULT_SPAN = 16*1024*1024
+
+# compressed bytes read at a time and uncompressed bytes inflated per call
+INPUT_SIZE = 256*1024
+OUTPUT_SIZE = 256*1024
+
+Z_OK = 0
+Z_STREAM_END = 1
+Z_BUF_ERROR = -5
+Z_BLOCK = 5
+
+# window bits for raw deflate data and for data with a gzip header
+RAW_WBITS = -15
+GZIP_WBITS = 16 + 15
+
+# length of the crc32 and size trailing each gzip member
+GZIP_TRAILER_SIZE = 8
+
+INDEX_MAGIC = b'DBSKGZX1'
+
+# magic, compressed size, compressed mtime, uncompressed size, span
+INDEX_HEADER = struct.Struct(b'<8sQQQQ')
+
+# uncompressed offset, compressed offset, bits, window length
+INDEX_POINT = struct.Struct(b'<QQBI')
+
+
+class GzipIndexError(Exception):
+    """Raised when an index cannot be read or used"""
+
+
+# window is the zlib compressed output preceding offset.  bits is the
+# number of bits of the byte before compressed_offset that belong to the
+# block starting there.
+AccessPoint = collections.namedtuple('AccessPoint',
+                                     'offset compressed_offset bits window')
+
+GzipIndex = collections.namedtuple('GzipIndex',
+                                   'size mtime length span points')
+
+
+class z_stream(ctypes.Structure):
+    _fields_ = [
+        ('next_in', ctypes.c_void_p),
+        ('avail_in', ctypes.c_uint),
+        ('total_in', ctypes.c_ulong),
+        ('next_out', ctypes.c_void_p),
+        ('avail_out', ctypes.c_uint),
+        ('total_out', ctypes.c_ulong),
+        ('msg', ctypes.c_char_p),
+        ('state', ctypes.c_void_p),
+        ('zalloc', ctypes.c_void_p),
+        ('zfree', ctypes.c_void_p),
+        ('opaque', ctypes.c_void_p),
+        ('data_type', ctypes.c_int),
+        ('adler', ctypes.c_ulong),
+        ('reserved', ctypes.c_ulong),
+    ]
+
+
+_libz = []
+
+
+def libz():
+    """Load libz on first use
+
+    :returns: ctypes.CDLL instance or None if libz cannot be loaded
+    """
+    if not _libz:
+        lib = None
+        path = ctypes.util.find_library('z')
+        if path is not None:
+            try:
+                lib = ctypes.CDLL(path)
+            except OSError:
+                lib = None
+        if lib is not None:
+            stream_p = ctypes.POINTER(z_stream)
+            lib.zlibVersion.restype = ctypes.c_char_p
+            lib.inflateInit2_.argtypes = [stream_p, ctypes.c_int,
+                                          ctypes.c_char_p, ctypes.c_int]
+            lib.inflate.argtypes = [stream_p, ctypes.c_int]
+            lib.inflateEnd.argtypes = [stream_p]
+            lib.inflatePrime.argtypes = [stream_p, ctypes.c_int,
+                                         ctypes.c_int]
+            lib.inflateSetDictionary.argtypes = [stream_p, ctypes.c_char_p,
+                                                 ctypes.c_uint]
+        _libz.append(lib)
+    return _libz[0]
+
+
+def available():
+    """Check whether gzip files can be indexed on this system"""
+    return libz() is not None
+
+
+class Inflater(object):
+    """libz inflate stream
+
+    :param wbits: RAW_WBITS or GZIP_WBITS
+    """
+    def __init__(self, wbits):
+        self.lib = libz()
+        if self.lib is None:
+            raise GzipIndexError("libz is not available")
+        self.raw = wbits < 0
+        self.stream = z_stream()
+        self.ref = ctypes.byref(self.stream)
+        ret = self.lib.inflateInit2_(self.ref, wbits, self.lib.zlibVersion(),
+                                     ctypes.sizeof(self.stream))
+        if ret != Z_OK:
+            raise GzipIndexError("Failed to initialize inflate (%d)" % ret)
+
+    def prime(self, bits, value):
+        self.lib.inflatePrime(self.ref, bits, value)
+
+    def set_dictionary(self, window):
+        self.lib.inflateSetDictionary(self.ref, window, len(window))
+
+    def inflate(self, flush=Z_BLOCK):
+        ret = self.lib.inflate(self.ref, flush)
+        if ret not in (Z_OK, Z_STREAM_END, Z_BUF_ERROR):
+            msg = self.stream.msg
+            if msg is not None:
+                msg = msg.decode('ascii', 'replace')
+            raise compression.DecompressionError(
+                "Invalid gzip data (%s)" % (msg or ret)
+            )
+        return ret
+
+    def close(self):
+        if self.stream is not None:
+            self.lib.inflateEnd(self.ref)
+            self.stream = self.ref = None
+
+
+class GzipReader(io.RawIOBase):
+    """Raw binary stream of the decompressed contents of a gzip file
+
+    Concatenated gzip members are read as one stream.  seek() resumes
+    decompression at the nearest access point of ``index`` before the
+    target, or at the start of the file without an index.
+
+    If ``span`` is given, access points at least span bytes apart are
+    recorded while the file is read from its start and are available from
+    ``points`` and ``build_index()`` once the whole file has been read.
+
+    :param fileobj: seekable binary file object of the gzip file
+    :param index: optional GzipIndex for fileobj
+    :param span: optional uncompressed distance between recorded points
+    """
+    def __init__(self, fileobj, index=None, span=None):
+        self.fileobj = fileobj
+        self.index = index
+        self.span = span
+        self.points = []
+        self.position = 0
+        self.inflater = None
+        self._input = ctypes.create_string_buffer(INPUT_SIZE)
+        self._output = ctypes.create_string_buffer(OUTPUT_SIZE)
+        self._input_address = ctypes.addressof(self._input)
+        self._output_address = ctypes.addressof(self._output)
+        self._offsets = [point.offset for point in index.points] \
+            if index else []
+        self._restart()
+
+    def _reset(self, wbits, compressed_offset, offset, history):
+        if self.inflater is not None:
+            self.inflater.close()
+        self.inflater = Inflater(wbits)
+        # file offset after the last compressed data read
+        self._compressed_offset = compressed_offset
+        # uncompressed offset of self._output[0]
+        self._output_offset = offset
+        # unread output is self._output[self._start:self._end]
+        self._start = self._end = 0
+        # up to WINDOW_SIZE bytes of output preceding self._output
+        self._history = history
+        # whether the current gzip member has ended
+        self._finished = False
+        self._trailer = 0
+        self.position = offset
+
+    def _restart(self):
+        self.fileobj.seek(0)
+        self._reset(GZIP_WBITS, 0, 0, b'')
+
+    def _resume(self, point):
+        """Start inflating at an access point"""
+        self.fileobj.seek(point.compressed_offset - (1 if point.bits else 0))
+        value = None
+        if point.bits:
+            value = bytearray(self.fileobj.read(1))[0]
+        window = zlib.decompress(point.window)
+        self._reset(RAW_WBITS, point.compressed_offset, point.offset, window)
+        if value is not None:
+            self.inflater.prime(point.bits, value >> (8 - point.bits))
+        if window:
+            self.inflater.set_dictionary(window)
+        # points are only recorded on a read from the start of the file
+        self.span = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if self.inflater is not None:
+            self.inflater.close()
+            self.inflater = None
+        super(GzipReader, self).close()
+
+    def _window(self):
+        """Last WINDOW_SIZE bytes of output up to self._end"""
+        end = self._end
+        if end >= WINDOW_SIZE:
+            return self._output[end - WINDOW_SIZE:end]
+        start = max(0, len(self._history) - WINDOW_SIZE + end)
+        return self._history[start:] + self._output[:end]
+
+    def _add_point(self, bits):
+        offset = self._output_offset + self._end
+        if self.points and offset - self.points[-1].offset < self.span:
+            return
+        compressed_offset = (self._compressed_offset -
+                             self.inflater.stream.avail_in)
+        self.points.append(AccessPoint(offset,
+                                       compressed_offset,
+                                       bits,
+                                       zlib.compress(self._window(), 1)))
+
+    def _fill(self):
+        """Inflate more output into the empty output buffer
+
+        :returns: False at the end of the input, otherwise True
+        """
+        if self._end == OUTPUT_SIZE:
+            if self.span is not None:
+                self._history = self._output[OUTPUT_SIZE - WINDOW_SIZE:]
+            self._output_offset += self._end
+            self._start = self._end = 0
+        stream = self.inflater.stream
+        while True:
+            if not stream.avail_in:
+                size = self.fileobj.readinto(self._input)
+                if not size:
+                    if not self._finished:
+                        raise compression.DecompressionError(
+                            "Compressed input ended unexpectedly"
+                        )
+                    return False
+                self._compressed_offset += size
+                stream.next_in = self._input_address
+                stream.avail_in = size
+            if self._finished:
+                if self._trailer:
+                    # a raw inflate ends before the member's trailer
+                    skip = min(self._trailer, stream.avail_in)
+                    stream.next_in += skip
+                    stream.avail_in -= skip
+                    self._trailer -= skip
+                    continue
+                # another gzip member follows
+                next_in, avail_in = stream.next_in, stream.avail_in
+                self.inflater.close()
+                self.inflater = Inflater(GZIP_WBITS)
+                stream = self.inflater.stream
+                stream.next_in, stream.avail_in = next_in, avail_in
+                self._finished = False
+            stream.next_out = self._output_address + self._end
+            stream.avail_out = OUTPUT_SIZE - self._end
+            ret = self.inflater.inflate()
+            produced = OUTPUT_SIZE - self._end - stream.avail_out
+            self._end += produced
+            if ret == Z_STREAM_END:
+                self._finished = True
+                if self.inflater.raw:
+                    self._trailer = GZIP_TRAILER_SIZE
+            elif self.span is not None and stream.data_type & 128 and \
+                    not stream.data_type & 64:
+                # at the end of a block other than the last
+                self._add_point(stream.data_type & 7)
+            if produced:
+                return True
+
+    def readinto(self, b):
+        if self._start == self._end and not self._fill():
+            return 0
+        size = min(len(b), self._end - self._start)
+        b[:size] = self._output[self._start:self._start + size]
+        self._start += size
+        self.position += size
+        return size
+
+    def _nearest_point(self, offset):
+        """Last access point at or before offset, if any"""
+        idx = bisect.bisect_right(self._offsets, offset)
+        if idx == 0:
+            return None
+        return self.index.points[idx - 1]
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            if self.index is None:
+                raise io.UnsupportedOperation("Cannot seek from the end of "
+                                              "a gzip file without an index")
+            offset += self.index.length
+        if offset < 0:
+            raise ValueError("Negative seek position %d" % offset)
+        if offset == self.position:
+            return offset
+        if self._output_offset <= offset <= self._output_offset + self._end:
+            # still in the output buffer
+            self._start = offset - self._output_offset
+            self.position = offset
+            return offset
+        point = self._nearest_point(offset)
+        start = point.offset if point else 0
+        if not start <= self.position <= offset:
+            if point is None:
+                self._restart()
+            else:
+                self._resume(point)
+        while self.position < offset:
+            if self._start == self._end and not self._fill():
+                break
+            size = min(offset - self.position, self._end - self._start)
+            self._start += size
+            self.position += size
+        return self.position
+
+    def build_index(self, size, mtime=0):
+        """Create a GzipIndex from the points recorded by a complete read
+
+        :param size: size of the gzip file
+        :param mtime: modification time of the gzip file, if known
+        """
+        return GzipIndex(size, int(mtime), self.position, self.span,
+                         self.points)
+
+
+def sidecar_path(path):
+    """Default location of the gzip index for a gzip file"""
+    return path + '.gzidx'
+
+
+def build(fileobj, span=DEFAULT_SPAN):
+    """Read a gzip file and index its access points
+
+    :param fileobj: seekable binary file object of a gzip file
+    :param span: uncompressed distance between access points
+    :returns: GzipIndex instance
+    """
+    reader = GzipReader(fileobj, span=span)
+    try:
+        while reader.read(OUTPUT_SIZE):
+            pass
+    finally:
+        reader.close()
+    info = os.fstat(fileobj.fileno())
+    return reader.build_index(info.st_size, info.st_mtime)
+
+
+def matches(gz_index, fileobj):
+    """Check whether an index was built for the current contents of fileobj
+    """
+    info = os.fstat(fileobj.fileno())
+    return (gz_index.size == info.st_size and
+            (not gz_index.mtime or gz_index.mtime == int(info.st_mtime)))
+
+
+def write_index(path, gz_index):
+    """Write a GzipIndex to path"""
+    with open(path, 'wb') as fileobj:
+        fileobj.write(INDEX_HEADER.pack(INDEX_MAGIC,
+                                        gz_index.size,
+                                        gz_index.mtime,
+                                        gz_index.length,
+                                        gz_index.span))
+        for point in gz_index.points:
+            fileobj.write(INDEX_POINT.pack(point.offset,
+                                           point.compressed_offset,
+                                           point.bits,
+                                           len(point.window)))
+            fileobj.write(point.window)
+
+
+def read_index(path):
+    """Read an index previously written by write_index()
+
+    :returns: GzipIndex instance
+    :raises: GzipIndexError if path is not a valid index
+    """
+    with open(path, 'rb') as fileobj:
+        header = fileobj.read(INDEX_HEADER.size)
+        if len(header) != INDEX_HEADER.size:
+            raise GzipIndexError("Truncated gzip index '%s'" % path)
+        magic, size, mtime, length, span = INDEX_HEADER.unpack(header)
+        if magic != INDEX_MAGIC:
+            raise GzipIndexError("'%s' is not a gzip index" % path)
+        points = []
+        while True:
+            data = fileobj.read(INDEX_POINT.size)
+            if not data:
+                break
+            if len(data) != INDEX_POINT.size:
+                raise GzipIndexError("Truncated gzip index '%s'" % path)
+            offset, compressed_offset, bits, window_length = \
+                INDEX_POINT.unpack(data)
+            window = fileobj.read(window_length)
+            if len(window) != window_length:
+                raise GzipIndexError("Truncated gzip index '%s'" % path)
+            points.append(AccessPoint(offset, compressed_offset, bits,
+                                      window))
+    return GzipIndex(size, mtime, length, span, points)
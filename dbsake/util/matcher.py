@@ -0,0 +1,133 @@
+"""
+dbsake.util.matcher
+~~~~~~~~~~~~~~~~~~~
+
+Inclusion / exclusion filtering of database.table names
+
+"""
+from __future__ import unicode_literals
+
+import collections
+import fnmatch
+import logging
+import re
+
+debug = logging.debug
+
+
+class LRUCache(object):
+    """Mapping that keeps only the most recently used ``size`` keys"""
+    def __init__(self, size):
+        self.size = size
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        if len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+
+def compile_patterns(patterns, mode='glob'):
+    """Compile a sequence of patterns into a single regular expression
+
+    :param patterns: sequence of glob or regex patterns
+    :param mode: 'glob' or 'regex'
+    :returns: compiled regex object or None if patterns is empty
+    """
+    if mode == 'glob':
+        patterns = [fnmatch.translate(pat) for pat in patterns]
+    elif mode != 'regex':
+        raise ValueError("only 'glob' or 'regex' filters are supported")
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:%s)' % pat for pat in patterns))
+
+
+class TableMatcher(object):
+    """Decide whether names are filtered by inclusion / exclusion patterns
+
+    All patterns of each kind are combined into one regular expression, so a
+    name is tested with a single match per kind, and decisions are cached
+    for the ``cache_size`` most recently seen names.
+
+    A name is filtered if inclusion patterns were specified and none
+    match, or if any exclusion pattern matches.  For an excluded name,
+    the first exclusion pattern matched is returned as the true value.
+
+    :param include: sequence of patterns to include
+    :param exclude: sequence of patterns to exclude
+    :param mode: 'glob' (default) or 'regex'
+    :param cache_size: number of decisions to cache
+    """
+    def __init__(self, include=(), exclude=(), mode='glob', cache_size=4096):
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        self.mode = mode
+        self._include = compile_patterns(self.include, mode)
+        self._exclude = compile_patterns(self.exclude, mode)
+        self._cache = LRUCache(cache_size)
+
+    def __bool__(self):
+        return bool(self.include or self.exclude)
+    # python 2.x shim
+    __nonzero__ = __bool__
+
+    def _match_exclude(self, name):
+        for pattern in self.exclude:
+            if compile_patterns([pattern], self.mode).match(name):
+                return pattern
+        return True
+
+    def _decide(self, name):
+        if self._include is not None and not self._include.match(name):
+            debug("# '%s' did not match any inclusion pattern. Filtering.",
+                  name)
+            return True
+        if self._exclude is not None and self._exclude.match(name):
+            pattern = self._match_exclude(name)
+            debug("# '%s' matched table exclusion pattern %s. Filtering",
+                  name, pattern)
+            return pattern
+        return False
+
+    def __call__(self, name):
+        """Check whether name is filtered
+
+        :param name: qualified database.table name
+        :returns: true value if filtered, False otherwise
+        """
+        result = self._cache.get(name)
+        if result is None:
+            result = self._decide(name)
+            self._cache[name] = result
+        return result
+
+    def table(self, database, table):
+        """Check whether a database and table are filtered
+
+        Decisions are cached by (database, table), so a name is only joined
+        and decoded the first time it is seen.
+
+        :param database: bytes database name
+        :param table: bytes table name, may be None
+        :returns: true value if filtered, False otherwise
+        """
+        key = (database, table)
+        result = self._cache.get(key)
+        if result is None:
+            name = b'.'.join([database or b'', table or b''])
+            result = self._decide(name.decode('utf-8'))
+            self._cache[key] = result
+        return result
@@ -0,0 +1,92 @@
+"""
+Test load command
+"""
+from __future__ import unicode_literals
+
+import gzip
+import hashlib
+import os
+import sys
+
+from click.testing import CliRunner
+
+from dbsake.cli.cmd.load import load_cli
+from dbsake.cli.cmd.sieve import sieve_cli
+from dbsake.core.mysql import load
+
+# stand-in for the mysql client, recording what it was asked to load
+FAKE_CLIENT = '''
+import hashlib, sys
+data = getattr(sys.stdin, 'buffer', sys.stdin).read()
+with open(sys.argv[1], 'a') as fileobj:
+    fileobj.write('%s %s\\n' % (sys.argv[2], hashlib.md5(data).hexdigest()))
+'''
+
+
+def test_load_directory():
+    runner = CliRunner()
+    sakila_path = os.path.join(os.path.dirname(__file__), 'sakila.sql.gz')
+    with runner.isolated_filesystem():
+        result = runner.invoke(sieve_cli, ['--format=directory',
+                                           '--input-file=' + sakila_path,
+                                           '--directory=out'], obj={})
+        assert result.exit_code == 0
+        with open('client.py', 'w') as fileobj:
+            fileobj.write(FAKE_CLIENT)
+        log_path = os.path.abspath('client.log')
+        command = '%s %s %s' % (sys.executable,
+                                os.path.abspath('client.py'),
+                                log_path)
+        result = runner.invoke(load_cli, ['-C', 'out', '-j', '1',
+                                          '-m', command], obj={})
+        assert result.exit_code == 0
+        names = {}
+        for name in os.listdir(os.path.join('out', 'sakila')):
+            with gzip.open(os.path.join('out', 'sakila', name)) as fileobj:
+                names[hashlib.md5(fileobj.read()).hexdigest()] = name
+        with open(log_path) as fileobj:
+            loaded = [line.split() for line in fileobj]
+        assert [db for db, _ in loaded] == ['sakila']*len(loaded)
+        loaded = [names[digest] for _, digest in loaded]
+        sizes = [os.path.getsize(os.path.join('out', 'sakila', name))
+                 for name in loaded[:-2]]
+        # tables are loaded largest first, then routines, then views
+        assert len(loaded) == 18
+        assert sizes == sorted(sizes, reverse=True)
+        assert loaded[-2:] == ['routines.ddl.gz', 'views.ddl.gz']
+
+        result = runner.invoke(load_cli, ['-C', 'out', '-j', '4',
+                                          '-m', 'false'], obj={})
+        assert result.exit_code == 1
+        assert 'Failed to load' in result.output
+
+
+def test_discover_chunks(tmpdir):
+    for name in ('t.sql.gz', 't.data-00001.sql.gz', 't.data-00002.sql.gz',
+                 't.post.sql.gz', 'views.ddl.gz'):
+        tmpdir.join('db', name).write('x', ensure=True)
+    phases = dict((phase, sorted(os.path.basename(job.path) for job in jobs))
+                  for phase, jobs in load.discover(str(tmpdir)))
+    assert phases == {
+        'databases': [],
+        'tables': ['t.sql.gz'],
+        'data': ['t.data-00001.sql.gz', 't.data-00002.sql.gz'],
+        'post': ['t.post.sql.gz'],
+        'routines': [],
+        'views': ['views.ddl.gz'],
+    }
+
+
+def test_local_infile_command(tmpdir):
+    tmpdir.join('db', 't.sql').write('x', ensure=True)
+    assert not load.has_tab_data(str(tmpdir))
+    tmpdir.join('db', 't.txt').write('x')
+    assert load.has_tab_data(str(tmpdir))
+
+    assert load.local_infile_command('mysql') == 'mysql --local-infile=1'
+    assert (load.local_infile_command('/usr/bin/mysql -uroot') ==
+            '/usr/bin/mysql -uroot --local-infile=1')
+    for command in ('mysql --local-infile=0',
+                    'mysql --local-infile',
+                    'python client.py'):
+        assert load.local_infile_command(command) == command
@@ -1,11 +1,31 @@
 """
 Test dbsake cli
 """
+import gzip
+import io
+import json
 import os
+import shutil
+import subprocess
+import sys
+import threading
 
+import pytest
 from click.testing import CliRunner
 
 from dbsake.cli.cmd.sieve import sieve_cli
+from dbsake.core.mysql.sieve import checkpoint
+from dbsake.core.mysql.sieve import filters
+from dbsake.core.mysql.sieve import inserts
+from dbsake.core.mysql.sieve import parser
+from dbsake.core.mysql.sieve import pipeline
+from dbsake.core.mysql.sieve import sample
+from dbsake.core.mysql.sieve import tab
+from dbsake.core.mysql.sieve import transform
+from dbsake.core.mysql.sieve import where
+from dbsake.core.mysql.sieve import writers
+from dbsake.util import cmd
+from dbsake.util import gzindex
 
 
 def test_sieve_stream():
@@ -39,3 +59,951 @@ def test_sieve_w_mariadb10_gtid():
     args = ['--format=stream', '--input-file=' + path, '-O']
     result = runner.invoke(sieve_cli, args, obj={})
     assert result.exit_code == 0
+
+
+def test_sieve_directory_jobs():
+    runner = CliRunner()
+    sakila_path = os.path.join(os.path.dirname(__file__), 'sakila.sql.gz')
+    with runner.isolated_filesystem():
+        for jobs in ('1', '4'):
+            args = ['--format=directory', '--input-file=' + sakila_path,
+                    '--compress-command=cat', '--directory=jobs' + jobs,
+                    '--jobs=' + jobs]
+            result = runner.invoke(sieve_cli, args, obj={})
+            assert result.exit_code == 0
+        names = sorted(os.listdir(os.path.join('jobs1', 'sakila')))
+        assert names == sorted(os.listdir(os.path.join('jobs4', 'sakila')))
+        for name in names:
+            with open(os.path.join('jobs1', 'sakila', name), 'rb') as f1:
+                with open(os.path.join('jobs4', 'sakila', name), 'rb') as f4:
+                    assert f1.read() == f4.read()
+
+
+def test_sieve_build_index():
+    runner = CliRunner()
+    sakila_path = os.path.join(os.path.dirname(__file__), 'sakila.sql.gz')
+    args = ['--table=sakila.actor', '--defer-indexes', '-O']
+    with runner.isolated_filesystem():
+        with gzip.open(sakila_path, 'rb') as src:
+            with open('sakila.sql', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        expected = runner.invoke(sieve_cli, args + ['--input-file=sakila.sql'],
+                                 obj={})
+        assert expected.exit_code == 0
+
+        result = runner.invoke(sieve_cli,
+                               ['--build-index', '--input-file=sakila.sql'],
+                               obj={})
+        assert result.exit_code == 0
+        assert os.path.exists('sakila.sql.idx')
+
+        result = runner.invoke(sieve_cli, args + ['--input-file=sakila.sql'],
+                               obj={})
+        assert result.exit_code == 0
+        assert result.output == expected.output
+
+        # a gzip input is indexed along with its access points
+        shutil.copy(sakila_path, 'sakila.sql.gz')
+        result = runner.invoke(sieve_cli,
+                               ['--build-index', '--index-span=64K',
+                                '--input-file=sakila.sql.gz'],
+                               obj={})
+        assert result.exit_code == 0
+        assert os.path.exists('sakila.sql.gz.idx')
+        assert os.path.exists('sakila.sql.gz.gzidx')
+        gz_index = gzindex.read_index('sakila.sql.gz.gzidx')
+        assert len(gz_index.points) > 10
+        assert gz_index.length == os.path.getsize('sakila.sql')
+
+        result = runner.invoke(sieve_cli,
+                               args + ['--input-file=sakila.sql.gz'],
+                               obj={})
+        assert result.exit_code == 0
+        assert result.output.replace('sakila.sql.gz', 'sakila.sql') == \
+            expected.output
+
+
+def test_block_line_reader():
+    data = ''.join('line %d\n' % n for n in range(100)).encode('ascii')
+    expected = parser.LineReader(io.BytesIO(data))
+    reader = parser.BlockLineReader(io.BytesIO(data), block_size=64)
+    for _ in range(50):
+        assert next(reader) == next(expected)
+    line = next(reader)
+    reader.pushback(line)
+    assert reader.line_no == expected.line_no == 50
+    assert reader.offset == expected.offset == data.index(line)
+    assert list(reader) == list(expected)
+    assert reader.offset == len(data)
+
+
+def test_skip_section_tabledata():
+    path = os.path.join(os.path.dirname(__file__), 'sakila.sql.gz')
+    with gzip.open(path, 'rb') as fileobj:
+        data = fileobj.read()
+
+    def section_offsets(block_size, skip):
+        dump_parser = parser.DumpParser(io.BytesIO(data))
+        dump_parser._stream.block_size = block_size
+        result = []
+        for section in dump_parser:
+            offset = dump_parser.offset
+            if skip:
+                section.flush()
+            else:
+                for _ in section.iterable:
+                    pass
+            result.append((section.name, section.table, offset,
+                           dump_parser.offset, dump_parser._stream.line_no))
+        return result
+
+    expected = section_offsets(64*1024, skip=False)
+    for block_size in (1, 7, 32, 4096, 64*1024):
+        assert section_offsets(block_size, skip=True) == expected
+
+
+def test_section_passthrough():
+    path = os.path.join(os.path.dirname(__file__), 'sakila.sql.gz')
+    with gzip.open(path, 'rb') as fileobj:
+        data = fileobj.read()
+
+    def copy_sections(block_size):
+        dump_parser = parser.DumpParser(io.BytesIO(data))
+        dump_parser._stream.block_size = block_size
+        output = io.BytesIO()
+        result = []
+        for section in dump_parser:
+            copied = section.passthrough(output.write)
+            if not copied:
+                output.writelines(section.iterable)
+            result.append((section.name, copied, dump_parser.offset,
+                           dump_parser._stream.line_no))
+        return output.getvalue(), result
+
+    output, expected = copy_sections(64*1024)
+    assert output == data
+    assert ('tabledata', True) in [item[:2] for item in expected]
+    for block_size in (32, 4096):
+        assert copy_sections(block_size) == (data, expected)
+
+    # a transformed section is never copied in bulk
+    dump_parser = parser.DumpParser(io.BytesIO(data))
+    for section in dump_parser:
+        section.iterable = iter(list(section.iterable))
+        assert not section.passthrough(io.BytesIO().write)
+
+
+def test_rebatch_inserts():
+    rows = [b"(1,'a),(b')", b"(2,'it\\'s),(')", b"(3,'x''y')",
+            b"(4,'\\\\),(')", b"(5,NULL)"]
+    lines = [b'INSERT INTO `t` VALUES ' + b','.join(rows[:3]) + b';\n',
+             b'INSERT INTO `t` VALUES ' + b','.join(rows[3:]) + b';\n',
+             b'/*!40000 ALTER TABLE `t` ENABLE KEYS */;\n']
+    prefix, split_rows = inserts.split_insert(lines[0])
+    assert prefix == b'INSERT INTO `t` VALUES '
+    assert list(split_rows) == rows[:3]
+
+    for options in (dict(max_rows=2), dict(max_bytes=50), dict(max_bytes=1)):
+        result = list(inserts.rebatch(lines, **options))
+        assert result[-1] == lines[-1]
+        result_rows = []
+        for line in result[:-1]:
+            prefix, split_rows = inserts.split_insert(line)
+            split_rows = list(split_rows)
+            assert prefix == b'INSERT INTO `t` VALUES '
+            assert len(split_rows) == 1 or len(line) <= options.get(
+                'max_bytes', len(line))
+            assert len(split_rows) <= options.get('max_rows', len(rows))
+            result_rows.extend(split_rows)
+        assert result_rows == rows
+
+    merged = list(inserts.rebatch(lines, max_bytes=1024))
+    assert merged == [b'INSERT INTO `t` VALUES ' + b','.join(rows) + b';\n',
+                      lines[-1]]
+
+    # an oversized row leaves no room for the rows of the next INSERT
+    prefix = b'INSERT INTO `t` VALUES '
+    big_row = b"(0,'" + b'x' * 99 + b"')"
+    small_rows = [('(%d,NULL)' % n).encode('ascii') for n in range(1, 11)]
+    lines = [prefix + big_row + b';\n',
+             prefix + b','.join(small_rows) + b';\n']
+    result = list(inserts.rebatch(lines, max_bytes=60))
+    assert result[0] == lines[0]
+    assert all(len(line) <= 60 for line in result[1:])
+    result_rows = []
+    for line in result:
+        result_rows.extend(inserts.split_insert(line)[1])
+    assert result_rows == [big_row] + small_rows
+
+
+def test_sieve_tab():
+    runner = CliRunner()
+    sakila_path = os.path.join(os.path.dirname(__file__), 'sakila.sql.gz')
+    args = ['--format=tab', '--input-file=' + sakila_path, '-C', 'out']
+    with runner.isolated_filesystem():
+        result = runner.invoke(sieve_cli, args, obj={})
+        assert result.exit_code == 0
+        with open(os.path.join('out', 'sakila', 'actor.txt'), 'rb') as fileobj:
+            rows = fileobj.read().splitlines()
+        assert len(rows) == 200
+        assert rows[0].split(b'\t')[:3] == [b'1', b'PENELOPE', b'GUINESS']
+        with open(os.path.join('out', 'sakila', 'actor.sql'), 'rb') as fileobj:
+            ddl = fileobj.read()
+        assert b'CREATE TABLE `actor`' in ddl
+        assert b"LOAD DATA LOCAL INFILE 'sakila/actor.txt' INTO TABLE " \
+               b"`actor` CHARACTER SET utf8" in ddl
+        assert b'INSERT INTO' not in ddl
+
+    row = b"(1,NULL,'a\\tb\tc\\'d''e',0x09005C,b'101',_binary 'x',-1.5e3)"
+    assert tab.row_fields(row) == [b'1', b'\\N', b"a\\tb\\tc\\'d\\'e",
+                                   b'\\t\\0\\\\', b'\x05', b'x', b'-1.5e3']
+
+
+def test_sieve_directory_chunks():
+    runner = CliRunner()
+    sakila_path = os.path.join(os.path.dirname(__file__), 'sakila.sql.gz')
+    args = ['--format=directory', '--input-file=' + sakila_path,
+            '--compress-command=cat']
+    with runner.isolated_filesystem():
+        result = runner.invoke(sieve_cli, args + ['-C', 'whole'], obj={})
+        assert result.exit_code == 0
+        result = runner.invoke(sieve_cli, args + ['-C', 'chunked',
+                                                  '--chunk-size=64K'],
+                               obj={})
+        assert result.exit_code == 0
+
+        def read(name):
+            with open(os.path.join('chunked', 'sakila', name), 'rb') as f:
+                return f.read()
+
+        names = sorted(os.listdir(os.path.join('chunked', 'sakila')))
+        chunks = [name for name in names if name.startswith('rental.data-')]
+        assert len(chunks) > 1
+        insert_lines = []
+        for name in chunks:
+            data = read(name)
+            assert data.startswith(b'-- MySQL dump')
+            assert data.endswith(b'SET CHARACTER_SET_CLIENT='
+                                 b'@OLD_CHARACTER_SET_CLIENT */;\n')
+            insert_lines.extend(line for line in data.splitlines(True)
+                           if line.startswith(b'INSERT'))
+        with open(os.path.join('whole', 'sakila', 'rental.sql'), 'rb') as f:
+            whole = f.read()
+        assert insert_lines == [line for line in whole.splitlines(True)
+                           if line.startswith(b'INSERT')]
+        assert b'INSERT' not in read('rental.sql')
+        assert b'TRIGGER rental_date' in read('rental.post.sql')
+
+        result = runner.invoke(sieve_cli, args + ['-C', 'parallel', '-j', '2',
+                                                  '--chunk-rows=2000'],
+                               obj={})
+        assert result.exit_code == 0
+        parallel_dir = os.path.join('parallel', 'sakila')
+        chunks = sorted(name for name in os.listdir(parallel_dir)
+                        if name.startswith('rental.data-'))
+        assert len(chunks) > 1
+        insert_lines = []
+        for name in chunks:
+            with open(os.path.join(parallel_dir, name), 'rb') as f:
+                insert_lines.extend(line for line in f.read().splitlines(True)
+                                    if line.startswith(b'INSERT'))
+        assert insert_lines == [line for line in whole.splitlines(True)
+                                if line.startswith(b'INSERT')]
+        with open(os.path.join(parallel_dir, 'rental.post.sql'), 'rb') as f:
+            assert b'TRIGGER rental_date' in f.read()
+
+
+def test_sieve_stats():
+    from dbsake.core.mysql import sieve
+
+    sakila_path = os.path.join(os.path.dirname(__file__), 'sakila.sql.gz')
+    with gzip.open(sakila_path, 'rb') as fileobj:
+        size = len(fileobj.read())
+    output = io.BytesIO()
+    with open(sakila_path, 'rb') as fileobj:
+        options = sieve.Options(output_format='stream',
+                                table=('sakila.actor',),
+                                exclude_table=(),
+                                table_schema=True,
+                                table_data=True,
+                                routines=None,
+                                events=None,
+                                triggers=None,
+                                master_data=None,
+                                defer_indexes=False,
+                                defer_foreign_keys=False,
+                                write_binlog=True,
+                                input_stream=fileobj,
+                                output_stream=output,
+                                stats=True)
+        result = sieve.sieve(options)
+    assert result.total.bytes_in == size
+    assert result.total.bytes_out == len(output.getvalue())
+    actor = result.by_table[(b'sakila', b'actor')]
+    assert actor.sections == 2
+    assert actor.inserts == 1
+    assert result.by_table[(b'sakila', b'rental')].bytes_out == 0
+    assert result.by_section['tabledata'].bytes_in > \
+        result.by_section['tabledata'].bytes_out
+    data = json.loads(result.to_json())
+    assert data['total']['bytes_in'] == size
+    assert set(data['total']['time']) == set(['read', 'parse', 'filter',
+                                              'transform', 'write'])
+
+
+def test_sieve_post_load_indexes():
+    runner = CliRunner()
+    sakila_path = os.path.join(os.path.dirname(__file__), 'sakila.sql.gz')
+    args = ['--input-file=' + sakila_path, '--table=sakila.actor',
+            '--post-load-indexes']
+    with runner.isolated_filesystem():
+        result = runner.invoke(sieve_cli, args + ['--to-stdout'], obj={})
+        assert result.exit_code == 0
+        assert b'ADD KEY' not in result.output.encode('utf8')
+        with open('post_load.sql', 'rb') as fileobj:
+            post_load = fileobj.read()
+        assert post_load.startswith(b'-- MySQL dump')
+        assert b'USE `sakila`;' in post_load
+        assert post_load.index(b'USE `sakila`;') < \
+            post_load.index(b'ALTER TABLE `actor`')
+        assert b'ADD KEY `idx_actor_last_name`' in post_load
+
+        result = runner.invoke(sieve_cli, args + ['--format=directory',
+                                                  '--compress-command=cat',
+                                                  '-C', 'out'], obj={})
+        assert result.exit_code == 0
+        table_dir = os.path.join('out', 'sakila')
+        with open(os.path.join(table_dir, 'actor.sql'), 'rb') as f:
+            assert b'ADD KEY' not in f.read()
+        with open(os.path.join(table_dir, 'actor.post.sql'), 'rb') as f:
+            assert b'ADD KEY `idx_actor_last_name`' in f.read()
+
+
+def test_sieve_post_load_without_database(tmpdir):
+    # a dump header that never names a database, as with the sakila dump
+    # stripped of its "Database: sakila" header field
+    path = str(tmpdir.join('nodb.sql'))
+    with open(path, 'wb') as fileobj:
+        fileobj.write(b'-- MySQL dump 10.14  Distrib 5.5.38-MariaDB\n'
+                      b'--\n'
+                      b'-- Host: localhost\n'
+                      b'-- ' + b'-' * 54 + b'\n'
+                      b'-- Server version\t5.5.38-MariaDB-log\n\n'
+                      b'/*!40101 SET NAMES utf8 */;\n\n'
+                      b'--\n-- Table structure for table `t`\n--\n\n'
+                      b'DROP TABLE IF EXISTS `t`;\n'
+                      b'CREATE TABLE `t` (\n'
+                      b'  `a` int(11) NOT NULL,\n'
+                      b'  `b` int(11) DEFAULT NULL,\n'
+                      b'  PRIMARY KEY (`a`),\n'
+                      b'  KEY `idx_b` (`b`)\n'
+                      b') ENGINE=InnoDB DEFAULT CHARSET=latin1;\n\n'
+                      b'--\n-- Dumping data for table `t`\n--\n\n'
+                      b'LOCK TABLES `t` WRITE;\n'
+                      b'INSERT INTO `t` VALUES (1,1),(2,2);\n'
+                      b'UNLOCK TABLES;\n')
+    post_load_path = str(tmpdir.join('post_load.sql'))
+    result = CliRunner().invoke(sieve_cli, ['--input-file=' + path,
+                                            '--post-load-indexes',
+                                            '--post-load-file=' +
+                                            post_load_path,
+                                            '--to-stdout'], obj={})
+    assert result.exit_code == 0
+    with open(post_load_path, 'rb') as fileobj:
+        post_load = fileobj.read()
+    assert b'ADD KEY `idx_b`' in post_load
+    assert b'USE ' not in post_load
+
+
+def test_sieve_where():
+    runner = CliRunner()
+    sakila_path = os.path.join(os.path.dirname(__file__), 'sakila.sql.gz')
+    args = ['--input-file=' + sakila_path, '--table=sakila.actor',
+            '--table=sakila.city', '--to-stdout',
+            '--where=sakila.actor:actor_id BETWEEN 10 AND 19 '
+            'OR first_name IN ("PENELOPE")',
+            '--where=sakila.actor:last_name != \'GUINESS\'']
+    result = runner.invoke(sieve_cli, args, obj={})
+    assert result.exit_code == 0
+    output = result.output.encode('utf8')
+    rows = [row for line in output.splitlines(True)
+            if line.startswith(b'INSERT INTO `actor`')
+            for row in inserts.split_insert(line)[1]]
+    ids = [int(row[1:row.index(b',')]) for row in rows]
+    assert ids == [10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 54, 104, 120]
+    # tables without a predicate are unchanged
+    assert output.count(b"INSERT INTO `city`") == 1
+
+    # the table structure is read for --where even when it is not output
+    result = runner.invoke(sieve_cli, args + ['--no-table-schema'], obj={})
+    assert result.exit_code == 0
+    output = result.output.encode('utf8')
+    assert b'CREATE TABLE' not in output
+    rows = [row for line in output.splitlines(True)
+            if line.startswith(b'INSERT INTO `actor`')
+            for row in inserts.split_insert(line)[1]]
+    assert len(rows) == len(ids)
+
+    result = runner.invoke(sieve_cli, args[:-1] + ['--where=sakila.actor:'
+                                                   'actor_id >'], obj={})
+    assert result.exit_code != 0
+    assert 'Expected string but found end of predicate' in result.output
+
+    predicate = where.parse_where("db.t:`a` >= 2 AND NOT b IS NULL")
+    keep_rows = predicate.bind([b'a', b'b'])
+    line = b"(2,'x'),(1,NULL),(3,NULL),(4,'a),(b\\'')"
+    assert keep_rows(line, 0, len(line)) == [b"(2,'x')", b"(4,'a),(b\\'')"]
+
+
+def test_sieve_sample():
+    runner = CliRunner()
+    sakila_path = os.path.join(os.path.dirname(__file__), 'sakila.sql.gz')
+    args = ['--input-file=' + sakila_path, '--to-stdout', '--sample=25%',
+            '--sample-full=sakila.language']
+
+    def table_rows(output, table):
+        prefix = b'INSERT INTO `' + table + b'`'
+        return [row for line in output.splitlines(True)
+                if line.startswith(prefix)
+                for row in inserts.split_insert(line)[1]]
+
+    def column(rows, pos):
+        return [tab.row_fields(row)[pos] for row in rows]
+
+    result = runner.invoke(sieve_cli, args, obj={})
+    assert result.exit_code == 0
+    output = result.output.encode('utf8')
+    assert runner.invoke(sieve_cli, args, obj={}).output == result.output
+
+    assert len(table_rows(output, b'language')) == 6
+    countries = table_rows(output, b'country')
+    assert 0 < len(countries) < 109
+    cities = table_rows(output, b'city')
+    assert 0 < len(cities) < 600
+    assert set(column(cities, 2)) <= set(column(countries, 0))
+    addresses = table_rows(output, b'address')
+    assert len(addresses) < 603
+    assert set(column(addresses, 4)) <= set(column(cities, 0))
+    actors = table_rows(output, b'actor')
+    assert 0 < len(actors) < 200
+    film_actors = table_rows(output, b'film_actor')
+    assert set(column(film_actors, 0)) <= set(column(actors, 0))
+
+    key_set = sample.KeySet(max_keys=4)
+    for value in range(10):
+        key_set.add(str(value).encode('ascii'))
+    key_set.freeze()
+    assert len(key_set) == 10
+    assert b'7' in key_set and b'0' in key_set
+    assert b'10' not in key_set
+    key_set.close()
+
+
+def test_sieve_verify():
+    runner = CliRunner()
+    sakila_path = os.path.join(os.path.dirname(__file__), 'sakila.sql.gz')
+    args = ['--input-file=' + sakila_path, '--to-stdout']
+    with runner.isolated_filesystem():
+        result = runner.invoke(sieve_cli, args + ['--verify=a.json'], obj={})
+        assert result.exit_code == 0
+        result = runner.invoke(sieve_cli, args + ['--verify=b.json',
+                                                  '--insert-batch-rows=7'],
+                               obj={})
+        assert result.exit_code == 0
+        with open('a.json') as fileobj:
+            manifest = json.load(fileobj)
+        with open('b.json') as fileobj:
+            assert json.load(fileobj) == manifest
+    tables = dict((entry['table'], entry) for entry in manifest['tables'])
+    assert tables['actor']['rows'] == 200
+    assert tables['rental']['rows'] == 16044
+
+    line = b"INSERT INTO `t` VALUES (1,'a),(b'),(2,'c\\'),(\\'d'),(3,NULL);\n"
+    assert inserts.split_rows(line, *inserts.values_bounds(line)) == \
+        [b"1,'a),(b'", b"2,'c\\'),(\\'d'", b'3,NULL']
+
+
+def test_sieve_manifest():
+    runner = CliRunner()
+    sakila_path = os.path.join(os.path.dirname(__file__), 'sakila.sql.gz')
+    result = runner.invoke(sieve_cli,
+                           ['--input-file=' + sakila_path, '--manifest'],
+                           obj={})
+    assert result.exit_code == 0
+    output = result.output
+    data = json.loads(output[:output.rindex('}') + 1])
+    with gzip.open(sakila_path, 'rb') as fileobj:
+        dump = fileobj.read()
+    assert data['bytes'] == len(dump)
+    for item in data['objects']:
+        if item['type'] == 'tablestructure' and item['table'] == 'actor':
+            section = dump[item['offset']:item['offset'] + item['bytes']]
+            assert b'CREATE TABLE `actor`' in section
+    tables = dict((item['table'], item) for item in data['tables'])
+    assert tables['actor']['rows'] == 200
+    assert tables['rental']['rows'] == 16044
+    assert tables['rental']['data_bytes'] < tables['rental']['bytes']
+
+
+def test_sieve_pipeline():
+    runner = CliRunner()
+    sakila_path = os.path.join(os.path.dirname(__file__), 'sakila.sql.gz')
+    args = ['--input-file=' + sakila_path, '--defer-indexes',
+            '--insert-batch-rows=50', '-t', 'sakila.rental',
+            '-t', 'sakila.actor']
+    expected = runner.invoke(sieve_cli, args, obj={})
+    assert expected.exit_code == 0
+    result = runner.invoke(sieve_cli, args + ['--pipeline'], obj={})
+    assert result.exit_code == 0
+    assert result.output == expected.output
+
+    with runner.isolated_filesystem():
+        args = ['--input-file=' + sakila_path, '--format=directory',
+                '--post-load-indexes', '--pipeline', '-t', 'sakila.rental',
+                '--compress-command=cat']
+        result = runner.invoke(sieve_cli, args, obj={})
+        assert result.exit_code == 0
+        with open(os.path.join('sakila', 'rental.post.sql'), 'rb') as f:
+            assert b'ALTER TABLE `rental`' in f.read()
+
+    def failing(section):
+        raise ValueError("transform failed")
+
+    sections = parser.DumpParser(stream=gzip.open(sakila_path, 'rb'))
+    stages = pipeline.Pipeline(sections, lambda section: False, failing)
+    try:
+        with stages:
+            for section in stages:
+                list(section.iterable)
+    except ValueError as exc:
+        assert str(exc) == "transform failed"
+    else:
+        assert False, "expected the transform error"
+
+
+def _read_tree(path):
+    result = {}
+    for root, _, names in os.walk(path):
+        for name in names:
+            with open(os.path.join(root, name), 'rb') as fileobj:
+                result[os.path.relpath(os.path.join(root, name), path)] = \
+                    fileobj.read()
+    return result
+
+
+def test_sieve_tee():
+    runner = CliRunner()
+    sakila_path = os.path.join(os.path.dirname(__file__), 'sakila.sql.gz')
+    outputs = [
+        ['--no-table-data', '-F', 'directory', '-C', 'schema', '-z', 'cat'],
+        ['-t', 'sakila.a*', '-F', 'tab', '-C', 'tab', '--no-table-schema',
+         '--where', 'sakila.actor:actor_id < 3'],
+        ['-T', 'sakila.rental', '-F', 'directory', '-C', 'rest', '-z', 'cat',
+         '--defer-indexes'],
+    ]
+    with runner.isolated_filesystem():
+        args = ['--input-file=' + sakila_path, '-t', 'sakila.actor']
+        expected = runner.invoke(sieve_cli, args, obj={})
+        assert expected.exit_code == 0
+        for output in outputs:
+            result = runner.invoke(sieve_cli, args[:1] + output, obj={})
+            assert result.exit_code == 0
+        expected_trees = [_read_tree(output[output.index('-C') + 1])
+                          for output in outputs]
+        for output in outputs:
+            shutil.rmtree(output[output.index('-C') + 1])
+
+        # sections are filtered in the parsing thread only, as the table
+        # matchers' caches are not thread-safe
+        filtered = filters.SectionFilter.filtered
+        threads = set()
+
+        def recording_filtered(self, section):
+            threads.add(threading.current_thread().name)
+            return filtered(self, section)
+
+        tee_args = [arg for output in outputs
+                    for arg in ('--tee', ' '.join(map(repr, output)))]
+        filters.SectionFilter.filtered = recording_filtered
+        try:
+            result = runner.invoke(sieve_cli, args + tee_args, obj={})
+        finally:
+            filters.SectionFilter.filtered = filtered
+        assert result.exit_code == 0
+        assert threads == set([threading.current_thread().name])
+        assert result.output == expected.output
+        for output, tree in zip(outputs, expected_trees):
+            assert tree
+            assert _read_tree(output[output.index('-C') + 1]) == tree
+
+        result = runner.invoke(sieve_cli, args + ['--tee', '-C other'],
+                               obj={})
+        assert result.exit_code != 0
+        assert '--tee outputs must use --format=directory or tab' in \
+            result.output
+        result = runner.invoke(sieve_cli,
+                               args + ['--tee', '-F tab -i ' + sakila_path],
+                               obj={})
+        assert result.exit_code != 0
+        assert '--input-file cannot be set for a --tee output' in \
+            result.output
+
+        # a failing output stops the pass and its error is raised; the
+        # compression command exiting may first break its pipe
+        failing = '-F directory -C bad -z false'
+        result = runner.invoke(sieve_cli, args + ['--tee', failing],
+                               obj={'debug': False})
+        assert result.exit_code != 0
+        assert isinstance(result.exception, (cmd.CommandError, SystemExit))
+
+
+def test_sieve_resume():
+    runner = CliRunner()
+    sakila_path = os.path.join(os.path.dirname(__file__), 'sakila.sql.gz')
+    transform_tabledata = transform.SectionTransform.transform_tabledata
+
+    def crash_after(lines, count):
+        for idx, line in enumerate(lines):
+            if idx == count:
+                raise RuntimeError("killed")
+            yield line
+
+    def crashing_transform(self, section):
+        transform_tabledata(self, section)
+        if section.table == b'payment':
+            section.iterable = crash_after(section.iterable, 8)
+
+    interval = checkpoint.INTERVAL
+    with runner.isolated_filesystem():
+        with gzip.open(sakila_path, 'rb') as fileobj:
+            with open('sakila.sql', 'wb') as output:
+                shutil.copyfileobj(fileobj, output)
+
+        cases = [
+            # checkpoint after every section, or only after the first
+            (sakila_path, 0, ['-F', 'directory', '-z', 'cat',
+                              '--chunk-rows', '3000', '--defer-indexes']),
+            ('sakila.sql', interval, ['-F', 'tab', '--defer-indexes']),
+            ('sakila.sql', 0, ['-F', 'directory', '-z', 'cat', '-j', '2',
+                               '--where', 'sakila.payment:amount > 5']),
+        ]
+        for input_path, case_interval, options in cases:
+            args = ['-i', input_path] + options
+            expected = runner.invoke(sieve_cli,
+                                     args + ['-C', 'expected',
+                                             '--verify', 'expected.json'],
+                                     obj={})
+            assert expected.exit_code == 0
+            args += ['-C', 'output', '--verify', 'output.json']
+
+            checkpoint.INTERVAL = case_interval
+            transform.SectionTransform.transform_tabledata = \
+                crashing_transform
+            try:
+                result = runner.invoke(sieve_cli, args, obj={})
+            finally:
+                transform.SectionTransform.transform_tabledata = \
+                    transform_tabledata
+                checkpoint.INTERVAL = interval
+            assert isinstance(result.exception, RuntimeError)
+            assert os.path.exists(os.path.join('output', 'sieve.checkpoint'))
+
+            result = runner.invoke(sieve_cli, args + ['-t', 'sakila.actor',
+                                                      '--resume'], obj={})
+            assert result.exit_code == 1
+            assert 'was written with different options' in result.output
+
+            result = runner.invoke(sieve_cli, args + ['--resume'], obj={})
+            assert result.exit_code == 0
+            assert result.output == expected.output
+            assert _read_tree('output') == _read_tree('expected')
+            with open('output.json') as fileobj:
+                with open('expected.json') as expected_fileobj:
+                    assert json.load(fileobj) == json.load(expected_fileobj)
+            shutil.rmtree('output')
+            shutil.rmtree('expected')
+
+        # without a checkpoint, --resume starts from the beginning
+        result = runner.invoke(sieve_cli, ['-i', 'sakila.sql', '-F', 'tab',
+                                           '-C', 'output', '--resume'],
+                               obj={})
+        assert result.exit_code == 0
+        assert not os.path.exists(os.path.join('output', 'sieve.checkpoint'))
+
+        result = runner.invoke(sieve_cli, ['-i', 'sakila.sql', '--resume'],
+                               obj={})
+        assert result.exit_code == 1
+        assert ('--resume requires --format=directory or --format=tab' in
+                result.output)
+
+
+
+def test_block_line_reader_fragments():
+    line = (b"INSERT INTO `t` VALUES " +
+            b','.join(b"(" + str(n).encode('ascii') + b",'a),(b" +
+                      b'x' * (n % 13) + b"')" for n in range(200)) +
+            b";\n")
+    data = b'-- x\n' + line + b'UNLOCK TABLES;\n' + line
+    rows = inserts.split_rows(line, *inserts.values_bounds(line))
+    for block_size in (1, 7, 4096):
+        for max_line_size in (1, 40, 100):
+            reader = parser.BlockLineReader(io.BytesIO(data),
+                                            block_size=block_size,
+                                            max_line_size=max_line_size)
+            lines = list(reader)
+            assert b''.join(lines) == data
+            assert reader.offset == len(data)
+            assert max(map(len, lines)) < max_line_size + 40
+            for fragment, following in zip(lines, lines[1:]):
+                if not fragment.endswith(b'\n'):
+                    assert fragment.endswith(b',')
+                    assert following.startswith(b'(')
+            statements = list(inserts.whole_statements(lines))
+            assert len(statements) == len(lines)
+            result = []
+            for statement in statements:
+                bounds = inserts.values_bounds(statement)
+                if bounds is not None:
+                    assert statement.endswith(b');\n')
+                    result.extend(inserts.split_rows(statement, *bounds))
+            assert result == rows * 2
+
+
+def test_sieve_line_memory():
+    runner = CliRunner()
+    sakila_path = os.path.join(os.path.dirname(__file__), 'sakila.sql.gz')
+    cases = [
+        ['--to-stdout', '--verify', 'verify.json'],
+        ['--to-stdout', '--defer-indexes', '-t', 'sakila.rental'],
+        ['--to-stdout', '--where', 'sakila.payment:amount > 5',
+         '--verify', 'verify.json'],
+        ['--to-stdout', '--sample', '10%', '--verify', 'verify.json'],
+        ['-F', 'directory', '-C', 'output', '-z', 'cat',
+         '--chunk-rows', '3000'],
+        ['-F', 'tab', '-C', 'output', '--defer-indexes'],
+    ]
+    with runner.isolated_filesystem():
+        for options in cases:
+            args = ['-i', sakila_path] + options
+            expected = runner.invoke(sieve_cli, args, obj={})
+            assert expected.exit_code == 0
+            expected_tree = _read_tree('.')
+            result = runner.invoke(sieve_cli, args + ['--line-memory', '4K'],
+                                   obj={})
+            assert result.exit_code == 0
+            if '--where' not in options and '--sample' not in options:
+                # rows are only rewritten into per-fragment statements
+                assert result.output == expected.output
+            assert _read_tree('.') == expected_tree
+            for name in os.listdir('.'):
+                if os.path.isdir(name):
+                    shutil.rmtree(name)
+                else:
+                    os.unlink(name)
+
+
+LINE_MEMORY_SCRIPT = """
+import sys
+
+from dbsake.cli.cmd.sieve import sieve_cli
+
+
+def peak_rss():
+    with open('/proc/self/status') as fileobj:
+        for line in fileobj:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+
+
+before = peak_rss()
+try:
+    sieve_cli.main(sys.argv[2:], obj={}, standalone_mode=False)
+except SystemExit:
+    pass
+with open(sys.argv[1], 'w') as fileobj:
+    fileobj.write(str(peak_rss() - before))
+"""
+
+
+def test_sieve_line_memory_peak_rss(tmpdir):
+    # the peak RSS of the process itself; ru_maxrss may be inherited from
+    # the parent across exec
+    if not os.path.exists('/proc/self/status'):
+        pytest.skip("requires /proc/self/status")
+    path = str(tmpdir.join('huge.sql'))
+    rows = b','.join([b"(1,'" + b'x' * 1000 + b"')"] * 1024)
+    count = 32
+    with open(path, 'wb') as fileobj:
+        fileobj.write(b'--\n-- Current Database: `db`\n--\n\n'
+                      b'USE `db`;\n\n'
+                      b'--\n-- Dumping data for table `t`\n--\n\n'
+                      b'LOCK TABLES `t` WRITE;\n'
+                      b'INSERT INTO `t` VALUES ')
+        for _ in range(count - 1):
+            fileobj.write(rows + b',')
+        fileobj.write(rows + b';\nUNLOCK TABLES;\n')
+    line_size = len(rows) * count
+
+    def peak_rss_growth(*args):
+        report = str(tmpdir.join('rss'))
+        with open(os.devnull, 'wb') as devnull:
+            subprocess.check_call([sys.executable, '-c', LINE_MEMORY_SCRIPT,
+                                   report, '-i', path, '--to-stdout',
+                                   '--verify', str(tmpdir.join('verify'))] +
+                                  list(args), stdout=devnull)
+        with open(str(tmpdir.join('verify'))) as fileobj:
+            assert json.load(fileobj)['tables'][0]['rows'] == count * 1024
+        with open(report) as fileobj:
+            return int(fileobj.read())
+
+    # the default reads the line whole, holding at least one copy of it
+    assert peak_rss_growth() > line_size
+    assert peak_rss_growth('--line-memory', '256K') < line_size // 2
+
+
+
+def test_writer_pool_barrier(tmpdir):
+    opened = []
+    release = threading.Event()
+    pool = writers.WriterPool(
+        1, on_open=lambda path, generation: opened.append((path, generation))
+    )
+    pool_open = pool.open
+
+    def blocked_open(stack, path, mode):
+        release.wait()
+        return pool_open(stack, path, mode)
+
+    pool.open = blocked_open
+    first = str(tmpdir.join('first'))
+    second = str(tmpdir.join('second'))
+    try:
+        with writers.PooledFile(pool, first, 'wb') as fileobj:
+            fileobj.write(b'first\n')
+        # a checkpoint barrier does not wait for the workers
+        written = pool.barrier(1)
+        assert not written()
+        with writers.PooledFile(pool, second, 'wb') as fileobj:
+            fileobj.write(b'second\n')
+        assert not written()
+    finally:
+        release.set()
+        pool.close()
+    assert written()
+    assert opened == [(first, 0), (second, 1)]
+    assert tmpdir.join('first').read() == 'first\n'
+
+
+
+def test_writer_pool_close_error(tmpdir):
+    def failing_open(stack, path, mode):
+        raise IOError("disk full")
+
+    for failed in (False, True):
+        pool = writers.WriterPool(1)
+        pool.open = failing_open
+        with writers.PooledFile(pool, str(tmpdir.join('data')), 'wb'):
+            pass
+        if failed:
+            # the exception the caller is failing with is left alone
+            pool.close(failed=True)
+        else:
+            with pytest.raises(IOError):
+                pool.close()
+
+
+def write_mydumper_fixture(path):
+    preamble = (b'/*!40101 SET NAMES binary*/;\n'
+                b'/*!40014 SET FOREIGN_KEY_CHECKS=0*/;\n\n')
+    files = {
+        'metadata': b'Started dump at: 2015-01-01 00:00:00\n',
+        'shop-schema-create.sql': b'CREATE DATABASE `shop` '
+                                  b'/*!40100 DEFAULT CHARACTER SET utf8 */;\n',
+        'shop.item-schema.sql': preamble +
+        b'CREATE TABLE `item` (\n'
+        b'  `id` int(11) NOT NULL,\n'
+        b'  `name` varchar(32) NOT NULL,\n'
+        b'  PRIMARY KEY (`id`),\n'
+        b'  KEY `idx_name` (`name`)\n'
+        b') ENGINE=InnoDB DEFAULT CHARSET=utf8;\n',
+        'shop.item.00000.sql.gz': preamble +
+        b'INSERT INTO `item` VALUES\n'
+        b"(1,'a'),\n"
+        b"(2,'b),(c');\n",
+        'shop.item.00001.sql': preamble +
+        b'INSERT INTO `item` VALUES\n'
+        b"(3,'d;');\n",
+        'shop.item-schema-triggers.sql': preamble +
+        b"SET SESSION SQL_MODE = '';\n"
+        b'DELIMITER ;;\n'
+        b'CREATE TRIGGER `item_bi` BEFORE INSERT ON `item` '
+        b'FOR EACH ROW SET NEW.name = UPPER(NEW.name) ;;\n'
+        b'DELIMITER ;\n',
+        'shop.note-schema.sql': preamble +
+        b'CREATE TABLE `note` (\n'
+        b'  `id` int(11) NOT NULL,\n'
+        b'  PRIMARY KEY (`id`)\n'
+        b') ENGINE=InnoDB DEFAULT CHARSET=utf8;\n',
+        'shop.note.sql': preamble +
+        b'INSERT INTO `note` VALUES(1);\n',
+        'shop.names-schema.sql': preamble +
+        b'CREATE TABLE `names` (\n'
+        b'  `name` tinyint NOT NULL\n'
+        b') ENGINE=MyISAM;\n',
+        'shop.names-schema-view.sql': preamble +
+        b'DROP TABLE IF EXISTS `names`;\n'
+        b'CREATE ALGORITHM=UNDEFINED VIEW `names` AS '
+        b'select `item`.`name` AS `name` from `item`;\n',
+    }
+    for name, data in files.items():
+        opener = gzip.open if name.endswith('.gz') else io.open
+        with opener(os.path.join(path, name), 'wb') as fileobj:
+            fileobj.write(data)
+
+
+def test_sieve_mydumper():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        os.mkdir('backup')
+        write_mydumper_fixture('backup')
+        result = runner.invoke(sieve_cli, ['-i', 'backup'], obj={})
+        assert result.exit_code == 0, result.output
+        output = result.output.encode('utf8')
+        assert b"INSERT INTO `item` VALUES (1,'a'),(2,'b),(c');\n" \
+            b"INSERT INTO `item` VALUES (3,'d;');\n" in output
+        assert b'INSERT INTO `note` VALUES (1);\n' in output
+        assert b'SET NAMES binary */;' in output
+        assert output.index(b'CREATE DATABASE `shop`') < \
+            output.index(b'CREATE TABLE `item`') < \
+            output.index(b'CREATE TRIGGER `item_bi`') < \
+            output.index(b'CREATE ALGORITHM=UNDEFINED VIEW `names`')
+        sections = []
+        for section in parser.DumpParser(io.BytesIO(output)):
+            sections.append(section.name)
+            section.flush()
+        assert sections == ['header', 'createdatabase',
+                            'tablestructure', 'tabledata', 'triggers',
+                            'view_temporary',
+                            'tablestructure', 'tabledata',
+                            'createdatabase', 'view', 'footer']
+
+        result = runner.invoke(sieve_cli, ['-i', 'backup', '-j', '2'],
+                               obj={})
+        assert result.exit_code == 0
+        assert result.output.encode('utf8') == output
+
+        result = runner.invoke(sieve_cli, ['-i', 'backup', '-j', '2',
+                                           '--defer-indexes',
+                                           '-t', 'shop.item'], obj={})
+        assert result.exit_code == 0
+        output = result.output.encode('utf8')
+        assert b'`note`' not in output
+        assert output.index(b"VALUES (3,'d;');") < \
+            output.index(b'ADD KEY `idx_name`')
+
+        result = runner.invoke(sieve_cli, ['-i', 'backup', '-F', 'directory',
+                                           '-C', 'out', '-z', 'cat'],
+                               obj={})
+        assert result.exit_code == 0
+        with open(os.path.join('out', 'shop', 'item.sql'), 'rb') as f:
+            assert b"VALUES (1,'a'),(2,'b),(c');" in f.read()
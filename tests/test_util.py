@@ -2,7 +2,16 @@
 Test dbsake.util.compression
 
 """
+import bz2
+import gzip
+import io
+import os
+
+import pytest
+
 from dbsake.util import compression
+from dbsake.util import gzindex
+from dbsake.util import matcher
 
 
 def test_progress_bar(capsys):
@@ -40,3 +49,151 @@ def test_rate_bar(capsys):
     assert err.endswith("\n")
 
     assert len(err.split("\r")) == 101  # 101 updates
+
+
+def _gzip_compress(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as fileobj:
+        fileobj.write(data)
+    return buf.getvalue()
+
+
+def _decompress(path, method):
+    with open(path, 'rb') as fileobj:
+        with compression.decompressed(fileobj, method=method) as stream:
+            return stream.read()
+
+
+def test_decompressed_in_process(tmpdir):
+    data = ''.join('line %d\n' % n for n in range(10000)).encode('ascii')
+    for ext, compress in (('.gz', _gzip_compress), ('.bz2', bz2.compress)):
+        path = str(tmpdir.join('data' + ext))
+        # concatenated members, as written by pigz / pbzip2
+        with open(path, 'wb') as fileobj:
+            fileobj.write(compress(data[:5000]))
+            fileobj.write(compress(data[5000:]))
+        assert compression.decompression_method(ext, 'python') is not None
+        assert _decompress(path, 'python') == data
+        assert _decompress(path, 'auto') == data
+
+
+class _NoEofDecompressor(object):
+    """Decompressor without an eof attribute, as on python 2.7"""
+    def __init__(self, decompressor):
+        self.decompressor = decompressor
+
+    def decompress(self, data):
+        return self.decompressor.decompress(data)
+
+    @property
+    def unused_data(self):
+        return self.decompressor.unused_data
+
+
+def test_stream_decompressor():
+    data = ''.join('line %d\n' % n for n in range(10000)).encode('ascii')
+    for compress, factory in ((_gzip_compress,
+                               compression.gzip_decompressor),
+                              (bz2.compress, bz2.BZ2Decompressor)):
+        compressed = compress(data)
+        for wrap in (factory, lambda: _NoEofDecompressor(factory())):
+            # a single member, fed whole and in small pieces
+            for size in (len(compressed), 7):
+                stream = compression.StreamDecompressor(wrap)
+                result = [stream.decompress(compressed[idx:idx + size])
+                          for idx in range(0, len(compressed), size)]
+                result.append(stream.flush())
+                assert b''.join(result) == data
+            # members split exactly at a read boundary
+            stream = compression.StreamDecompressor(wrap)
+            result = stream.decompress(compressed) + \
+                stream.decompress(compressed) + stream.flush()
+            assert result == data * 2
+            stream = compression.StreamDecompressor(wrap)
+            stream.decompress(compressed[:-20])
+            with pytest.raises(compression.DecompressionError):
+                stream.flush()
+
+
+def test_decompressed_truncated(tmpdir):
+    path = str(tmpdir.join('data.gz'))
+    with open(path, 'wb') as fileobj:
+        fileobj.write(_gzip_compress(b'x'*100000)[:-100])
+    with pytest.raises(compression.DecompressionError):
+        _decompress(path, 'python')
+
+
+def test_gzip_index(tmpdir):
+    data = ''.join('%d,%x\n' % (n, n * n) for n in range(300000))
+    data = data.encode('ascii')
+    path = str(tmpdir.join('data.gz'))
+    # two members, so access points follow a member boundary
+    with open(path, 'wb') as fileobj:
+        fileobj.write(_gzip_compress(data[:1000000]))
+        fileobj.write(_gzip_compress(data[1000000:]))
+
+    with open(path, 'rb') as fileobj:
+        gz_index = gzindex.build(fileobj, span=64*1024)
+    assert gz_index.length == len(data)
+    assert len(gz_index.points) > 20
+    assert set(point.bits for point in gz_index.points) == set(range(8))
+    index_path = gzindex.sidecar_path(path)
+    gzindex.write_index(index_path, gz_index)
+    assert gzindex.read_index(index_path) == gz_index
+
+    with open(path, 'rb') as fileobj:
+        assert gzindex.matches(gz_index, fileobj)
+        stream = io.BufferedReader(gzindex.GzipReader(fileobj,
+                                                      index=gz_index))
+        assert stream.read() == data
+        for point in reversed(gz_index.points):
+            stream.seek(point.offset + 1)
+            assert stream.read(100000) == data[point.offset + 1:
+                                               point.offset + 100001]
+        stream.seek(-10, io.SEEK_END)
+        assert stream.read() == data[-10:]
+
+    with open(path, 'r+b') as fileobj:
+        fileobj.truncate(os.path.getsize(path) - 100)
+        reader = gzindex.GzipReader(fileobj)
+        with pytest.raises(compression.DecompressionError):
+            while reader.read(65536):
+                pass
+
+
+def test_proxy_stream(tmpdir):
+    data = ''.join('line %d\n' % n for n in range(100000)).encode('ascii')
+    path = str(tmpdir.join('data.sql'))
+    with open(path, 'wb') as fileobj:
+        fileobj.write(data)
+    # regular files are spliced into the pipe, other streams are copied
+    with open(path, 'rb') as fileobj:
+        fileobj.peek(1)
+        for stream in (fileobj, io.BytesIO(data)):
+            progress = []
+            with compression.ProxyStream(stream, progress.append,
+                                         interval=0) as proxy:
+                with io.open(proxy.fileno(), 'rb', closefd=False) as result:
+                    assert result.read() == data
+            assert sum(progress) == len(data)
+            assert progress[-1] == 0
+
+
+def test_table_matcher():
+    match = matcher.TableMatcher(include=['sakila.*', 'world.city'],
+                                 exclude=['sakila.actor*', 'sakila.film'],
+                                 cache_size=2)
+    assert match('sakila.rental') is False
+    assert match('world.city') is False
+    assert match('world.country') is True
+    assert match('sakila.actor_info') == 'sakila.actor*'
+    assert match.table(b'sakila', b'film') == 'sakila.film'
+    assert match.table(b'sakila', b'film_text') is False
+    assert len(match._cache) == 2
+    # repeated decisions are unchanged once evicted from the cache
+    assert match('world.country') is True
+
+    assert not matcher.TableMatcher()
+    assert matcher.TableMatcher(exclude=['mysql.*'])('test.t1') is False
+    with pytest.raises(ValueError):
+        matcher.TableMatcher(include=['x'], mode='bogus')